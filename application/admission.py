@@ -0,0 +1,112 @@
+"""Admission control and per principal rate limits.
+
+ConcurrencyLimiter bounds the requests a process works on at once, so a
+slow database sheds excess load with fast 503s instead of piling requests
+up in worker threads. RateLimiter keeps a token bucket per authenticated
+principal. Both count what they let through, queue and reject; the counters
+are reported by the stats endpoint and /metrics.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class ConcurrencyLimiter(object):
+    """At most `limit` requests in flight. Up to `queue` more wait at most
+    `timeout` seconds for a slot, the rest are shed. A `limit` of 0 or less
+    admits everything.
+    """
+
+    def __init__(self, limit, queue=0, timeout=0.0):
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.queued = 0
+        self.shed = 0
+        self.timed_out = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Take a slot, waiting in the queue if there is room, False when shed"""
+        if self.limit <= 0:
+            return True
+        with self._cond:
+            if self.in_flight >= self.limit:
+                if self.waiting >= self.queue:
+                    self.shed += 1
+                    return False
+                self.waiting += 1
+                self.queued += 1
+                deadline = time.monotonic() + self.timeout
+                try:
+                    while self.in_flight >= self.limit:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self.shed += 1
+                            self.timed_out += 1
+                            return False
+                        self._cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += 1
+            self.admitted += 1
+            return True
+
+    def release(self):
+        if self.limit <= 0:
+            return
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    @property
+    def stats(self):
+        return {'limit': self.limit, 'queue': self.queue, 'in_flight': self.in_flight, 'waiting': self.waiting,
+                'admitted': self.admitted, 'queued': self.queued, 'shed': self.shed, 'timed_out': self.timed_out}
+
+
+class RateLimiter(object):
+    """Token bucket per key refilled with `rate` tokens per second up to
+    `burst`. Buckets of the `maxsize` most recently seen keys are kept, an
+    evicted key starts over with a full bucket. A `rate` of 0 or less lets
+    everything through.
+    """
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self.allowed = 0
+        self.limited = 0
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token of `key`'s bucket, returns 0 when taken or else the
+        seconds until the bucket holds one again
+        """
+        if self.rate <= 0:
+            return 0
+        now = time.monotonic()
+        with self._lock:
+            tokens, stamp = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - stamp) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+                self.allowed += 1
+            else:
+                wait = (1 - tokens) / self.rate
+                self.limited += 1
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+    @property
+    def stats(self):
+        return {'rate': self.rate, 'burst': self.burst, 'keys': len(self._buckets), 'allowed': self.allowed,
+                'limited': self.limited}
@@ -1,12 +1,23 @@
 import re
+import time
 import uuid
 from datetime import datetime, timedelta
 from functools import wraps
 import jwt
-from flask import Flask, jsonify, request, abort, make_response
+from playhouse.pool import MaxConnectionsExceeded
+from flask import Flask, Response, g, jsonify, request, abort, make_response, stream_with_context
+from playhouse.postgres_ext import ServerSide
 from werkzeug.exceptions import NotFound
 from werkzeug.security import generate_password_hash, check_password_hash
 import application.models as models
+from application.cache import TTLCache
+from application.conditional import conditional
+from application.admission import ConcurrencyLimiter, RateLimiter
+from application.metrics import CallbackGauge, Registry, RequestMetrics
+from application.instrumentation import QueryBudgetExceeded, endpoint_budget, query_budget
+from application.pagination import InvalidCursor, Pager
+from application import serializers
+import math
 import os
 
 def create_app(config_name):
@@ -18,8 +29,77 @@ def create_app(config_name):
 
     app.config.from_object(config_module)
 
-    from application.models import db, migrate
+    # bind the models to the configured database, connections are opened by the first request
+    from application.models import db
+    models.init_db(app.config)
 
+    # public_id -> Users row of recently authenticated principals, evicted by Users.save()/delete_instance()
+    principal_cache = TTLCache(app.config['PRINCIPAL_CACHE_SIZE'], app.config['PRINCIPAL_CACHE_TTL'])
+    models.Users.principal_caches.add(principal_cache)
+
+    # (menu id, servings, read versions) -> shopping list of the weekly menu
+    shopping_list_cache = TTLCache(app.config['SHOPPING_LIST_CACHE_SIZE'], app.config['SHOPPING_LIST_CACHE_TTL'])
+
+    # (classification id, page, per page, cursor, keys, read versions) -> classification list page
+    classification_cache = TTLCache(app.config['CLASSIFICATION_CACHE_SIZE'], app.config['CLASSIFICATION_CACHE_TTL'])
+
+    # bounded in-flight requests of this process and per user token buckets
+    admission = ConcurrencyLimiter(app.config['MAX_IN_FLIGHT'], app.config['ADMISSION_QUEUE'],
+                                   app.config['ADMISSION_TIMEOUT'])
+    rate_limiter = RateLimiter(app.config['RATE_LIMIT_PER_SECOND'], app.config['RATE_LIMIT_BURST'])
+
+    # request latency, status, SQL and serialization time per route, scraped from /metrics
+    app.json = serializers.FastJSONProvider(app)
+    request_metrics = RequestMetrics(Registry(), db)
+    request_metrics.registry.register(CallbackGauge('admission', 'Admission control', lambda: admission.stats))
+    request_metrics.registry.register(CallbackGauge('rate_limit', 'Per user rate limits', lambda: rate_limiter.stats))
+
+    # admit the request, shedding it when the process is saturated, then check a
+    # pooled connection out for it and return it when the request is torn down
+    @app.before_request
+    def db_connect():
+        g.request_start = time.perf_counter()
+        request_metrics.started()
+        db.reset_query_stats()
+        if request.endpoint != 'metrics_endpoint':
+            if not admission.acquire():
+                response = jsonify({'message': 'server is busy, retry later'})
+                response.headers['Retry-After'] = str(app.config['ADMISSION_RETRY_AFTER'])
+                return response, 503
+            g.admitted = True
+        db.connect(reuse_if_open=True)
+
+    # requests running more statements than their view's query_budget fail in strict mode, else are logged
+    def check_query_budget(queries):
+        budget = endpoint_budget()
+        if budget is not None and queries > budget:
+            message = f"{request.endpoint} ran {queries} queries, budget is {budget}"
+            if app.config['QUERY_BUDGET_STRICT']:
+                raise QueryBudgetExceeded(message)
+            app.logger.warning(message)
+
+    # statements run by the request, reported in the response headers and the request log
+    @app.after_request
+    def query_stats(response):
+        stats = db.query_stats
+        elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+        response.headers['X-Query-Count'] = str(stats['queries'])
+        response.headers.add('Server-Timing', f'db;dur={stats["time"] * 1000:.2f};desc="{stats["queries"]} queries"')
+        response.headers.add('Server-Timing', f'serialize;dur={g.get("serialization_time", 0.0) * 1000:.2f}')
+        response.headers.add('Server-Timing', f'total;dur={elapsed * 1000:.2f}')
+        app.logger.info(f"{request.method} {request.full_path.rstrip('?')} {response.status_code} "
+                        f"{stats['queries']} queries {stats['time'] * 1000:.2f}ms db {elapsed * 1000:.2f}ms total")
+        request_metrics.finished(request, response, elapsed, stats)
+        check_query_budget(stats['queries'])
+        return response
+
+    @app.teardown_request
+    def db_close(exc):
+        request_metrics.torn_down()
+        if not db.is_closed():
+            db.close()
+        if g.pop('admitted', False):
+            admission.release()
     # db.init_app(app)
     # migrate.init_app(app, db)
 
@@ -42,10 +122,17 @@ def create_app(config_name):
                     return jsonify({'message': 'a valid token is missing'})
             try:
                 data = jwt.decode(token, app.config['SECRET_KEY'], algorithms=['HS256'])
-                current_user = models.Users.select().where(models.Users.public_id == data['public_id']).get()
+                current_user = principal_cache.get(data['public_id'])
+                if current_user is None:
+                    current_user = models.Users.select().where(models.Users.public_id == data['public_id']).get()
+                    principal_cache.set(data['public_id'], current_user)
             except Exception as e:
                 app.logger.warning(f"valid token missing {e}")
                 return jsonify({'message': 'token is invalid'}), 403
+            wait = rate_limiter.take(str(current_user.public_id))
+            if wait:
+                app.logger.warning(f"rate limit exceeded by {current_user.name}")
+                return jsonify({'message': 'rate limit exceeded'}), 429, {'Retry-After': str(math.ceil(wait))}
             app.logger.info("token validation successful")
             return f(current_user, *args, **kwargs)
     
@@ -64,6 +151,7 @@ def create_app(config_name):
             try:
                 hashed_password = generate_password_hash(data['password'], method='sha256')
                 row = models.Users.create(public_id=uuid.uuid4(), name=data["name"], password=hashed_password, admin=False)
+                models.WriteVersion.bump(models.Users)
                 app.logger.info(f"{row} created successfully")
                 return jsonify({'message': f'{row.name} registered successfully'})
             except Exception as e:
@@ -100,29 +188,25 @@ def create_app(config_name):
     
     @app.route('/api/v1/user', methods=['GET'])
     @token_required
+    @conditional(reads=(models.Users,))
+    @query_budget(3)
     def get_all_users(user):
-        users = models.Users.select()
-        result = []
-        for user in users:
-            user_data = {'public_id': user.public_id, 'name': user.name, 'password': user.password, 'admin': user.admin}
-            result.append(user_data)
+        result = serializers.users(models.Users.select())
         app.logger.info(f"get all users successful: {result}")
         return jsonify({'users': result, "meta": f"Logged in as : {user.name}"})
     
     
-    # simple utility function to create tables
-    def create_model_tables():
-        try:
-            with models.db:
-                models.db.create_tables([models.RecipeClassification, models.Recipe, models.Ingredient, models.Customer,
-                                        models.WeeklyMenuReview,
-                                        models.WeeklyMenu, models.RecipeReview, models.WeeklyRecipeMap, models.Users])
-                app.logger.info("model table creation successful")
-        except Exception as e:
-            app.logger.warning(e)
-    
-    
-    create_model_tables()
+    # Prometheus scrape target, unauthenticated like the usual /metrics endpoints
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        return Response(request_metrics.registry.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+    @app.route('/api/v1/stats', methods=['GET'])
+    @token_required
+    def stats_endpoint(user):
+        return jsonify({'principal_cache': principal_cache.stats, 'shopping_list_cache': shopping_list_cache.stats,
+                        'classification_cache': classification_cache.stats, 'db_pool': db.stats, 'admission': admission.stats, 'rate_limit': rate_limiter.stats})
     
     
     # error handling
@@ -136,21 +220,68 @@ def create_app(config_name):
         }), http_code
     
     
+    @app.errorhandler(MaxConnectionsExceeded)
+    def pool_exhausted(error):
+        return not_found(error, 503)
+    
+    
+    @app.errorhandler(InvalidCursor)
+    def invalid_cursor(error):
+        return not_found(error, 400)
+    
+    
+    # keys a list endpoint serializes for its ?fields= and ?include= parameters, ValueError when unknown
+    def requested_keys(defaults, includes):
+        return serializers.requested(request.args.get('fields'), request.args.get('include'), defaults, includes)
+
+
     # Endpoints
     
     @app.route('/api/v1/recipes', methods=['GET', 'POST'])
     @app.route('/api/v1/recipes/<int:page>', methods=['GET'])
     @app.route('/api/v1/recipes/id/<int:recipe_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.Recipe, models.Ingredient, models.RecipeClassification, models.WeeklyRecipeMap,
+                        models.RecipeRating, models.RecipeReview, models.Customer),
+                 writes=(models.Recipe,))
+    @query_budget(10)
     def recipes_endpoint(user, page=1, recipe_id=0):
         # get request
         if request.method == 'GET':
-            per_page = 10
-            query = models.Recipe.select().where(models.Recipe.is_publish).paginate(page, per_page) if recipe_id == 0 \
-                else models.Recipe.select().where(models.Recipe.id == recipe_id)
-            data = [i.serialize for i in query]
+            pager = Pager(page)
+            try:
+                keys = requested_keys(serializers.RECIPE_KEYS, serializers.RECIPE_INCLUDES)
+            except ValueError as e:
+                return make_response({"error": str(e)}, 400)
+            # nutrient range filters, e.g. ?energy_kj_max=2500&protein_g_min=30
+            bounds = {}
+            for name in models.RecipeNutrition.NUTRIENTS:
+                for bound in (f'{name}_min', f'{name}_max'):
+                    if bound in request.args:
+                        try:
+                            bounds[bound] = float(request.args[bound])
+                        except ValueError:
+                            return make_response({"error": f"{bound} must be a number"}, 400)
+            conditions = [models.Recipe.is_publish]
+            if bounds:
+                conditions.append(models.Recipe.id.in_(models.RecipeNutrition.within(bounds)))
+            # highest rated or most reviewed first, ranked pages read the RecipeRating indexes
+            sort = request.args.get('sort')
+            if sort not in (None, 'rating', 'review_count'):
+                return make_response({"error": "sort must be one of rating, review_count"}, 400)
+            if sort and recipe_id == 0:
+                rank = models.RecipeRating.rating if sort == 'rating' else models.RecipeRating.score_count
+                ranked = models.RecipeRating.select(models.RecipeRating.recipe, rank).join(models.Recipe).where(
+                    *conditions)
+                page = pager.paginate(ranked, models.RecipeRating.recipe, rank=rank)
+                data = serializers.ranked_recipes(
+                    [{'id': recipe, 'rank': value} for recipe, value in pager.rows(list(page.tuples()))], keys)
+            else:
+                query = pager.paginate(models.Recipe.select().where(*conditions), models.Recipe.id) \
+                    if recipe_id == 0 else models.Recipe.select().where(models.Recipe.id == recipe_id)
+                data = pager.rows(serializers.recipes(query, keys))
             if data:
-                return make_response({'recipes': data, 'meta': {'page': page, 'per_page': per_page, 'page_url': request.url}}),200
+                return make_response({'recipes': data, 'meta': pager.meta(data)}),200
             else:
                 return not_found("Recipe does not exists",404)
         elif request.method == 'POST':  # post request
@@ -163,7 +294,7 @@ def create_app(config_name):
             query = models.Recipe.select().where(
                 models.Recipe.id == row.id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.recipes(query)
             app.logger.info(f"{data}")
             return make_response({
                 'Recipe': data,
@@ -211,33 +342,97 @@ def create_app(config_name):
             query = models.Recipe.select().where(
                 models.Recipe.id == recipe_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.recipes(query)
             return make_response({
                 'Recipe': data,
                 'meta': {'page_url': request.url}
             }), 200
     
     
+    @app.route('/api/v1/recipes/search', methods=['GET'])
+    @token_required
+    @conditional(reads=(models.Recipe, models.Ingredient, models.RecipeClassification, models.WeeklyRecipeMap,
+                        models.RecipeRating, models.RecipeReview, models.Customer))
+    @query_budget(7)
+    def recipe_search_endpoint(user):
+        text = request.args.get('q', '').strip()
+        if not text:
+            return make_response({"error": "Missing search text, use ?q="}, 400)
+        try:
+            keys = requested_keys(serializers.RECIPE_KEYS, serializers.RECIPE_INCLUDES)
+        except ValueError as e:
+            return make_response({"error": str(e)}, 400)
+        pager = Pager(request.args.get('page', 1, type=int))
+        matches, rank = models.RecipeSearch.matching(text)
+        page = pager.paginate(matches, models.RecipeSearch.recipe, rank=rank)
+        data = serializers.ranked_recipes(
+            [{'id': recipe_id, 'rank': rank} for recipe_id, rank in pager.rows(list(page.tuples()))], keys)
+        return make_response({'recipes': data, 'meta': pager.meta(data)}), 200
+
+
+    # recipes that can be cooked from a set of ingredients, ranked by how much of them they use
+    @app.route('/api/v1/recipes/by-ingredients', methods=['GET'])
+    @token_required
+    @conditional(reads=(models.Recipe, models.Ingredient, models.RecipeClassification, models.WeeklyRecipeMap,
+                        models.RecipeRating, models.RecipeReview, models.Customer))
+    @query_budget(8)
+    def recipe_coverage_endpoint(user):
+        try:
+            keys = requested_keys(serializers.RECIPE_KEYS, serializers.RECIPE_INCLUDES)
+        except ValueError as e:
+            return make_response({"error": str(e)}, 400)
+        required = request.args.getlist('required')
+        optional = request.args.getlist('optional')
+        menu_id = request.args.get('menu_id', type=int)
+        if not (required or optional or menu_id):
+            return make_response({"error": "Give ingredient names with ?required= / ?optional=, or a menu_id"}, 400)
+        if len(required) + len(optional) > app.config['MAX_COVERAGE_NAMES']:
+            return make_response({"error": f"At most {app.config['MAX_COVERAGE_NAMES']} ingredient names"}, 400)
+        if menu_id is not None and models.WeeklyMenu.get_or_none(models.WeeklyMenu.id == menu_id) is None:
+            return not_found("WeeklyMenu does not exists", 404)
+        pager = Pager(request.args.get('page', 1, type=int))
+        rows, rank, key = models.Ingredient.coverage(required, optional, menu_id)
+        page = pager.paginate(rows, key, rank=rank)
+        data = serializers.ranked_recipes([
+            {'id': recipe_id, 'rank': rank, 'coverage': {'matched': matched, 'missing': missing}}
+            for recipe_id, matched, missing, rank in pager.rows(list(page.tuples()))], keys)
+        return make_response({'recipes': data, 'meta': pager.meta(data)}), 200
+
+
     @app.route('/api/v1/recipes-classification', methods=['GET', 'POST'])
     @app.route('/api/v1/recipes-classification/<int:page>', methods=['GET'])
     @app.route('/api/v1/recipes-classification/id/<int:recipe_classification_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.RecipeClassification, models.Recipe), writes=(models.RecipeClassification,))
+    @query_budget(7)
     def recipes_classification_endpoint(user=None, page=1, recipe_classification_id=0):
         # get request
         if request.method == 'GET':
-            per_page = 10
+            pager = Pager(page)
             try:
-                query = models.RecipeClassification.select().where(
-                    models.RecipeClassification.is_publish).paginate(
-                    page, per_page) if recipe_classification_id == 0 else models.RecipeClassification.select().where(
-                    models.RecipeClassification.id == recipe_classification_id)
-            except Exception as e:
-                return not_found(e, 404)
-            data = [i.serialize for i in query]
+                keys = requested_keys(serializers.CLASSIFICATION_KEYS, serializers.CLASSIFICATION_INCLUDES)
+            except ValueError as e:
+                return make_response({"error": str(e)}, 400)
+            # pages stay valid until a recipe or classification write bumps the read versions
+            key = (recipe_classification_id, pager.page, pager.per_page, pager.cursor, keys, g.read_versions)
+            data = classification_cache.get(key)
+            if data is None:
+                try:
+                    query = pager.paginate(models.RecipeClassification.select().where(
+                        models.RecipeClassification.is_publish), models.RecipeClassification.id) \
+                        if recipe_classification_id == 0 else models.RecipeClassification.select().where(
+                        models.RecipeClassification.id == recipe_classification_id)
+                except InvalidCursor:
+                    raise
+                except Exception as e:
+                    return not_found(e, 404)
+                data = serializers.classifications(query, keys)
+                classification_cache.set(key, data)
+            data = pager.rows(data)
             if data:
                 return make_response(jsonify({
                     'recipes-classification': data,
-                    'meta': {'page': page, 'per_page': per_page, 'page_url': request.url}
+                    'meta': pager.meta(data)
                 })), 200
             else:
                 return not_found("No records found", 404)
@@ -252,7 +447,7 @@ def create_app(config_name):
             query = models.RecipeClassification.select().where(
                 models.RecipeClassification.id == row.id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.classifications(query)
             return make_response(jsonify({
                 'recipes-classification': data,
                 'meta': {'page_url': request.url}
@@ -273,7 +468,7 @@ def create_app(config_name):
             if recipeClassification:
                 recipeClassification.is_publish = False
                 recipeClassification.save()
-                return make_response(jsonify([recipeClassification.serialize])), 204
+                return make_response(""), 204
             else:
                 return make_response(jsonify({
                     "Error": "The requested resource is no longer available at the "
@@ -304,30 +499,61 @@ def create_app(config_name):
             query = models.RecipeClassification.select().where(
                 models.RecipeClassification.id == recipe_classification_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.classifications(query)
             return make_response(jsonify({
                 'recipes-classification': data,
                 'meta': {'page_url': request.url}
             })), 200
     
     
+    def create_ingredients(items):
+        """Bulk insert ingredients and respond with every created row"""
+        if not items:
+            return make_response({"error": "Payload must hold at least one ingredient"}, 400)
+        if len(items) > app.config['MAX_BULK_ROWS']:
+            return make_response({"error": f"Payload must hold at most {app.config['MAX_BULK_ROWS']} ingredients"}, 413)
+        try:
+            rows = models.Ingredient.create_many(items)
+        except models.ValidationError as e:
+            app.logger.warning(f"bulk ingredient insert rejected: {e.errors}")
+            return make_response({"errors": e.errors}, e.status)
+        except Exception as e:
+            return not_found(e, 409)
+        return make_response(jsonify({
+            'Ingredient': models.Ingredient.serialize_many(rows),
+            'meta': {'count': len(rows), 'page_url': request.url}
+        })), 201
+    
+    
+    @app.route('/api/v1/recipes/id/<int:recipe_id>/ingredients', methods=['POST'])
+    @token_required
+    @conditional(writes=(models.Ingredient,))
+    @query_budget(8)
+    def recipe_ingredients_endpoint(user, recipe_id):
+        if not isinstance(request.json, list):
+            return make_response({"error": "Payload must be a list of ingredients"}, 400)
+        return create_ingredients([dict(i, recipe=recipe_id) if isinstance(i, dict) else i for i in request.json])
+    
+    
     @app.route('/api/v1/ingredient', methods=['GET', 'POST'])
     @app.route('/api/v1/ingredient/<int:page>', methods=['GET'])
     @app.route('/api/v1/ingredient/id/<int:ingredient_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.Ingredient, models.Recipe), writes=(models.Ingredient,))
+    @query_budget(8)
     def ingredient_endpoint(user, page=1, ingredient_id=-1):
         # get request
         if request.method == 'GET':
-            per_page = 10
+            pager = Pager(page)
             if ingredient_id == -1:
-                query = models.Ingredient.select().paginate(page, per_page)
+                query = pager.paginate(models.Ingredient.select(), models.Ingredient.id)
             else:
                 query = models.Ingredient.select().where(models.Ingredient.id == ingredient_id)
-            data = [i.serialize for i in query]
+            data = pager.rows(serializers.ingredients(query))
             if data:
                 return make_response(jsonify({
                     'Ingredient': data,
-                    'meta': {'page': page, 'per_page': per_page, 'page_url': request.url}
+                    'meta': pager.meta(data)
                 })), 200
             else:
                 # if no results are found.
@@ -337,12 +563,14 @@ def create_app(config_name):
                 })), 404
     
         elif request.method == 'POST':  # post request
+            if isinstance(request.json, list):
+                return create_ingredients(request.json)
             try:
                 row = models.Ingredient.create(**request.json)
                 query = models.Ingredient.select().where(
                     models.Ingredient.id == row.id,
                 )
-                data = [i.serialize for i in query]
+                data = serializers.ingredients(query)
                 return make_response(jsonify({
                     'Ingredient': data,
                     'meta': {'page_url': request.url}
@@ -393,40 +621,67 @@ def create_app(config_name):
             query = models.Ingredient.select().where(
                 models.Ingredient.id == ingredient_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.ingredients(query)
             return make_response(jsonify({
                 'Ingredient': data,
                 'meta': {'page_url': request.url}
             })), 200
     
     
+    def review_filters(model, parent, parent_arg):
+        """Conditions of the review list query arguments: `parent_arg` (id of the
+        reviewed row), customer_id, min_score and a [since, until) pub_date range.
+        Raises ValueError for malformed values.
+        """
+        conditions = []
+        if parent_arg in request.args:
+            conditions.append(parent == int(request.args[parent_arg]))
+        if 'customer_id' in request.args:
+            conditions.append(model.customer == int(request.args['customer_id']))
+        if 'min_score' in request.args:
+            conditions.append(model.score >= int(request.args['min_score']))
+        if 'since' in request.args:
+            conditions.append(model.pub_date >= datetime.fromisoformat(request.args['since']))
+        if 'until' in request.args:
+            conditions.append(model.pub_date < datetime.fromisoformat(request.args['until']))
+        return conditions
+
+
     @app.route('/api/v1/recipe-review', methods=['GET', 'POST'])
     @app.route('/api/v1/recipe-review/<int:page>', methods=['GET'])
     @app.route('/api/v1/recipe-review/id/<int:recipe_review_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.RecipeReview, models.Recipe, models.Customer),
+                 writes=(models.RecipeReview, models.RecipeRating))
+    @query_budget(7)
     def recipe_review_endpoint(user=None, page=1, recipe_review_id=0):
         # get request
         if request.method == 'GET':
-            per_page = 10
-            query = models.RecipeReview.select().where(models.RecipeReview.is_publish).paginate(page, per_page) \
+            pager = Pager(page)
+            try:
+                conditions = review_filters(models.RecipeReview, models.RecipeReview.recipe, 'recipe_id')
+            except ValueError as e:
+                return make_response({"error": f"invalid filter: {e}"}, 400)
+            query = pager.paginate(models.RecipeReview.select().where(models.RecipeReview.is_publish, *conditions),
+                                   models.RecipeReview.id) \
                 if recipe_review_id == 0 else models.RecipeReview.select().where(models.RecipeReview.id == recipe_review_id)
-            data = [i.serialize for i in query]
+            data = pager.rows(serializers.recipe_reviews(query))
             app.logger.info(f"data:{data}")
             if not data:
                 return not_found(NotFound("No matching records found"), 404)
-            return make_response({'recipe-review': data, 'meta': {'page': page,
-                                                                'per_page': per_page,
-                                                                'page_url': request.url}}), 200
+            return make_response({'recipe-review': data, 'meta': pager.meta(data)}), 200
         elif request.method == 'POST':  # post request
             # print(request.json)
             try:
-                row = models.RecipeReview.create(**request.json)
+                with models.db.atomic():
+                    row = models.RecipeReview.create(**request.json)
+                    models.RecipeRating.review_changed(None, row.score_state)
             except Exception as e:
                 return not_found(e, 409)
             query = models.RecipeReview.select().where(
                 models.RecipeReview.id == row.id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.recipe_reviews(query)
             app.logger.info(f"data:{data}")
             return make_response({
                 'recipe-review': data,
@@ -435,42 +690,48 @@ def create_app(config_name):
     
         elif request.method == "DELETE":  # delete endpoint
         
-            try:
-                RecipeReview = models.RecipeReview.get(
-                    models.RecipeReview.id == recipe_review_id
-                )
-            except Exception as e:
-                return not_found(e, 404)
-    
-            if RecipeReview and RecipeReview.is_publish:
+            # the row is locked before reading its score, so concurrent writes apply their deltas in turn
+            with models.db.atomic():
+                try:
+                    RecipeReview = models.RecipeReview.select().where(
+                        models.RecipeReview.id == recipe_review_id
+                    ).for_update().get()
+                except Exception as e:
+                    return not_found(e, 404)
+                if not RecipeReview.is_publish:
+                    return not_found(NotFound("RecipeReview already deleted or does not exists"))
+                before = RecipeReview.score_state
                 RecipeReview.is_publish = False
                 RecipeReview.save()
-                return make_response(""), 204
-            else:
-                return not_found(NotFound("RecipeReview already deleted or does not exists"))
+                models.RecipeRating.review_changed(before, RecipeReview.score_state)
+            return make_response(""), 204
         elif request.method == "PUT":  # put endpoint
-            try:
-                c = models.RecipeReview.get(
-                    models.RecipeReview.id == recipe_review_id
-                )
-            except Exception as e:
-                return not_found(e, 400)
             if not request.json:
                 abort(400)
             # print(request.json.items())
             try:
-                for k, v in request.json.items():
-                    if k in c.__dict__['__data__']:
-                        setattr(c, k, v)
-                    else:
-                        app.logger.warning(f"'{k}' is not one of the attributes of {c}, ignoring {k}:{v}")
-                c.save()
+                with models.db.atomic():
+                    # locked before reading its score, see DELETE
+                    try:
+                        c = models.RecipeReview.select().where(
+                            models.RecipeReview.id == recipe_review_id
+                        ).for_update().get()
+                    except models.DoesNotExist as e:
+                        return not_found(e, 400)
+                    before = c.score_state
+                    for k, v in request.json.items():
+                        if k in c.__dict__['__data__']:
+                            setattr(c, k, v)
+                        else:
+                            app.logger.warning(f"'{k}' is not one of the attributes of {c}, ignoring {k}:{v}")
+                    c.save()
+                    models.RecipeRating.review_changed(before, c.score_state)
             except Exception as e:
                 return not_found(e, 202)
             query = models.RecipeReview.select().where(
                 models.RecipeReview.id == recipe_review_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.recipe_reviews(query)
             return make_response({
                 'recipe-review': data,
                 'meta': {'page_url': request.url}
@@ -481,29 +742,38 @@ def create_app(config_name):
     @app.route('/api/v1/weekly-menu-review/<int:page>', methods=['GET'])
     @app.route('/api/v1/weekly-menu-review/id/<int:weekly_menu_review_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.WeeklyMenuReview, models.WeeklyMenu, models.Customer),
+                 writes=(models.WeeklyMenuReview, models.WeeklyMenuScore))
+    @query_budget(7)
     def weekly_menu_review_endpoint(user=None, page=1, weekly_menu_review_id=0):
         # get request
         if request.method == 'GET':
-            per_page = 10
-            query = models.WeeklyMenuReview.select().where(models.WeeklyMenuReview.is_publish).paginate(page, per_page) \
+            pager = Pager(page)
+            try:
+                conditions = review_filters(models.WeeklyMenuReview, models.WeeklyMenuReview.menu, 'menu_id')
+            except ValueError as e:
+                return make_response({"error": f"invalid filter: {e}"}, 400)
+            query = pager.paginate(
+                models.WeeklyMenuReview.select().where(models.WeeklyMenuReview.is_publish, *conditions),
+                models.WeeklyMenuReview.id) \
                 if weekly_menu_review_id == 0 else models.WeeklyMenuReview.select(). \
                 where(models.WeeklyMenuReview.id == weekly_menu_review_id)
-            data = [i.serialize for i in query]
+            data = pager.rows(serializers.weekly_menu_reviews(query))
             if not data:
                 return not_found(NotFound("No matching records found"), 404)
-            return make_response({'weekly-menu-review': data, 'meta': {'page': page,
-                                                                    'per_page': per_page,
-                                                                    'page_url': request.url}}), 200
+            return make_response({'weekly-menu-review': data, 'meta': pager.meta(data)}), 200
         elif request.method == 'POST':  # post request
             # print(request.json)
             try:
-                row = models.WeeklyMenuReview.create(**request.json)
+                with models.db.atomic():
+                    row = models.WeeklyMenuReview.create(**request.json)
+                    models.WeeklyMenuScore.review_changed(None, row.score_state)
             except Exception as e:
                 return not_found(e, 409)
             query = models.WeeklyMenuReview.select().where(
                 models.WeeklyMenuReview.id == row.id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.weekly_menu_reviews(query)
             return make_response({
                 'weekly-menu-review': data,
                 'meta': {'page_url': request.url}
@@ -511,42 +781,48 @@ def create_app(config_name):
     
         elif request.method == "DELETE":  # delete endpoint
         
-            try:
-                review_object = models.WeeklyMenuReview.get(
-                    models.WeeklyMenuReview.id == weekly_menu_review_id
-                )
-            except Exception as e:
-                return not_found(e, 404)
-    
-            if review_object and review_object.is_publish:
+            # the row is locked before reading its score, so concurrent writes apply their deltas in turn
+            with models.db.atomic():
+                try:
+                    review_object = models.WeeklyMenuReview.select().where(
+                        models.WeeklyMenuReview.id == weekly_menu_review_id
+                    ).for_update().get()
+                except Exception as e:
+                    return not_found(e, 404)
+                if not review_object.is_publish:
+                    return not_found(NotFound("RecipeReview already deleted or does not exists"))
+                before = review_object.score_state
                 review_object.is_publish = False
                 review_object.save()
-                return make_response(""), 204
-            else:
-                return not_found(NotFound("RecipeReview already deleted or does not exists"))
+                models.WeeklyMenuScore.review_changed(before, review_object.score_state)
+            return make_response(""), 204
         elif request.method == "PUT":  # put endpoint
-            try:
-                c = models.WeeklyMenuReview.get(
-                    models.WeeklyMenuReview.id == weekly_menu_review_id
-                )
-            except Exception as e:
-                return not_found(e, 400)
             if not request.json:
                 abort(400)
             # print(request.json.items())
             try:
-                for k, v in request.json.items():
-                    if k in c.__dict__['__data__']:
-                        setattr(c, k, v)
-                    else:
-                        app.logger.warning(f"'{k}' is not one of the attributes of {c}, ignoring {k}:{v}")
-                c.save()
+                with models.db.atomic():
+                    # locked before reading its score, see DELETE
+                    try:
+                        c = models.WeeklyMenuReview.select().where(
+                            models.WeeklyMenuReview.id == weekly_menu_review_id
+                        ).for_update().get()
+                    except models.DoesNotExist as e:
+                        return not_found(e, 400)
+                    before = c.score_state
+                    for k, v in request.json.items():
+                        if k in c.__dict__['__data__']:
+                            setattr(c, k, v)
+                        else:
+                            app.logger.warning(f"'{k}' is not one of the attributes of {c}, ignoring {k}:{v}")
+                    c.save()
+                    models.WeeklyMenuScore.review_changed(before, c.score_state)
             except Exception as e:
                 return not_found(e, 202)
             query = models.WeeklyMenuReview.select().where(
                 models.WeeklyMenuReview.id == weekly_menu_review_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.weekly_menu_reviews(query)
             return make_response({
                 'weekly-menu-review': data,
                 'meta': {'page_url': request.url}
@@ -557,17 +833,13 @@ def create_app(config_name):
     @app.route('/api/v1/customer/<int:page>', methods=['GET'])
     @app.route('/api/v1/customer/id/<int:customer_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.Customer,), writes=(models.Customer,))
     def customer_endpoint(user=None, page=1, customer_id=0):
         # get request
         if request.method == 'GET':
             customer = models.Customer.select() if customer_id == 0 else models.Customer.select(). \
                 where(models.Customer.id == customer_id)
-            result = []
-            for user in customer:
-                user_data = {"id": user.id, 'public_id': user.public_id, 'name': user.name, 'password': user.password,
-                            'admin': user.admin,
-                            "is_active": user.is_active}
-                result.append(user_data)
+            result = serializers.customers(customer, private=True)
             return make_response({'users': result, "meta": f"Logged in as : {user.name}"}), 200
         elif request.method == 'POST':  # post request
             # print(request.json)
@@ -617,15 +889,68 @@ def create_app(config_name):
             query = models.Customer.select().where(
                 models.Customer.id == customer_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.customers(query)
             return make_response({
                 'customer': data,
                 'meta': {'page_url': request.url}
             }), 200
     
     
+    # resource -> (model, timestamp column used by `since`)
+    export_resources = {
+        'recipes': (models.Recipe, None),
+        'ingredients': (models.Ingredient, None),
+        'recipe-reviews': (models.RecipeReview, models.RecipeReview.pub_date),
+        'weekly-menu-reviews': (models.WeeklyMenuReview, models.WeeklyMenuReview.pub_date),
+    }
+    
+    
+    @app.route('/api/v1/export/<resource>', methods=['GET'])
+    @token_required
+    @query_budget(3)
+    def export_endpoint(user, resource):
+        """Stream every row of a resource as newline delimited JSON, ordered by id.
+
+        `since_id` resumes after a row id, `since` (ISO 8601) keeps rows
+        published at or after a point in time for resources with a pub_date.
+        Rows are encoded by the app's JSON provider. The streamed statements
+        run after the response headers are sent, so the budget is checked
+        again once the stream is done.
+        """
+        if resource not in export_resources:
+            return not_found(NotFound(f"unknown export {resource}, pick one of {sorted(export_resources)}"), 404)
+        model, timestamp = export_resources[resource]
+        query = model.select().order_by(model.id).dicts()
+        try:
+            if 'since_id' in request.args:
+                query = query.where(model.id > int(request.args['since_id']))
+            if 'since' in request.args:
+                if timestamp is None:
+                    raise ValueError(f"{resource} has no timestamp to filter on")
+                query = query.where(timestamp >= datetime.fromisoformat(request.args['since']))
+        except ValueError as e:
+            return not_found(e, 400)
+    
+        def generate():
+            # a named cursor has to live inside a transaction
+            with models.db.atomic():
+                lines = []
+                for row in ServerSide(query, array_size=app.config['EXPORT_FETCH_SIZE']):
+                    lines.append(app.json.dumps(row))
+                    if len(lines) >= 500:
+                        yield '\n'.join(lines) + '\n'
+                        lines = []
+                if lines:
+                    yield '\n'.join(lines) + '\n'
+            check_query_budget(db.query_stats['queries'])
+    
+        app.logger.info(f"export of {resource} started by {user}")
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    
+    
     @app.route('/api/v1/weekly-menu/id/<int:weekly_menu_id>/recipe/id/<int:recipe_id>', methods=['POST', 'DELETE'])
     @token_required
+    @conditional(writes=(models.WeeklyRecipeMap,))
     def add_remove_recipe_to_weekly_menu_endpoint(user, weekly_menu_id, recipe_id):
         if request.method == 'POST':
             try:
@@ -639,7 +964,7 @@ def create_app(config_name):
                 query = models.WeeklyMenu.select().where(
                     models.WeeklyMenu.id == weekly_menu.id,
                 )
-                data = [i.serialize for i in query]
+                data = serializers.weekly_menus(query)
                 return make_response({
                     'WeeklyMenu': data,
                     'meta': {'page_url': request.url}
@@ -660,7 +985,7 @@ def create_app(config_name):
                 query = models.WeeklyMenu.select().where(
                     models.WeeklyMenu.id == weekly_menu.id,
                 )
-                data = [i.serialize for i in query]
+                data = serializers.weekly_menus(query)
                 return make_response({
                     'WeeklyMenu': data,
                     'meta': {'page_url': request.url}
@@ -669,23 +994,135 @@ def create_app(config_name):
                 return not_found(e)
     
     
+    def recipe_id_list(payload, key):
+        """Distinct recipe ids listed under `key` of a payload, ValueError unless a list of integers"""
+        ids = payload.get(key, [])
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise ValueError(f"{key} must be a list of recipe ids")
+        return list(dict.fromkeys(ids))
+
+
+    # the whole recipe set of a menu in one transaction: PUT {"recipes": [...]} replaces it,
+    # PATCH {"add": [...], "remove": [...]} applies a diff to it
+    @app.route('/api/v1/weekly-menu/id/<int:weekly_menu_id>/recipes', methods=['PUT', 'PATCH'])
+    @token_required
+    @conditional(writes=(models.WeeklyRecipeMap,))
+    @query_budget(9)
+    def weekly_menu_recipes_endpoint(user, weekly_menu_id):
+        payload = request.get_json(silent=True)
+        if not isinstance(payload, dict) or (request.method == 'PUT' and 'recipes' not in payload):
+            return make_response({"error": "Payload must be an object with a recipes list"
+                                  if request.method == 'PUT' else "Payload must be an object"}, 400)
+        try:
+            if request.method == 'PUT':
+                add, remove = recipe_id_list(payload, 'recipes'), []
+            else:
+                add, remove = recipe_id_list(payload, 'add'), recipe_id_list(payload, 'remove')
+        except ValueError as e:
+            return make_response({"error": str(e)}, 400)
+        if set(add) & set(remove):
+            return make_response({"error": "A recipe cannot be both added and removed"}, 400)
+        if len(add) + len(remove) > app.config['MAX_BULK_ROWS']:
+            return make_response({"error": f"At most {app.config['MAX_BULK_ROWS']} recipes"}, 413)
+        if models.WeeklyMenu.get_or_none(models.WeeklyMenu.id == weekly_menu_id) is None:
+            return not_found("WeeklyMenu does not exists", 404)
+        unknown = set(add) - {recipe_id for recipe_id, in models.Recipe.select(models.Recipe.id).where(
+            models.Recipe.id.in_(add)).tuples()} if add else set()
+        if unknown:
+            return make_response({"error": "Unknown recipes", "recipes": sorted(unknown)}, 400)
+        try:
+            if request.method == 'PUT':
+                added, removed = models.WeeklyMenu.set_recipes(weekly_menu_id, add)
+            else:
+                with models.db.atomic():
+                    removed = models.WeeklyMenu.remove_recipes(weekly_menu_id, remove) if remove else 0
+                    added = models.WeeklyMenu.add_recipes(weekly_menu_id, add)
+        except models.IntegrityError as e:
+            return not_found(e, 409)
+        data = serializers.weekly_menus(models.WeeklyMenu.select().where(models.WeeklyMenu.id == weekly_menu_id))
+        return make_response({
+            'WeeklyMenu': data,
+            'meta': {'added': added, 'removed': removed, 'page_url': request.url}
+        }), 200
+
+
+    # copy the recipes of the menu of another week, {"week_number": N, "replace": false}
+    @app.route('/api/v1/weekly-menu/id/<int:weekly_menu_id>/recipes/clone', methods=['POST'])
+    @token_required
+    @conditional(writes=(models.WeeklyRecipeMap,))
+    @query_budget(8)
+    def weekly_menu_clone_endpoint(user, weekly_menu_id):
+        payload = request.get_json(silent=True)
+        week_number = payload.get('week_number') if isinstance(payload, dict) else None
+        if not isinstance(week_number, int) or isinstance(week_number, bool):
+            return make_response({"error": "Payload must give the week_number to clone from"}, 400)
+        if models.WeeklyMenu.get_or_none(models.WeeklyMenu.id == weekly_menu_id) is None:
+            return not_found("WeeklyMenu does not exists", 404)
+        source = models.WeeklyMenu.get_or_none(models.WeeklyMenu.week_number == week_number)
+        if source is None:
+            return not_found(f"No weekly menu for week {week_number}", 404)
+        if source.id == weekly_menu_id:
+            return make_response({"error": "A weekly menu cannot be cloned into itself"}, 400)
+        with models.db.atomic():
+            removed = models.WeeklyMenu.remove_recipes(weekly_menu_id) if payload.get('replace') else 0
+            added = models.WeeklyMenu.clone_recipes(weekly_menu_id, source.id)
+        data = serializers.weekly_menus(models.WeeklyMenu.select().where(models.WeeklyMenu.id == weekly_menu_id))
+        return make_response({
+            'WeeklyMenu': data,
+            'meta': {'added': added, 'removed': removed, 'source': source.id, 'page_url': request.url}
+        }), 201
+
+
+    # pick list of a weekly menu, ingredient totals over all of its recipes
+    @app.route('/api/v1/weekly-menu/id/<int:weekly_menu_id>/shopping-list', methods=['GET'])
+    @token_required
+    @conditional(reads=(models.WeeklyMenu, models.WeeklyRecipeMap, models.Ingredient, models.Recipe))
+    @query_budget(4)
+    def weekly_menu_shopping_list_endpoint(user, weekly_menu_id):
+        servings = request.args.get('servings')
+        if servings is not None:
+            try:
+                servings = int(servings)
+                if servings < 1:
+                    raise ValueError(servings)
+            except ValueError:
+                return make_response({"error": "servings must be a positive integer"}, 400)
+        key = (weekly_menu_id, servings, g.read_versions)
+        data = shopping_list_cache.get(key)
+        if data is None:
+            if models.WeeklyMenu.get_or_none(models.WeeklyMenu.id == weekly_menu_id) is None:
+                return not_found("WeeklyMenu does not exists", 404)
+            data = models.WeeklyMenu.shopping_list(weekly_menu_id, servings)
+            shopping_list_cache.set(key, data)
+        return make_response({
+            'shopping-list': data,
+            'meta': {'menu': weekly_menu_id, 'servings': servings, 'page_url': request.url}
+        }), 200
+
+
     @app.route('/api/v1/weekly-menu', methods=['GET', 'POST'])
     @app.route('/api/v1/weekly-menu/<int:page>', methods=['GET'])
     @app.route('/api/v1/weekly-menu/id/<int:weekly_menu_id>', methods=['GET', 'DELETE', 'PUT'])
     @token_required
+    @conditional(reads=(models.WeeklyMenu, models.WeeklyRecipeMap, models.WeeklyMenuScore, models.WeeklyMenuReview,
+                        models.Recipe, models.RecipeClassification, models.Customer),
+                 writes=(models.WeeklyMenu,))
     def weekly_menu_endpoint(user, page=1, weekly_menu_id=0):
         # get request
         if request.method == 'GET':
-            per_page = 10
-            query = models.WeeklyMenu.select().where(models.WeeklyMenu.is_publish).paginate(page,
-                                                                                        per_page) if weekly_menu_id == 0 \
+            pager = Pager(page)
+            try:
+                keys = requested_keys(serializers.MENU_KEYS, serializers.MENU_INCLUDES)
+            except ValueError as e:
+                return make_response({"error": str(e)}, 400)
+            query = pager.paginate(models.WeeklyMenu.select().where(models.WeeklyMenu.is_publish),
+                                   models.WeeklyMenu.id) if weekly_menu_id == 0 \
                 else models.WeeklyMenu.select().where(models.WeeklyMenu.id == weekly_menu_id)
-            data = [i.serialize for i in query]
+            data = pager.rows(serializers.weekly_menus(query, keys))
             # print(data)
             if not data:
                 return not_found(NotFound("No matching records found"), 404)
-            return make_response({'weekly-menu': data, 'meta': {'page': page, 'per_page': per_page,
-                                                                'page_url': request.url}}), 200
+            return make_response({'weekly-menu': data, 'meta': pager.meta(data)}), 200
         elif request.method == 'POST':  # post request
             # print(request.json)
             try:
@@ -695,7 +1132,7 @@ def create_app(config_name):
             query = models.WeeklyMenu.select().where(
                 models.WeeklyMenu.id == row.id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.weekly_menus(query)
             return make_response({
                 'WeeklyMenu': data,
                 'meta': {'page_url': request.url}
@@ -738,7 +1175,7 @@ def create_app(config_name):
             query = models.WeeklyMenu.select().where(
                 models.WeeklyMenu.id == weekly_menu_id,
             )
-            data = [i.serialize for i in query]
+            data = serializers.weekly_menus(query)
             return make_response({
                 'WeeklyMenu': data,
                 'meta': {'page_url': request.url}
@@ -0,0 +1,283 @@
+"""Bulk import of catalog documents such as the samples in data/.
+
+A document is a sequence of sections, each a `#<kind> -->` marker line
+followed by a JSON object or a list of objects::
+
+    #type -->
+    { "is_publish": true, "name": "Veggis" }
+
+    #recipe -->
+    { "recipe_name": "...", "classification": 2, ... }
+
+    #ingredient -->
+    [{ "ingredient_name": "garlic", "unit": "clove", "count": 2 }]
+
+Recipes of a document belong to the document's `type` (classification)
+and ingredients to its recipe, so the numeric ids in the samples do not
+have to match the target database. A string `classification` or
+`recipe` is looked up by name instead. Rows with values their columns
+would reject are skipped and counted as errors, the rest of the batch is
+still written.
+"""
+import json
+import os
+import re
+import time
+
+from peewee import BooleanField, CharField, ForeignKeyField, IntegerField, SmallIntegerField, TextField, chunked
+from playhouse.postgres_ext import HStoreField
+
+from application import models
+
+SECTION = re.compile(r'^#\s*(\w+)\s*-->\s*$', re.MULTILINE)
+KINDS = {
+    'type': 'classification',
+    'classification': 'classification',
+    'recipe': 'recipe',
+    'ingredient': 'ingredient',
+    'ingredients': 'ingredient',
+}
+SMALLINT = (-2 ** 15, 2 ** 15 - 1)
+INTEGER = (-2 ** 31, 2 ** 31 - 1)
+
+
+class CatalogError(ValueError):
+    """Raised for documents that cannot be parsed or resolved"""
+
+
+def parse_document(text):
+    """Return the (kind, [payload, ...]) sections of a catalog document"""
+    parts = SECTION.split(text)
+    if parts[0].strip():
+        raise CatalogError("content before the first section marker")
+    sections = []
+    for marker, body in zip(parts[1::2], parts[2::2]):
+        kind = KINDS.get(marker.lower())
+        if kind is None:
+            raise CatalogError(f"unknown section #{marker}")
+        try:
+            payload = json.loads(body, strict=False)
+        except ValueError as e:
+            raise CatalogError(f"invalid JSON in #{marker} section: {e}") from e
+        sections.append((kind, payload if isinstance(payload, list) else [payload]))
+    return sections
+
+
+def iter_files(paths):
+    """Yield the .json files of `paths`, descending into directories"""
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.endswith('.json'):
+                        yield os.path.join(root, name)
+        else:
+            yield path
+
+
+def _columns(model, payload):
+    return {name: payload[name] for name in model._meta.fields if name in payload and name != 'id'}
+
+
+def _text(name, value):
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise CatalogError(f"invalid {name} {value!r}")
+    value = str(value)
+    if '\x00' in value:
+        raise CatalogError(f"invalid {name} {value!r}")
+    return value
+
+
+def _value(field, value):
+    """`value` converted for the column of `field`, CatalogError when the
+    database would reject it
+    """
+    name = field.name
+    if isinstance(field, ForeignKeyField):
+        field = field.rel_field
+    if isinstance(field, BooleanField):
+        if not isinstance(value, bool):
+            raise CatalogError(f"invalid {name} {value!r}")
+        return value
+    if isinstance(field, IntegerField):
+        try:
+            if isinstance(value, bool) or isinstance(value, float) and not value.is_integer():
+                raise ValueError
+            value = int(value)
+        except (TypeError, ValueError):
+            raise CatalogError(f"invalid {name} {value!r}") from None
+        low, high = SMALLINT if isinstance(field, SmallIntegerField) else INTEGER
+        if not low <= value <= high:
+            raise CatalogError(f"{name} {value} out of range")
+        return value
+    if isinstance(field, HStoreField):
+        if not isinstance(value, dict):
+            raise CatalogError(f"invalid {name} {value!r}")
+        return {_text(name, k): None if v is None else _text(name, v) for k, v in value.items()}
+    if isinstance(field, (CharField, TextField)):
+        value = _text(name, value)
+        if getattr(field, 'max_length', None) and len(value) > field.max_length:
+            raise CatalogError(f"{name} longer than {field.max_length} characters")
+    return value
+
+
+def _row(model, row):
+    """`row` with every value converted for its column of `model`"""
+    return {name: _value(model._meta.fields[name], value) for name, value in row.items()}
+
+
+class CatalogLoader(object):
+    """Buffers documents and writes them in batches of upserts.
+
+    Classifications are keyed on `name`, recipes on `recipe_name` and
+    ingredients on (ingredient_name, recipe), so importing the same
+    catalog twice updates rows in place.
+    """
+
+    def __init__(self, batch_size=1000):
+        self.batch_size = batch_size
+        self.classifications = {}  # name -> id
+        self.recipes = {}  # recipe_name -> id
+        self.documents = []
+        self.counts = {'documents': 0, 'classifications': 0, 'recipes': 0, 'ingredients': 0, 'errors': 0}
+
+    def add(self, sections):
+        self.documents.append(sections)
+        if len(self.documents) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        documents, self.documents = self.documents, []
+        if not documents:
+            return
+        with models.db.atomic():
+            self._upsert_classifications(documents)
+            recipe_ids = self._upsert_recipes(documents)
+            recipe_ids.update(self._upsert_ingredients(documents))
+            models.RecipeSearch.refresh(*recipe_ids)
+            models.RecipeNutrition.refresh(*recipe_ids)
+            models.RecipeRating.add(*recipe_ids)
+            models.WriteVersion.bump(models.RecipeClassification, models.Recipe, models.Ingredient)
+        self.counts['documents'] += len(documents)
+
+    def _upsert_classifications(self, documents):
+        rows = {}
+        for sections in documents:
+            for kind, payloads in sections:
+                if kind == 'classification':
+                    for payload in payloads:
+                        try:
+                            if not payload.get('name'):
+                                raise CatalogError("classification without a name")
+                            row = _row(models.RecipeClassification, _columns(models.RecipeClassification, payload))
+                        except CatalogError:
+                            self.counts['errors'] += 1
+                            continue
+                        rows[row['name']] = row
+        model = models.RecipeClassification
+        for batch in chunked(rows.values(), self.batch_size):
+            query = model.insert_many(batch).on_conflict(
+                conflict_target=[model.name], preserve=[model.is_publish]).returning(model.id, model.name)
+            for row in query.execute():
+                self.classifications[row.name] = row.id
+        self.counts['classifications'] += len(rows)
+
+    def _classification_id(self, value):
+        if isinstance(value, str):
+            if value not in self.classifications:
+                row = models.RecipeClassification.get_or_none(models.RecipeClassification.name == value)
+                if row is None:
+                    raise CatalogError(f"unknown classification {value!r}")
+                self.classifications[value] = row.id
+            return self.classifications[value]
+        return value
+
+    def _upsert_recipes(self, documents):
+        defaults = {name: field.default for name, field in models.Recipe._meta.fields.items()
+                    if name not in ('id', 'classification')}
+        defaults['nutrition'] = {}
+        rows = {}
+        for sections in documents:
+            names = [p['name'] for kind, payloads in sections if kind == 'classification'
+                     for p in payloads if p.get('name')]
+            for kind, payloads in sections:
+                if kind != 'recipe':
+                    continue
+                for payload in payloads:
+                    row = dict(defaults, **_columns(models.Recipe, payload))
+                    try:
+                        row['classification'] = self._classification_id(names[0] if names else row['classification'])
+                        row = _row(models.Recipe, row)
+                    except (CatalogError, KeyError):
+                        self.counts['errors'] += 1
+                        continue
+                    rows[row['recipe_name']] = row
+        model = models.Recipe
+        preserve = [field for name, field in model._meta.fields.items() if name not in ('id', 'recipe_name')]
+        recipe_ids = set()
+        for batch in chunked(rows.values(), self.batch_size):
+            query = model.insert_many(batch).on_conflict(
+                conflict_target=[model.recipe_name], preserve=preserve).returning(model.id, model.recipe_name)
+            for row in query.execute():
+                self.recipes[row.recipe_name] = row.id
+                recipe_ids.add(row.id)
+        self.counts['recipes'] += len(rows)
+        return recipe_ids
+
+    def _recipe_id(self, value):
+        if isinstance(value, str):
+            if value not in self.recipes:
+                row = models.Recipe.get_or_none(models.Recipe.recipe_name == value)
+                if row is None:
+                    raise CatalogError(f"unknown recipe {value!r}")
+                self.recipes[value] = row.id
+            return self.recipes[value]
+        return value
+
+    def _upsert_ingredients(self, documents):
+        rows = {}
+        for sections in documents:
+            names = [p['recipe_name'] for kind, payloads in sections if kind == 'recipe'
+                     for p in payloads if p.get('recipe_name')]
+            for kind, payloads in sections:
+                if kind != 'ingredient':
+                    continue
+                for payload in payloads:
+                    row = {'unit': '', 'count': 0}
+                    row.update(_columns(models.Ingredient, payload))
+                    try:
+                        row['recipe'] = self._recipe_id(names[0] if names else row['recipe'])
+                        row = _row(models.Ingredient, row)
+                        row['ingredient_name'] = row['ingredient_name'].strip()
+                    except (CatalogError, KeyError):
+                        self.counts['errors'] += 1
+                        continue
+                    rows[(row['ingredient_name'], row['recipe'])] = row
+        model = models.Ingredient
+        for batch in chunked(rows.values(), self.batch_size):
+            model.insert_many(batch).on_conflict(
+                conflict_target=[model.ingredient_name, model.recipe], preserve=[model.unit, model.count]
+            ).as_rowcount().execute()
+        self.counts['ingredients'] += len(rows)
+        return {recipe_id for _, recipe_id in rows}
+
+
+def load(paths, batch_size=1000, on_error=None):
+    """Import every catalog document under `paths`, returns row counts and timing"""
+    loader = CatalogLoader(batch_size)
+    start = time.perf_counter()
+    for path in iter_files(paths):
+        try:
+            with open(path, encoding='utf-8') as f:
+                loader.add(parse_document(f.read()))
+        except (OSError, CatalogError) as e:
+            loader.counts['errors'] += 1
+            if on_error:
+                on_error(path, e)
+    loader.flush()
+    stats = dict(loader.counts)
+    stats['seconds'] = time.perf_counter() - start
+    rows = stats['classifications'] + stats['recipes'] + stats['ingredients']
+    stats['rows_per_second'] = rows / stats['seconds'] if stats['seconds'] else 0
+    return stats
@@ -0,0 +1,47 @@
+import hashlib
+from functools import wraps
+
+from flask import current_app, g, make_response, request
+
+from application.models import WriteVersion
+
+
+def conditional(reads=(), writes=()):
+    """ETag / conditional GET support for a token_required endpoint.
+
+    GET responses carry an ETag derived from the write versions of the
+    `reads` models and the authenticated principal, so a matching
+    If-None-Match is answered with 304 before the view runs. Successful
+    POST/PUT/DELETE requests bump the versions of the `writes` models.
+    Views may set their own Cache-Control max-age, otherwise clients have
+    to revalidate every time. The versions are left in g.read_versions
+    for views that cache on them.
+    """
+    def decorator(f):
+        @wraps(f)
+        def wrapper(user, *args, **kwargs):
+            if request.method not in ('GET', 'HEAD'):
+                response = make_response(f(user, *args, **kwargs))
+                if writes and response.status_code < 400:
+                    WriteVersion.bump(*writes)
+                return response
+
+            versions = g.read_versions = WriteVersion.current(*reads)
+            etag = hashlib.sha1(repr((str(user.public_id), versions)).encode()).hexdigest()
+            if request.if_none_match.contains_weak(etag):
+                # no Cache-Control, clients keep the policy stored with the 200
+                response = current_app.response_class(status=304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(user, *args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+                if not response.cache_control.max_age:
+                    response.cache_control.private = True
+                    response.cache_control.no_cache = True
+            return response
+
+        return wrapper
+
+    return decorator
@@ -6,12 +6,77 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 class Config(object):
     """Base configuration"""
 
-    user = os.environ["POSTGRES_USER"]
-    password = os.environ["POSTGRES_PASSWORD"]
-    hostname = os.environ["POSTGRES_HOSTNAME"]
-    port = os.environ["POSTGRES_PORT"]
-    database = os.environ["APPLICATION_DB"]
-    secret_key= os.environ["SECRET_KEY"]
+    user = os.environ.get("POSTGRES_USER")
+    password = os.environ.get("POSTGRES_PASSWORD")
+    hostname = os.environ.get("POSTGRES_HOSTNAME")
+    port = os.environ.get("POSTGRES_PORT")
+    database = os.environ.get("APPLICATION_DB")
+    secret_key= os.environ.get("SECRET_KEY")
+
+    # database the models are bound to by models.init_db(), no connection is opened before the first query
+    POSTGRES_DB = os.environ.get("POSTGRES_DB")
+    POSTGRES_USER = os.environ.get("POSTGRES_USER")
+    POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
+    POSTGRES_HOSTNAME = os.environ.get("POSTGRES_HOSTNAME")
+
+    # database connection pool, a request waits up to DB_POOL_TIMEOUT seconds for a free connection
+    DB_POOL_MAX_CONNECTIONS = int(os.environ.get("DB_POOL_MAX_CONNECTIONS", 20))
+    DB_POOL_STALE_TIMEOUT = int(os.environ.get("DB_POOL_STALE_TIMEOUT", 300))
+    DB_POOL_TIMEOUT = int(os.environ.get("DB_POOL_TIMEOUT", 10))
+
+    # per process admission control: past MAX_IN_FLIGHT concurrent requests (0 = unlimited) up to
+    # ADMISSION_QUEUE more wait ADMISSION_TIMEOUT seconds for a slot, the rest get a 503 with Retry-After
+    MAX_IN_FLIGHT = int(os.environ.get("MAX_IN_FLIGHT", DB_POOL_MAX_CONNECTIONS))
+    ADMISSION_QUEUE = int(os.environ.get("ADMISSION_QUEUE", 32))
+    ADMISSION_TIMEOUT = float(os.environ.get("ADMISSION_TIMEOUT", 0.5))
+    ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 1))
+
+    # token bucket per authenticated user, RATE_LIMIT_PER_SECOND = 0 disables it, over the limit gets a 429
+    RATE_LIMIT_PER_SECOND = float(os.environ.get("RATE_LIMIT_PER_SECOND", 0))
+    RATE_LIMIT_BURST = int(os.environ.get("RATE_LIMIT_BURST", 20))
+
+    # list endpoints page size, clients may pick up to MAX_PER_PAGE rows
+    PER_PAGE = 10
+    MAX_PER_PAGE = int(os.environ.get("MAX_PER_PAGE", 100))
+
+    # largest accepted bulk write payload
+    MAX_BULK_ROWS = int(os.environ.get("MAX_BULK_ROWS", 1000))
+
+    # rows fetched per round trip by the streaming exports
+    EXPORT_FETCH_SIZE = int(os.environ.get("EXPORT_FETCH_SIZE", 2000))
+
+    # authenticated principal cache used by token_required
+    PRINCIPAL_CACHE_SIZE = int(os.environ.get("PRINCIPAL_CACHE_SIZE", 1024))
+    PRINCIPAL_CACHE_TTL = int(os.environ.get("PRINCIPAL_CACHE_TTL", 60))
+
+    # weekly menu shopping lists, also keyed by the write versions they were computed at
+    SHOPPING_LIST_CACHE_SIZE = int(os.environ.get("SHOPPING_LIST_CACHE_SIZE", 256))
+    SHOPPING_LIST_CACHE_TTL = int(os.environ.get("SHOPPING_LIST_CACHE_TTL", 3600))
+
+    # classification list pages, also keyed by the write versions they were computed at
+    CLASSIFICATION_CACHE_SIZE = int(os.environ.get("CLASSIFICATION_CACHE_SIZE", 256))
+    CLASSIFICATION_CACHE_TTL = int(os.environ.get("CLASSIFICATION_CACHE_TTL", 3600))
+
+    # text search configuration of the recipe search documents
+    SEARCH_LANGUAGE = os.environ.get("SEARCH_LANGUAGE", "english")
+
+    # most ingredient names a recipes/by-ingredients query may ask for
+    MAX_COVERAGE_NAMES = int(os.environ.get("MAX_COVERAGE_NAMES", 100))
+
+    # dedicated database `manage.py bench` seeds and measures, the benchmarks refuse to run without one
+    BENCH_DATABASE = os.environ.get("BENCH_DATABASE")
+
+    # pre-fork server, SERVER_WORKERS = 0 starts one worker per available CPU
+    SERVER_BIND = os.environ.get("SERVER_BIND", "0.0.0.0:8000")
+    SERVER_WORKERS = int(os.environ.get("SERVER_WORKERS", 0))
+    SERVER_THREADS = int(os.environ.get("SERVER_THREADS", 4))
+    SERVER_TIMEOUT = int(os.environ.get("SERVER_TIMEOUT", 30))
+    SERVER_GRACEFUL_TIMEOUT = int(os.environ.get("SERVER_GRACEFUL_TIMEOUT", 30))
+    SERVER_KEEPALIVE = int(os.environ.get("SERVER_KEEPALIVE", 5))
+    SERVER_MAX_REQUESTS = int(os.environ.get("SERVER_MAX_REQUESTS", 0))
+
+    # fail requests that run more statements than their view's query_budget instead of logging them
+    QUERY_BUDGET_STRICT = os.environ.get("QUERY_BUDGET_STRICT", "") not in ("", "0", "false")
 
 
 class ProductionConfig(Config):
@@ -26,3 +91,11 @@ class TestingConfig(Config):
     """Testing configuration"""
 
     TESTING = True
+
+
+def settings(config_name):
+    """The UPPERCASE settings of the `config_name` configuration (production,
+    development or testing), the mapping create_app() loads into app.config
+    """
+    config = globals()[f"{config_name.capitalize()}Config"]
+    return {key: getattr(config, key) for key in dir(config) if key.isupper()}
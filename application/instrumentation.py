@@ -0,0 +1,24 @@
+from flask import current_app, request
+
+
+class QueryBudgetExceeded(RuntimeError):
+    """Raised in strict mode when a view runs more statements than its query_budget"""
+
+
+def query_budget(queries):
+    """Declare the most SQL statements a view may run per request.
+
+    Requests over budget are logged, or fail with QueryBudgetExceeded when
+    QUERY_BUDGET_STRICT is set (as the tests do). The budget survives the
+    other decorators as long as they use functools.wraps.
+    """
+    def decorator(f):
+        f.query_budget = queries
+        return f
+    return decorator
+
+
+def endpoint_budget():
+    """query_budget of the view serving the current request, None when undeclared"""
+    view = current_app.view_functions.get(request.endpoint)
+    return getattr(view, 'query_budget', None)
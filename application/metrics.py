@@ -0,0 +1,220 @@
+"""Prometheus text format metrics of the running process.
+
+Every thread updates its own shard of each metric, so recording a sample
+never takes a lock; the shards are only merged when /metrics is scraped.
+Shards of finished threads are folded into a base total when the next
+thread starts recording or at scrape time, so counters stay monotonic
+while a server starting a thread per request keeps a bounded number of
+shards.
+"""
+import threading
+import time
+
+from flask import g, has_request_context
+from flask.json.provider import DefaultJSONProvider
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._local = threading.local()
+        self._shards = {}  # thread -> shard
+        self._base = {}  # merged shards of finished threads
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._fold()
+                self._shards[threading.current_thread()] = shard
+            return shard
+
+    def _fold(self):
+        """Merge the shards of finished threads into the base, with the lock held"""
+        for thread in [thread for thread in self._shards if not thread.is_alive()]:
+            for key, value in self._shards.pop(thread).items():
+                self._merge(self._base, key, value)
+
+    def _merged(self):
+        merged = {}
+        with self._lock:
+            self._fold()
+            shards = list(self._shards.values())
+            for key, value in self._base.items():
+                self._merge(merged, key, value)
+        for shard in shards:
+            for key, value in shard.copy().items():
+                self._merge(merged, key, value)
+        return merged
+
+    def _merge(self, merged, key, value):
+        merged[key] = merged.get(key, 0) + value
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} {self.kind}'
+        for key, value in sorted(self._merged().items()):
+            yield f'{self.name}{_format_labels(self.labels, key)} {_format_value(value)}'
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *labels, amount=1):
+        shard = self._shard()
+        shard[labels] = shard.get(labels, 0) + amount
+
+
+class Gauge(Counter):
+    """Up/down counter, each thread has to undo its own increments"""
+    kind = 'gauge'
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shard()
+        series = shard.get(labels)
+        if series is None:
+            # per bucket counts (not cumulative), then count and sum
+            series = shard[labels] = [0] * len(self.buckets) + [0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+                break
+        series[-2] += 1
+        series[-1] += value
+
+    def _merge(self, merged, key, value):
+        total = merged.setdefault(key, [0] * len(value))
+        for i, item in enumerate(list(value)):
+            total[i] += item
+
+    def collect(self):
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for key, series in sorted(self._merged().items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                yield f'{self.name}_bucket{_format_labels(self.labels, key, [("le", bound)])} {cumulative}'
+            yield f'{self.name}_bucket{_format_labels(self.labels, key, [("le", "+Inf")])} {series[-2]}'
+            yield f'{self.name}_count{_format_labels(self.labels, key)} {series[-2]}'
+            yield f'{self.name}_sum{_format_labels(self.labels, key)} {_format_value(float(series[-1]))}'
+
+
+class CallbackGauge(object):
+    """Gauges read from `function`, a dict of name suffix -> value, at scrape time"""
+
+    def __init__(self, prefix, documentation, function):
+        self.prefix = prefix
+        self.documentation = documentation
+        self.function = function
+
+    def collect(self):
+        for suffix, value in self.function().items():
+            name = f'{self.prefix}_{suffix}'
+            yield f'# HELP {name} {self.documentation} {suffix.replace("_", " ")}'
+            yield f'# TYPE {name} gauge'
+            yield f'{name} {_format_value(value)}'
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def exposition(self):
+        lines = [line for metric in self.metrics for line in metric.collect()]
+        return '\n'.join(lines) + '\n'
+
+
+class TimedJSONProvider(DefaultJSONProvider):
+    """JSON provider that adds the time spent encoding responses to g.serialization_time"""
+
+    def dumps(self, obj, **kwargs):
+        return self.timed(super().dumps, obj, **kwargs)
+
+    @staticmethod
+    def timed(function, *args, **kwargs):
+        """Call the encoding `function`, counting its time when serving a request"""
+        if not has_request_context():
+            return function(*args, **kwargs)
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            g.serialization_time = g.get('serialization_time', 0.0) + time.perf_counter() - start
+
+
+class RequestMetrics(object):
+    """Request instrumentation of an app, exposed by `registry`"""
+
+    def __init__(self, registry, db=None):
+        self.registry = registry
+        self.requests = registry.register(Counter(
+            'http_requests_total', 'Requests served.', ('method', 'route', 'status')))
+        self.latency = registry.register(Histogram(
+            'http_request_duration_seconds', 'Request latency up to the response being returned.',
+            ('method', 'route')))
+        self.in_flight = registry.register(Gauge('http_requests_in_flight', 'Requests being served.'))
+        self.db_time = registry.register(Histogram(
+            'http_request_db_seconds', 'Time spent executing SQL per request.', ('method', 'route')))
+        self.db_queries = registry.register(Histogram(
+            'http_request_db_queries', 'SQL statements executed per request.', ('method', 'route'),
+            buckets=QUERY_BUCKETS))
+        self.serialization = registry.register(Histogram(
+            'http_response_serialization_seconds', 'Time spent encoding JSON responses per request.',
+            ('method', 'route')))
+        if db is not None:
+            registry.register(CallbackGauge('db_pool', 'Database connection pool', lambda: db.stats))
+
+    def started(self):
+        self.in_flight.inc()
+        g.metrics_in_flight = True
+
+    def finished(self, request, response, elapsed, query_stats):
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.requests.inc(request.method, route, str(response.status_code))
+        self.latency.observe(elapsed, request.method, route)
+        self.db_time.observe(query_stats['time'], request.method, route)
+        self.db_queries.observe(query_stats['queries'], request.method, route)
+        self.serialization.observe(g.get('serialization_time', 0.0), request.method, route)
+
+    def torn_down(self):
+        if g.pop('metrics_in_flight', False):
+            self.in_flight.dec()
@@ -0,0 +1,243 @@
+"""Versioned schema migrations, applied by `manage.py migrate`.
+
+A migration is a function of the database registered with @migration, its
+version is its position in MIGRATIONS: add new ones at the end and never
+reorder or edit applied ones. Schema changes are spelled out as SQL
+instead of being derived from the model classes, so a later model change
+cannot rewrite what an applied migration did. Every migration runs in its
+own transaction holding an advisory lock, and its version is recorded in
+the schemaversion table in the same transaction, so concurrent or repeated
+runs apply each migration once. Nothing here runs when the application
+starts.
+"""
+from datetime import datetime
+
+from peewee import *
+
+from application import models
+
+# pg_advisory_xact_lock key serializing concurrent migrate runs
+LOCK_KEY = 0x6d6967
+
+MIGRATIONS = []
+
+# the tables and indexes of the models as they were before versioned migrations,
+# without the unique (week, recipe) index that unique_weekly_recipe_map adds
+INITIAL_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS "customer" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"public_id" UUID NOT NULL, '
+        '"name" VARCHAR(255) NOT NULL, '
+        '"password" VARCHAR(255) NOT NULL, '
+        '"admin" BOOLEAN NOT NULL, '
+        '"is_active" BOOLEAN NOT NULL)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "customer_name" ON "customer" ("name")',
+    'CREATE TABLE IF NOT EXISTS "recipeclassification" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"name" VARCHAR(35) NOT NULL, '
+        '"is_publish" BOOLEAN NOT NULL)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "recipeclassification_name" ON "recipeclassification" ("name")',
+    'CREATE TABLE IF NOT EXISTS "recipe" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"recipe_name" VARCHAR(255) NOT NULL, '
+        '"description" TEXT NOT NULL, '
+        '"num_of_servings" SMALLINT NOT NULL, '
+        '"cook_time" SMALLINT NOT NULL, '
+        '"directions" TEXT NOT NULL, '
+        '"is_publish" BOOLEAN NOT NULL, '
+        '"nutrition" HSTORE NOT NULL, '
+        '"classification_id" INTEGER NOT NULL, '
+        'FOREIGN KEY ("classification_id") REFERENCES "recipeclassification" ("id"))',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "recipe_recipe_name" ON "recipe" ("recipe_name")',
+    'CREATE INDEX IF NOT EXISTS "recipe_nutrition" ON "recipe" ("nutrition")',
+    'CREATE INDEX IF NOT EXISTS "recipe_classification_id" ON "recipe" ("classification_id")',
+    'CREATE TABLE IF NOT EXISTS "ingredient" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"ingredient_name" VARCHAR(255) NOT NULL, '
+        '"unit" VARCHAR(255) NOT NULL, '
+        '"count" INTEGER NOT NULL, '
+        '"recipe_id" INTEGER NOT NULL, '
+        'FOREIGN KEY ("recipe_id") REFERENCES "recipe" ("id"))',
+    'CREATE INDEX IF NOT EXISTS "ingredient_recipe_id" ON "ingredient" ("recipe_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "ingredient_ingredient_name_recipe_id" '
+        'ON "ingredient" ("ingredient_name", "recipe_id")',
+    'CREATE INDEX IF NOT EXISTS "ingredient_name_key" ON "ingredient" '
+        '(lower(btrim(regexp_replace("ingredient_name", \'[[:space:]]+\', \' \', \'g\'))), "recipe_id")',
+    'CREATE TABLE IF NOT EXISTS "recipenutrition" ('
+        '"recipe_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"energy_kj" DOUBLE PRECISION, '
+        '"protein_g" DOUBLE PRECISION, '
+        '"fat_g" DOUBLE PRECISION, '
+        '"saturates_g" DOUBLE PRECISION, '
+        '"carbohydrate_g" DOUBLE PRECISION, '
+        '"sugars_g" DOUBLE PRECISION, '
+        '"fibre_g" DOUBLE PRECISION, '
+        '"sodium_mg" DOUBLE PRECISION, '
+        'FOREIGN KEY ("recipe_id") REFERENCES "recipe" ("id") ON DELETE CASCADE)',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_energy_kj" ON "recipenutrition" ("energy_kj")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_protein_g" ON "recipenutrition" ("protein_g")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_fat_g" ON "recipenutrition" ("fat_g")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_saturates_g" ON "recipenutrition" ("saturates_g")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_carbohydrate_g" ON "recipenutrition" ("carbohydrate_g")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_sugars_g" ON "recipenutrition" ("sugars_g")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_fibre_g" ON "recipenutrition" ("fibre_g")',
+    'CREATE INDEX IF NOT EXISTS "recipenutrition_sodium_mg" ON "recipenutrition" ("sodium_mg")',
+    'CREATE TABLE IF NOT EXISTS "reciperating" ('
+        '"recipe_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"score_sum" INTEGER NOT NULL, '
+        '"score_count" INTEGER NOT NULL, '
+        '"rating" DOUBLE PRECISION NOT NULL, '
+        '"score_1" INTEGER NOT NULL, '
+        '"score_2" INTEGER NOT NULL, '
+        '"score_3" INTEGER NOT NULL, '
+        '"score_4" INTEGER NOT NULL, '
+        '"score_5" INTEGER NOT NULL, '
+        'FOREIGN KEY ("recipe_id") REFERENCES "recipe" ("id") ON DELETE CASCADE)',
+    'CREATE INDEX IF NOT EXISTS "reciperating_rating" ON "reciperating" ("rating" DESC, "recipe_id")',
+    'CREATE INDEX IF NOT EXISTS "reciperating_score_count" ON "reciperating" ("score_count" DESC, "recipe_id")',
+    'CREATE TABLE IF NOT EXISTS "recipereview" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"review" TEXT NOT NULL, '
+        '"recipe_id" INTEGER NOT NULL, '
+        '"customer_id" INTEGER NOT NULL, '
+        '"is_publish" BOOLEAN NOT NULL, '
+        '"score" INTEGER NOT NULL, '
+        '"summary" VARCHAR(255) NOT NULL, '
+        '"pub_date" TIMESTAMP NOT NULL, '
+        'FOREIGN KEY ("recipe_id") REFERENCES "recipe" ("id"), '
+        'FOREIGN KEY ("customer_id") REFERENCES "customer" ("id"))',
+    'CREATE INDEX IF NOT EXISTS "recipereview_recipe_id" ON "recipereview" ("recipe_id")',
+    'CREATE INDEX IF NOT EXISTS "recipereview_customer_id" ON "recipereview" ("customer_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "recipereview_recipe_id_customer_id" '
+        'ON "recipereview" ("recipe_id", "customer_id")',
+    'CREATE INDEX IF NOT EXISTS "recipereview_recipe_id_is_publish_pub_date" '
+        'ON "recipereview" ("recipe_id", "is_publish", "pub_date")',
+    'CREATE INDEX IF NOT EXISTS "recipereview_customer_id_is_publish_pub_date" '
+        'ON "recipereview" ("customer_id", "is_publish", "pub_date")',
+    'CREATE TABLE IF NOT EXISTS "recipesearch" ('
+        '"recipe_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"is_publish" BOOLEAN NOT NULL, '
+        '"document" TSVECTOR NOT NULL, '
+        'FOREIGN KEY ("recipe_id") REFERENCES "recipe" ("id") ON DELETE CASCADE)',
+    'CREATE INDEX IF NOT EXISTS "recipesearch_document" ON "recipesearch" USING GIN ("document")',
+    'CREATE TABLE IF NOT EXISTS "users" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"public_id" UUID NOT NULL, '
+        '"name" VARCHAR(255) NOT NULL, '
+        '"password" VARCHAR(255) NOT NULL, '
+        '"admin" BOOLEAN NOT NULL)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "users_name" ON "users" ("name")',
+    'CREATE TABLE IF NOT EXISTS "weeklymenu" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"week_number" SMALLINT NOT NULL, '
+        '"is_publish" BOOLEAN NOT NULL)',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "weeklymenu_week_number" ON "weeklymenu" ("week_number")',
+    'CREATE TABLE IF NOT EXISTS "weeklymenureview" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"review" TEXT NOT NULL, '
+        '"menu_id" INTEGER NOT NULL, '
+        '"customer_id" INTEGER NOT NULL, '
+        '"is_publish" BOOLEAN NOT NULL, '
+        '"score" INTEGER NOT NULL, '
+        '"summary" VARCHAR(255) NOT NULL, '
+        '"pub_date" TIMESTAMP NOT NULL, '
+        'FOREIGN KEY ("menu_id") REFERENCES "weeklymenu" ("id"), '
+        'FOREIGN KEY ("customer_id") REFERENCES "customer" ("id"))',
+    'CREATE INDEX IF NOT EXISTS "weeklymenureview_menu_id" ON "weeklymenureview" ("menu_id")',
+    'CREATE INDEX IF NOT EXISTS "weeklymenureview_customer_id" ON "weeklymenureview" ("customer_id")',
+    'CREATE UNIQUE INDEX IF NOT EXISTS "weeklymenureview_menu_id_customer_id" '
+        'ON "weeklymenureview" ("menu_id", "customer_id")',
+    'CREATE INDEX IF NOT EXISTS "weeklymenureview_menu_id_is_publish_pub_date" '
+        'ON "weeklymenureview" ("menu_id", "is_publish", "pub_date")',
+    'CREATE INDEX IF NOT EXISTS "weeklymenureview_customer_id_is_publish_pub_date" '
+        'ON "weeklymenureview" ("customer_id", "is_publish", "pub_date")',
+    'CREATE TABLE IF NOT EXISTS "weeklymenuscore" ('
+        '"menu_id" INTEGER NOT NULL PRIMARY KEY, '
+        '"score_sum" INTEGER NOT NULL, '
+        '"score_count" INTEGER NOT NULL, '
+        '"score_1" INTEGER NOT NULL, '
+        '"score_2" INTEGER NOT NULL, '
+        '"score_3" INTEGER NOT NULL, '
+        '"score_4" INTEGER NOT NULL, '
+        '"score_5" INTEGER NOT NULL, '
+        'FOREIGN KEY ("menu_id") REFERENCES "weeklymenu" ("id"))',
+    'CREATE TABLE IF NOT EXISTS "weeklyrecipemap" ('
+        '"id" SERIAL NOT NULL PRIMARY KEY, '
+        '"week_id" INTEGER NOT NULL, '
+        '"recipe_id" INTEGER NOT NULL, '
+        'FOREIGN KEY ("week_id") REFERENCES "weeklymenu" ("id"), '
+        'FOREIGN KEY ("recipe_id") REFERENCES "recipe" ("id"))',
+    'CREATE INDEX IF NOT EXISTS "weeklyrecipemap_week_id" ON "weeklyrecipemap" ("week_id")',
+    'CREATE INDEX IF NOT EXISTS "weeklyrecipemap_recipe_id" ON "weeklyrecipemap" ("recipe_id")',
+    'CREATE TABLE IF NOT EXISTS "writeversion" ('
+        '"name" VARCHAR(255) NOT NULL PRIMARY KEY, '
+        '"version" BIGINT NOT NULL)',
+)
+
+
+class SchemaVersion(models.BaseModel):
+    version = IntegerField(primary_key=True)
+    name = CharField()
+    applied_at = DateTimeField(default=datetime.now)
+
+
+def migration(function):
+    MIGRATIONS.append(function)
+    return function
+
+
+def versions():
+    """(version, migration) pairs in the order they apply"""
+    return list(enumerate(MIGRATIONS, 1))
+
+
+@migration
+def initial_schema(db):
+    """Tables and indexes of every model as they were before versioned
+    migrations, databases created by then already have them
+    """
+    for statement in INITIAL_SCHEMA:
+        db.execute_sql(statement)
+
+
+@migration
+def derived_tables(db):
+    """Fill the rollups and projections derived from the catalog and reviews"""
+    models.WeeklyMenuScore.rebuild()
+    models.RecipeRating.rebuild()
+    models.RecipeSearch.rebuild()
+    models.RecipeNutrition.rebuild()
+
+
+@migration
+def unique_weekly_recipe_map(db):
+    """One WeeklyRecipeMap row per (week, recipe), duplicates left by the
+    racy check-then-insert of addRecipe are dropped first
+    """
+    Map = models.WeeklyRecipeMap
+    first = Map.select(fn.MIN(Map.id)).group_by(Map.week, Map.recipe)
+    Map.delete().where(Map.id.not_in(first)).execute()
+    db.execute_sql('CREATE UNIQUE INDEX IF NOT EXISTS "weeklyrecipemap_week_id_recipe_id" '
+                   'ON "weeklyrecipemap" ("week_id", "recipe_id")')
+
+
+def applied(db=models.db):
+    """Versions already applied to `db`"""
+    if not db.table_exists(SchemaVersion._meta.table_name):
+        return set()
+    return {version for version, in SchemaVersion.select(SchemaVersion.version).tuples()}
+
+
+def migrate(db=models.db):
+    """Apply the pending migrations in order, returns their names"""
+    db.create_tables([SchemaVersion], safe=True)
+    names = []
+    for version, function in versions():
+        with db.atomic():
+            db.execute_sql('SELECT pg_advisory_xact_lock(%s)', (LOCK_KEY,))
+            if SchemaVersion.select().where(SchemaVersion.version == version).exists():
+                continue
+            function(db)
+            SchemaVersion.create(version=version, name=function.__name__)
+        names.append(function.__name__)
+    return names
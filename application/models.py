@@ -1,28 +1,113 @@
 from enum import unique
-import statistics
+import threading
+import time
+import weakref
 from datetime import datetime
 from peewee import *
+from peewee import Expression
 from playhouse.hybrid import hybrid_property
-from playhouse.postgres_ext import PostgresqlExtDatabase, HStoreField
+from playhouse.postgres_ext import HStoreField, TSVectorField
+try:
+    from playhouse.postgres_ext import PooledPostgresqlExtDatabase
+except ImportError:  # peewee < 4
+    from playhouse.pool import PooledPostgresqlExtDatabase
 from playhouse.shortcuts import model_to_dict
 # from flask import current_app, g
 
-import os
 
-pg_database=os.environ['POSTGRES_DB']
-pg_user=os.environ['POSTGRES_USER']
-pg_password=os.environ['POSTGRES_PASSWORD']
-pg_host=os.environ['POSTGRES_HOSTNAME']
+class MeteredPooledDatabase(PooledPostgresqlExtDatabase):
+    """Connection pool that records how often and how long callers wait for a
+    free connection, and counts and times the statements of each thread
+    between two reset_query_stats() calls (one per request).
+    """
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waits = 0
+        self.wait_time = 0.0
+        self._query_stats = threading.local()
 
-db = PostgresqlExtDatabase(pg_database, register_hstore=True,
-                           user=pg_user,
-                           password=pg_password,
-                           host=pg_host,
-                           )
+    def execute_sql(self, sql, params=None, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return super().execute_sql(sql, params, *args, **kwargs)
+        finally:
+            stats = self._query_stats
+            stats.queries = getattr(stats, 'queries', 0) + 1
+            stats.time = getattr(stats, 'time', 0.0) + time.perf_counter() - start
 
-def migrate(db):
-    pass
+    def reset_query_stats(self):
+        self._query_stats.queries = 0
+        self._query_stats.time = 0.0
+
+    @property
+    def query_stats(self):
+        """Statements executed by the current thread since reset_query_stats() and their total seconds"""
+        return {'queries': getattr(self._query_stats, 'queries', 0),
+                'time': getattr(self._query_stats, 'time', 0.0)}
+
+    def connect(self, reuse_if_open=False):
+        exhausted = (self.is_closed() and self._max_connections and not self._connections
+                     and len(self._in_use) >= self._max_connections)
+        if not exhausted:
+            return super().connect(reuse_if_open)
+        start = time.perf_counter()
+        try:
+            return super().connect(reuse_if_open)
+        finally:
+            with self._pool_lock:
+                self.waits += 1
+                self.wait_time += time.perf_counter() - start
+
+    @property
+    def stats(self):
+        with self._pool_lock:
+            return {
+                'max_connections': self._max_connections,
+                'in_use': len(self._in_use),
+                'idle': len(self._connections),
+                'waits': self.waits,
+                'wait_time': round(self.wait_time, 6),
+            }
+
+
+# bound to the configured database by init_db(), importing the models opens nothing
+db = DatabaseProxy()
+
+
+def init_db(config):
+    """Bind `db` to the database of `config`, a Flask config or any mapping
+    holding the POSTGRES_*, DB_POOL_* and SEARCH_LANGUAGE settings. No
+    connection is opened until the first query; binding the same settings
+    again is a no-op.
+    """
+    settings = {
+        'database': config['POSTGRES_DB'],
+        'user': config['POSTGRES_USER'],
+        'password': config['POSTGRES_PASSWORD'],
+        'host': config['POSTGRES_HOSTNAME'],
+        'max_connections': config['DB_POOL_MAX_CONNECTIONS'],
+        'stale_timeout': config['DB_POOL_STALE_TIMEOUT'],
+        'timeout': config['DB_POOL_TIMEOUT'],
+    }
+    RecipeSearch.language = config.get('SEARCH_LANGUAGE', RecipeSearch.language)
+    if db.obj is not None:
+        if db.obj.settings == settings:
+            return db.obj
+        db.obj.close_all()
+    database = MeteredPooledDatabase(register_hstore=True, **settings)
+    database.settings = settings
+    db.initialize(database)
+    return database
+
+
+class ValidationError(Exception):
+    """Rejected write payload, `errors` describes each offending row"""
+
+    def __init__(self, errors, status=422):
+        super().__init__(errors)
+        self.errors = errors
+        self.status = status
 
 
 class BaseModel(Model):
@@ -32,6 +117,25 @@ class BaseModel(Model):
         database = db
 
 
+class WriteVersion(BaseModel):
+    """Per table write counter, bumped on every write and used to derive ETags"""
+    name = CharField(primary_key=True)
+    version = BigIntegerField(default=0)
+
+    @classmethod
+    def bump(cls, *models):
+        rows = [{'name': model._meta.table_name, 'version': 1} for model in models]
+        cls.insert_many(rows).on_conflict(
+            conflict_target=[cls.name], update={cls.version: cls.version + 1}).as_rowcount().execute()
+
+    @classmethod
+    def current(cls, *models):
+        """Versions of the tables of `models`, in the same order"""
+        names = [model._meta.table_name for model in models]
+        versions = dict(cls.select(cls.name, cls.version).where(cls.name.in_(names)).tuples())
+        return tuple(versions.get(name, 0) for name in names)
+
+
 class RecipeClassification(BaseModel):
     """RecipeClassification Model"""
     name = CharField(max_length=35,unique=True)
@@ -86,8 +190,20 @@ class Recipe(BaseModel):
     def serialize(self):
         data = {'ingredients': self.ingredients, 'has_links':self.has_links}
         data.update(model_to_dict(self))
+        rating = RecipeRating.get_or_none(RecipeRating.recipe == self.id) or RecipeRating()
+        data.update(rating.serialize)
         return data
 
+    def save(self, *args, **kwargs):
+        created = self.id is None or kwargs.get('force_insert')
+        with db.atomic():
+            rows = super().save(*args, **kwargs)
+            RecipeSearch.refresh(self.id)
+            RecipeNutrition.refresh(self.id)
+            if created:
+                RecipeRating.add(self.id)
+        return rows
+
     def __str__(self):
         return "{} : {} ".format(
             self.id,
@@ -107,9 +223,72 @@ class Ingredient(BaseModel):
             (("ingredient_name", "recipe"), True),
         )
 
+    def save(self, *args, **kwargs):
+        with db.atomic():
+            previous = None
+            if self.id is not None and 'recipe' in self._dirty:
+                previous = Ingredient.select(Ingredient.recipe).where(Ingredient.id == self.id).scalar()
+            rows = super().save(*args, **kwargs)
+            RecipeSearch.refresh(self.recipe_id, previous)
+        return rows
+
+    def delete_instance(self, *args, **kwargs):
+        with db.atomic():
+            rows = super().delete_instance(*args, **kwargs)
+            RecipeSearch.refresh(self.recipe_id)
+        return rows
+
     @classmethod
     def getIngredientByRecipe(cls, recipe_id):
-        Ingredient.select().where(Ingredient.recipe.id == recipe_id)
+        return Ingredient.select().where(Ingredient.recipe == recipe_id)
+
+    @staticmethod
+    def normalize_name(name):
+        """Case and whitespace folded ingredient name, the Python side of name_key()"""
+        return ' '.join(str(name).split()).lower()
+
+    @classmethod
+    def name_key(cls):
+        """SQL of the folded ingredient_name, served by the ingredient_name_key index"""
+        return fn.lower(fn.btrim(fn.regexp_replace(cls.ingredient_name, '[[:space:]]+', ' ', 'g')))
+
+    @classmethod
+    def coverage(cls, required=(), optional=(), menu=None):
+        """Published recipes using the `required` and `optional` ingredient names.
+
+        With `menu`, the names of the menu's ingredients are optional
+        matches too and the menu's own recipes are left out. A recipe must
+        use every required name. Returns the query of (recipe_id, matched,
+        missing, rank) rows, its rank expression (matched names first, then
+        the fewest other ingredients) and the recipe id column.
+        """
+        required = {cls.normalize_name(name) for name in required} - {''}
+        names = required | {cls.normalize_name(name) for name in optional} - {''}
+        key = cls.name_key()
+        wanted = key.in_(list(names)) if names else SQL('false')
+        menu_recipes = WeeklyRecipeMap.select(WeeklyRecipeMap.recipe).where(WeeklyRecipeMap.week == menu)
+        if menu is not None:
+            menu_names = cls.select(key).where(cls.recipe.in_(menu_recipes))
+            wanted = wanted | key.in_(menu_names)
+
+        # only the ingredient rows found through the index are folded and grouped
+        hits = cls.select(cls.recipe, fn.COUNT(key.distinct()).alias('matched')).where(wanted).group_by(cls.recipe)
+        if menu is not None:
+            hits = hits.where(cls.recipe.not_in(menu_recipes))
+        if required:
+            hits = hits.having(fn.COUNT(key.distinct()).filter(key.in_(list(required))) == len(required))
+        hits = hits.alias('hits')
+        other = cls.alias('other')
+        total = other.select(fn.COUNT(other.id)).where(other.recipe == hits.c.recipe_id)
+        query = (Select([hits], [hits.c.recipe_id, hits.c.matched, total.alias('total')])
+                 .join(Recipe, on=(Recipe.id == hits.c.recipe_id))
+                 .where(Recipe.is_publish))
+
+        ranked = query.alias('coverage')
+        missing = ranked.c.total - ranked.c.matched
+        rank = (ranked.c.matched + 1.0 / (missing + 1)).cast('float8')
+        rows = Select([ranked], [ranked.c.recipe_id, ranked.c.matched, missing.alias('missing'), rank.alias('rank')])
+        return rows.bind(db), rank, ranked.c.recipe_id
 
     @property
     def serialize(self):
@@ -122,6 +301,230 @@ class Ingredient(BaseModel):
         }
         return data
 
+    @classmethod
+    def serialize_many(cls, ingredients):
+        """Serialize ingredients, loading their recipes in a single query"""
+        ingredients = list(ingredients)
+        recipe_ids = list({i.recipe_id for i in ingredients})
+        recipes = {r.id: r for r in Recipe.select(Recipe.id, Recipe.recipe_name).where(Recipe.id.in_(recipe_ids))}
+        for ingredient in ingredients:
+            if ingredient.recipe_id in recipes:
+                ingredient.recipe = recipes[ingredient.recipe_id]
+        return [i.serialize for i in ingredients]
+
+    @classmethod
+    def create_many(cls, items, batch_size=500):
+        """Validate and insert ingredient rows in one transaction.
+
+        Raises ValidationError (422) for malformed rows or unknown recipes
+        and (409) for rows clashing with the (ingredient_name, recipe)
+        unique index. Returns the created ingredients.
+        """
+        fields = {'ingredient_name', 'unit', 'count', 'recipe'}
+        rows, errors = [], []
+        for index, item in enumerate(items):
+            if not isinstance(item, dict):
+                errors.append({'index': index, 'error': 'ingredient must be an object'})
+                continue
+            unknown = set(item) - fields
+            if unknown:
+                errors.append({'index': index, 'error': f"unknown attributes {sorted(unknown)}"})
+                continue
+            name = str(item.get('ingredient_name') or '').strip()
+            if not name:
+                errors.append({'index': index, 'error': 'ingredient_name is required'})
+                continue
+            try:
+                rows.append({'ingredient_name': name, 'unit': str(item.get('unit') or '').strip(),
+                             'count': int(item.get('count') or 0), 'recipe': int(item['recipe'])})
+            except (KeyError, TypeError, ValueError) as e:
+                errors.append({'index': index, 'error': f"invalid count or recipe: {e}"})
+        if errors:
+            raise ValidationError(errors)
+
+        recipe_ids = {row['recipe'] for row in rows}
+        known = {r.id for r in Recipe.select(Recipe.id).where(Recipe.id.in_(list(recipe_ids)))}
+        errors = [{'index': index, 'error': f"recipe {row['recipe']} does not exist"}
+                  for index, row in enumerate(rows) if row['recipe'] not in known]
+        if errors:
+            raise ValidationError(errors)
+
+        seen = {}
+        for index, row in enumerate(rows):
+            key = (row['ingredient_name'], row['recipe'])
+            if key in seen:
+                errors.append({'index': index, 'error': f"duplicate of row {seen[key]}"})
+            seen[key] = index
+        existing = cls.select(cls.ingredient_name, cls.recipe).where(
+            Tuple(cls.ingredient_name, cls.recipe).in_(list(seen))).tuples()
+        errors.extend({'index': seen[key], 'error': f"{key[0]} already exists for recipe {key[1]}"}
+                      for key in existing)
+        if errors:
+            raise ValidationError(errors, 409)
+
+        created = []
+        with db.atomic():
+            for batch in chunked(rows, batch_size):
+                created.extend(cls.insert_many(batch).returning(cls).execute())
+            RecipeSearch.refresh(*recipe_ids)
+        return created
+
+
+class RecipeSearch(BaseModel):
+    """Full text search document of a recipe.
+
+    Weighted A: recipe_name, B: ingredient names, C: description,
+    D: directions. `is_publish` is copied from the recipe so matches are
+    ranked and paged on this table alone. Kept current by Recipe and
+    Ingredient saves and the bulk writers through refresh(), rebuild()
+    recomputes every document.
+    """
+    recipe = ForeignKeyField(Recipe, primary_key=True, backref='backref_search', on_delete='CASCADE')
+    is_publish = BooleanField(default=False)
+    document = TSVectorField()
+
+    # text search configuration, SEARCH_LANGUAGE of the config given to init_db()
+    language = 'english'
+
+    @classmethod
+    def document_query(cls):
+        """recipe id, is_publish, search document of every recipe"""
+        language = cls.language
+
+        def weighted(value, weight):
+            return fn.setweight(fn.to_tsvector(language, fn.COALESCE(value, '')), weight)
+
+        names = fn.string_agg(Ingredient.ingredient_name, ' ')
+        return (Recipe
+                .select(Recipe.id, Recipe.is_publish,
+                        weighted(Recipe.recipe_name, 'A').concat(weighted(names, 'B'))
+                        .concat(weighted(Recipe.description, 'C')).concat(weighted(Recipe.directions, 'D')))
+                .join(Ingredient, JOIN.LEFT_OUTER, on=(Ingredient.recipe == Recipe.id))
+                .group_by(Recipe.id))
+
+    @classmethod
+    def refresh(cls, *recipe_ids):
+        """Recompute the documents of `recipe_ids` (None entries are ignored)"""
+        recipe_ids = [recipe_id for recipe_id in set(recipe_ids) if recipe_id is not None]
+        if not recipe_ids:
+            return 0
+        query = cls.document_query().where(Recipe.id.in_(recipe_ids))
+        return cls.insert_from(query, [cls.recipe, cls.is_publish, cls.document]).on_conflict(
+            conflict_target=[cls.recipe],
+            update={cls.is_publish: EXCLUDED.is_publish, cls.document: EXCLUDED.document}).as_rowcount().execute()
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the documents of every recipe"""
+        with db.atomic():
+            cls.create_table(safe=True)
+            cls.delete().execute()
+            return cls.insert_from(
+                cls.document_query(), [cls.recipe, cls.is_publish, cls.document]).as_rowcount().execute()
+
+    @classmethod
+    def matching(cls, text):
+        """Published recipes matching the web search style `text`, and the ts_rank expression"""
+        query = fn.websearch_to_tsquery(cls.language, text)
+        # double precision, so a rank read back from a cursor compares equal
+        rank = fn.ts_rank(cls.document, query).cast('float8')
+        matches = cls.select(cls.recipe, rank.alias('rank')).where(
+            cls.is_publish & Expression(cls.document, '@@', query))
+        return matches, rank
+
+
+Ingredient.add_index(Ingredient.index(Ingredient.name_key(), Ingredient.recipe, name='ingredient_name_key'))
+
+
+# unit -> factor to the base unit of its kind (g, kJ)
+NUTRITION_UNITS = {
+    'g': {'g': 1, 'mg': 0.001, 'mcg': 0.000001, 'µg': 0.000001, 'kg': 1000},
+    'kj': {'kj': 1, 'kcal': 4.184},
+}
+
+
+class RecipeNutrition(BaseModel):
+    """Numeric projection of Recipe.nutrition for range filters.
+
+    Every column is parsed in SQL from the display strings of the keys
+    listed in NUTRIENTS ("1264kJ", "30.5 g", "1,2 g"), converted to the
+    unit in its name; missing or unparseable values are NULL. Kept current
+    by Recipe saves and the bulk writers through refresh(), rebuild()
+    recomputes every row.
+    """
+    # column -> (unit, (nutrition key, unit of values without one), ...)
+    NUTRIENTS = {
+        'energy_kj': ('kj', ('Energy (kJ)', 'kj'), ('Energy', 'kj'), ('Energy (kcal)', 'kcal'), ('Calories', 'kcal')),
+        'protein_g': ('g', ('Protein', 'g')),
+        'fat_g': ('g', ('Fat', 'g')),
+        'saturates_g': ('g', ('of which saturates', 'g'), ('Saturates', 'g')),
+        'carbohydrate_g': ('g', ('Carbohydrate', 'g'), ('Carbohydrates', 'g')),
+        'sugars_g': ('g', ('of which sugars', 'g'), ('Sugars', 'g')),
+        'fibre_g': ('g', ('Fibre', 'g'), ('Fiber', 'g')),
+        'sodium_mg': ('mg', ('Sodium', 'mg')),
+    }
+
+    recipe = ForeignKeyField(Recipe, primary_key=True, backref='backref_nutrition', on_delete='CASCADE')
+    energy_kj = DoubleField(null=True, index=True)
+    protein_g = DoubleField(null=True, index=True)
+    fat_g = DoubleField(null=True, index=True)
+    saturates_g = DoubleField(null=True, index=True)
+    carbohydrate_g = DoubleField(null=True, index=True)
+    sugars_g = DoubleField(null=True, index=True)
+    fibre_g = DoubleField(null=True, index=True)
+    sodium_mg = DoubleField(null=True, index=True)
+
+    @staticmethod
+    def parsed(key, unit, default):
+        """Value of the nutrition `key` in `unit`, NULL for other kinds of units"""
+        raw = Recipe.nutrition[key]
+        number = fn.replace(fn.substring(raw, r'^\s*([0-9]+(?:[.,][0-9]+)?)'), ',', '.').cast('float8')
+        found = fn.COALESCE(fn.NULLIF(fn.lower(fn.substring(raw, r'^\s*[0-9.,]+\s*([[:alpha:]µ]+)')), ''), default)
+        factors = next(units for units in NUTRITION_UNITS.values() if unit in units)
+        return number * Case(found, [(name, factor / factors[unit]) for name, factor in factors.items()])
+
+    @classmethod
+    def nutrition_query(cls):
+        """recipe id and nutrient columns of every recipe"""
+        columns = [fn.COALESCE(*[cls.parsed(key, unit, default) for key, default in keys])
+                   for unit, *keys in cls.NUTRIENTS.values()]
+        return Recipe.select(Recipe.id, *columns)
+
+    @classmethod
+    def fields(cls):
+        return [cls.recipe] + [getattr(cls, name) for name in cls.NUTRIENTS]
+
+    @classmethod
+    def refresh(cls, *recipe_ids):
+        """Recompute the rows of `recipe_ids` (None entries are ignored)"""
+        recipe_ids = [recipe_id for recipe_id in set(recipe_ids) if recipe_id is not None]
+        if not recipe_ids:
+            return 0
+        query = cls.nutrition_query().where(Recipe.id.in_(recipe_ids))
+        return cls.insert_from(query, cls.fields()).on_conflict(
+            conflict_target=[cls.recipe],
+            update={getattr(cls, name): getattr(EXCLUDED, name) for name in cls.NUTRIENTS}).as_rowcount().execute()
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the rows of every recipe"""
+        with db.atomic():
+            cls.create_table(safe=True)
+            cls.delete().execute()
+            return cls.insert_from(cls.nutrition_query(), cls.fields()).as_rowcount().execute()
+
+    @classmethod
+    def within(cls, bounds):
+        """Ids of the recipes whose nutrients are within `bounds`, a dict of
+        '<column>_min' / '<column>_max' -> inclusive limit
+        """
+        conditions = []
+        for name, limit in bounds.items():
+            column, bound = name.rsplit('_', 1)
+            field = getattr(cls, column)
+            conditions.append(field >= limit if bound == 'min' else field <= limit)
+        return cls.select(cls.recipe).where(*conditions)
+
 
 class WeeklyMenu(BaseModel):
     """WeeklyMenu Model"""
@@ -130,10 +533,8 @@ class WeeklyMenu(BaseModel):
 
     @property
     def averageScore(self):
-        try:
-            return statistics.mean((i.score for i in WeeklyMenuReview.select().where(WeeklyMenuReview.menu == self)))
-        except statistics.StatisticsError as e:
-            return 0
+        rollup = WeeklyMenuScore.get_or_none(WeeklyMenuScore.menu == self.id)
+        return rollup.average if rollup else 0
 
     @property
     def recipes(self):
@@ -142,17 +543,64 @@ class WeeklyMenu(BaseModel):
     @classmethod
     def addRecipe(cls, weekly_menu, recipe):
         """Add recipe to weekly menu"""
-        if WeeklyRecipeMap.select().where(WeeklyRecipeMap.week == weekly_menu, WeeklyRecipeMap.recipe == recipe):
-            return False, f"{recipe} is already part of weekly menu {weekly_menu}"
-        recipe_map = WeeklyRecipeMap()
-        recipe_map.recipe = recipe
         try:
-            recipe_map.week = weekly_menu
-
-            recipe_map.save()
-            return True, None
+            added = cls.add_recipes(weekly_menu, [recipe])
         except Exception as e:
             return False, e
+        if not added:
+            return False, f"{recipe} is already part of weekly menu {weekly_menu}"
+        return True, None
+
+    @classmethod
+    def add_recipes(cls, menu_id, recipe_ids):
+        """Map the recipes of `recipe_ids` to the menu in one insert, skipping
+        the ones it already holds; returns the ids of the added recipes
+        """
+        if not recipe_ids:
+            return []
+        query = (WeeklyRecipeMap
+                 .insert_many([{'week': menu_id, 'recipe': recipe_id} for recipe_id in recipe_ids])
+                 .on_conflict_ignore()
+                 .returning(WeeklyRecipeMap.recipe)
+                 .tuples())
+        return [recipe_id for recipe_id, in query.execute()]
+
+    @classmethod
+    def remove_recipes(cls, menu_id, recipe_ids=None, keep=None):
+        """Unmap `recipe_ids` from the menu, or every recipe but the ones of
+        `keep`; returns the number of removed recipes
+        """
+        query = WeeklyRecipeMap.delete().where(WeeklyRecipeMap.week == menu_id)
+        if recipe_ids is not None:
+            query = query.where(WeeklyRecipeMap.recipe.in_(list(recipe_ids)))
+        if keep:
+            query = query.where(WeeklyRecipeMap.recipe.not_in(list(keep)))
+        return query.execute()
+
+    @classmethod
+    def set_recipes(cls, menu_id, recipe_ids):
+        """Make `recipe_ids` the recipe set of the menu, returns the added ids
+        and the number of removed recipes
+        """
+        with db.atomic():
+            removed = cls.remove_recipes(menu_id, keep=recipe_ids)
+            return cls.add_recipes(menu_id, recipe_ids), removed
+
+    @classmethod
+    def clone_recipes(cls, menu_id, source_id):
+        """Add the recipes of the `source_id` menu to the menu in a single
+        INSERT ... SELECT, returns the ids of the added recipes
+        """
+        source = (WeeklyRecipeMap
+                  .select(Value(menu_id), WeeklyRecipeMap.recipe)
+                  .where(WeeklyRecipeMap.week == source_id)
+                  .order_by(WeeklyRecipeMap.id))
+        query = (WeeklyRecipeMap
+                 .insert_from(source, [WeeklyRecipeMap.week, WeeklyRecipeMap.recipe])
+                 .on_conflict_ignore()
+                 .returning(WeeklyRecipeMap.recipe)
+                 .tuples())
+        return [recipe_id for recipe_id, in query.execute()]
 
     @classmethod
     def removeRecipe(cls, weekly_menu, recipe):
@@ -170,12 +618,44 @@ class WeeklyMenu(BaseModel):
         data.update({"recipes": self.recipes, "score": self.averageScore})
         return data
 
+    @classmethod
+    def shopping_list(cls, menu_id, servings=None):
+        """Summed ingredient counts of the recipes of a menu by normalized
+        name and unit, scaled from each recipe's num_of_servings to
+        `servings` when given
+        """
+        count = Ingredient.count
+        if servings is not None:
+            # float8 before scaling, the integer count would make Postgres divide integers
+            count = (Ingredient.count.cast('float8') * float(servings)
+                     / fn.COALESCE(fn.NULLIF(Recipe.num_of_servings, 0), servings))
+        name, unit = Ingredient.name_key(), fn.lower(fn.btrim(Ingredient.unit))
+        query = (Ingredient
+                 .select(name.alias('name'), unit.alias('unit'), fn.SUM(count).alias('quantity'),
+                         fn.COUNT(Ingredient.recipe.distinct()).alias('recipes'))
+                 .join(WeeklyRecipeMap, on=(WeeklyRecipeMap.recipe == Ingredient.recipe))
+                 .join(Recipe, on=(Recipe.id == Ingredient.recipe))
+                 .where(WeeklyRecipeMap.week == menu_id)
+                 .group_by(name, unit)
+                 .order_by(name, unit))
+        rows = list(query.dicts())
+        if servings is not None:
+            for row in rows:
+                row['quantity'] = round(row['quantity'], 2)
+        return rows
+
 
 class WeeklyRecipeMap(BaseModel):
     """M:M relation for weekly Menu and Recipes"""
     week = ForeignKeyField(WeeklyMenu)
     recipe = ForeignKeyField(Recipe)
 
+    class Meta:
+        # a recipe is mapped to a menu once, bulk writes rely on it for ON CONFLICT DO NOTHING
+        indexes = (
+            (("week", "recipe"), True),
+        )
+
     @property
     def serialize(self):
         return model_to_dict(self)
@@ -187,11 +667,31 @@ class Users(BaseModel):
     password = CharField()
     admin = BooleanField(default=False)
 
+    # caches keyed by public_id (the app's principal caches), a saved or deleted
+    # user is evicted from them; bulk update()/delete() queries are not seen
+    principal_caches = weakref.WeakSet()
+
     @property
     def serialize(self):
         data = model_to_dict(self)
         return data
 
+    def save(self, *args, **kwargs):
+        rows = super().save(*args, **kwargs)
+        self.evict()
+        return rows
+
+    def delete_instance(self, *args, **kwargs):
+        rows = super().delete_instance(*args, **kwargs)
+        self.evict()
+        return rows
+
+    def evict(self):
+        """Drop the user from the principal caches"""
+        if type(self) is Users:
+            for cache in list(Users.principal_caches):
+                cache.invalidate(str(self.public_id))
+
 
 
     def __str__(self):
@@ -235,6 +735,9 @@ class RecipeReview(BaseModel):
     class Meta:
          indexes = (
               (('recipe', 'customer'), True),
+              # review list filters, see review_filters() in app.py
+              (('recipe', 'is_publish', 'pub_date'), False),
+              (('customer', 'is_publish', 'pub_date'), False),
         )
             
 
@@ -254,6 +757,11 @@ class RecipeReview(BaseModel):
         # return model_to_dict(self)
         return data
 
+    @property
+    def score_state(self):
+        """(recipe id, score, published) as counted by RecipeRating"""
+        return self.recipe_id, int(self.score), bool(self.is_publish)
+
 
 class WeeklyMenuReview(BaseModel):
     """Weekly Menu review Model"""
@@ -276,6 +784,8 @@ class WeeklyMenuReview(BaseModel):
     class Meta:
         indexes = (
              (('menu', 'customer'), True),
+             (('menu', 'is_publish', 'pub_date'), False),
+             (('customer', 'is_publish', 'pub_date'), False),
        )
 
     @property
@@ -291,3 +801,157 @@ class WeeklyMenuReview(BaseModel):
         }
         # return model_to_dict(self)
         return data
+
+    @property
+    def score_state(self):
+        """(menu id, score, published) as counted by WeeklyMenuScore"""
+        return self.menu_id, int(self.score), bool(self.is_publish)
+
+
+class WeeklyMenuScore(BaseModel):
+    """Rollup of published review scores per weekly menu"""
+    menu = ForeignKeyField(WeeklyMenu, primary_key=True, backref='backref_score')
+    score_sum = IntegerField(default=0)
+    score_count = IntegerField(default=0)
+    score_1 = IntegerField(default=0)
+    score_2 = IntegerField(default=0)
+    score_3 = IntegerField(default=0)
+    score_4 = IntegerField(default=0)
+    score_5 = IntegerField(default=0)
+
+    @classmethod
+    def histogram_fields(cls):
+        return [cls.score_1, cls.score_2, cls.score_3, cls.score_4, cls.score_5]
+
+    @property
+    def histogram(self):
+        return {str(score): getattr(self, f'score_{score}') for score in range(1, 6)}
+
+    @property
+    def average(self):
+        if not self.score_count:
+            return 0
+        if self.score_sum % self.score_count == 0:
+            return self.score_sum // self.score_count
+        return self.score_sum / self.score_count
+
+    @classmethod
+    def apply(cls, menu_id, score, step):
+        """Add (step=1) or remove (step=-1) a single score from the rollup of a menu"""
+        values = {cls.menu: menu_id, cls.score_sum: score * step, cls.score_count: step}
+        update = {cls.score_sum: cls.score_sum + score * step, cls.score_count: cls.score_count + step}
+        if 1 <= score <= 5:
+            column = getattr(cls, f'score_{score}')
+            values[column] = step
+            update[column] = column + step
+        cls.insert(values).on_conflict(conflict_target=[cls.menu], update=update).execute()
+
+    @classmethod
+    def review_changed(cls, before, after):
+        """Move a review between rollups, `before`/`after` are WeeklyMenuReview.score_state values or None"""
+        if before and before[2]:
+            cls.apply(before[0], before[1], -1)
+        if after and after[2]:
+            cls.apply(after[0], after[1], 1)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute every rollup from the published reviews"""
+        review = WeeklyMenuReview
+        query = review.select(
+            review.menu, fn.SUM(review.score), fn.COUNT(review.id),
+            *[fn.COUNT(review.id).filter(review.score == score) for score in range(1, 6)]
+        ).where(review.is_publish).group_by(review.menu)
+        with db.atomic():
+            cls.create_table(safe=True)
+            cls.delete().execute()
+            menus = cls.insert_from(
+                query, [cls.menu, cls.score_sum, cls.score_count] + cls.histogram_fields()).as_rowcount().execute()
+            WriteVersion.bump(cls)
+        return menus
+
+
+class RecipeRating(BaseModel):
+    """Rollup of published review scores per recipe.
+
+    Every recipe has a row, zero until it is reviewed, so the recipe list
+    sorted by rating or review count walks an index of this table.
+    """
+    recipe = ForeignKeyField(Recipe, primary_key=True, backref='backref_rating', on_delete='CASCADE')
+    score_sum = IntegerField(default=0)
+    score_count = IntegerField(default=0)
+    rating = DoubleField(default=0)
+    score_1 = IntegerField(default=0)
+    score_2 = IntegerField(default=0)
+    score_3 = IntegerField(default=0)
+    score_4 = IntegerField(default=0)
+    score_5 = IntegerField(default=0)
+
+    @classmethod
+    def histogram_fields(cls):
+        return [cls.score_1, cls.score_2, cls.score_3, cls.score_4, cls.score_5]
+
+    @property
+    def histogram(self):
+        return {str(score): getattr(self, f'score_{score}') for score in range(1, 6)}
+
+    @property
+    def serialize(self):
+        return {'rating': self.rating, 'review_count': self.score_count, 'rating_histogram': self.histogram}
+
+    @classmethod
+    def add(cls, *recipe_ids):
+        """Create the empty rows of new recipes"""
+        recipe_ids = [recipe_id for recipe_id in set(recipe_ids) if recipe_id is not None]
+        if not recipe_ids:
+            return 0
+        fields = [cls.score_sum, cls.score_count, cls.rating] + cls.histogram_fields()
+        query = Recipe.select(Recipe.id, *[Value(0) for _ in fields]).where(Recipe.id.in_(recipe_ids))
+        return cls.insert_from(query, [cls.recipe] + fields).on_conflict_ignore().as_rowcount().execute()
+
+    @classmethod
+    def apply(cls, recipe_id, score, step):
+        """Add (step=1) or remove (step=-1) a single score from the rollup of a recipe"""
+        total, count = cls.score_sum + score * step, cls.score_count + step
+        values = {cls.recipe: recipe_id, cls.score_sum: score * step, cls.score_count: step,
+                  cls.rating: score if step > 0 else 0}
+        update = {cls.score_sum: total, cls.score_count: count,
+                  cls.rating: fn.COALESCE(total.cast('float8') / fn.NULLIF(count, 0), 0)}
+        if 1 <= score <= 5:
+            column = getattr(cls, f'score_{score}')
+            values[column] = step
+            update[column] = column + step
+        cls.insert(values).on_conflict(conflict_target=[cls.recipe], update=update).execute()
+
+    @classmethod
+    def review_changed(cls, before, after):
+        """Move a review between rollups, `before`/`after` are RecipeReview.score_state values or None"""
+        if before and before[2]:
+            cls.apply(before[0], before[1], -1)
+        if after and after[2]:
+            cls.apply(after[0], after[1], 1)
+
+    @classmethod
+    def rebuild(cls):
+        """Recompute the rollup of every recipe from the published reviews"""
+        review = RecipeReview
+        query = (Recipe
+                 .select(Recipe.id, fn.COALESCE(fn.SUM(review.score), 0), fn.COUNT(review.id),
+                         fn.COALESCE(fn.AVG(review.score).cast('float8'), 0),
+                         *[fn.COUNT(review.id).filter(review.score == score) for score in range(1, 6)])
+                 .join(review, JOIN.LEFT_OUTER, on=((review.recipe == Recipe.id) & review.is_publish))
+                 .group_by(Recipe.id))
+        with db.atomic():
+            cls.create_table(safe=True)
+            cls.delete().execute()
+            recipes = cls.insert_from(
+                query, [cls.recipe, cls.score_sum, cls.score_count, cls.rating] + cls.histogram_fields()
+            ).as_rowcount().execute()
+            WriteVersion.bump(cls)
+        return recipes
+
+
+# sorted recipe lists, highest first with ties in id order (see Pager.paginate)
+RecipeRating.add_index(RecipeRating.index(RecipeRating.rating.desc(), RecipeRating.recipe, name='reciperating_rating'))
+RecipeRating.add_index(RecipeRating.index(RecipeRating.score_count.desc(), RecipeRating.recipe,
+                                          name='reciperating_score_count'))
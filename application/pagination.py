@@ -0,0 +1,87 @@
+import base64
+import binascii
+import json
+
+from flask import current_app, request
+
+
+class InvalidCursor(ValueError):
+    """Raised for cursors that were not produced by encode_cursor"""
+
+
+def encode_cursor(value):
+    raw = json.dumps(value, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        return json.loads(raw)
+    except (binascii.Error, ValueError) as e:
+        raise InvalidCursor(f"invalid cursor {cursor!r}") from e
+
+
+class Pager(object):
+    """Pagination of list endpoints.
+
+    Without a `cursor` query argument the `/<int:page>` LIMIT/OFFSET
+    behaviour is kept. With one, rows are fetched after the key encoded in
+    the cursor, so deep pages cost the same as the first one. Either way
+    `meta['next']` holds the cursor of the following page, or None on the
+    last page. `per_page` is client selectable up to MAX_PER_PAGE.
+
+    Ranked pages (search results) are ordered by a `rank` expression,
+    highest first with ties broken by the key; their cursors hold the
+    (rank, key) of the last row, which the serialized rows carry as 'rank'.
+
+    Paginated queries fetch one row past the page, so rows() can tell
+    whether a next page exists; meta() only offers a cursor when it does.
+    """
+
+    def __init__(self, page=1):
+        config = current_app.config
+        per_page = request.args.get('per_page', config['PER_PAGE'], type=int)
+        self.per_page = min(max(per_page, 1), config['MAX_PER_PAGE'])
+        self.cursor = request.args.get('cursor')
+        self.page = page if self.cursor is None else None
+        self.ranked = False
+        self.more = False
+
+    def paginate(self, query, key, rank=None):
+        """Apply the page to `query`, ordered by the unique column `key` or by
+        `rank` then `key`, plus the first row of the next page
+        """
+        self.ranked = rank is not None
+        query = query.order_by(rank.desc(), key) if self.ranked else query.order_by(key)
+        if self.cursor is None:
+            return query.limit(self.per_page + 1).offset(max(self.page - 1, 0) * self.per_page)
+        after = decode_cursor(self.cursor)
+        if self.ranked:
+            if not (isinstance(after, list) and len(after) == 2 and isinstance(after[0], (int, float))
+                    and isinstance(after[1], int)):
+                raise InvalidCursor(f"invalid cursor {self.cursor!r}")
+            return query.where((rank < after[0]) | ((rank == after[0]) & (key > after[1]))).limit(self.per_page + 1)
+        if not isinstance(after, int):
+            raise InvalidCursor(f"invalid cursor {self.cursor!r}")
+        return query.where(key > after).limit(self.per_page + 1)
+
+    def rows(self, data):
+        """The rows of the page out of `data`, the rows of a paginated query,
+        without the look-ahead row
+        """
+        self.more = len(data) > self.per_page
+        return data[:self.per_page]
+
+    def meta(self, data):
+        """Pagination metadata for the serialized rows of the page"""
+        last_page = not self.more
+        if not last_page:
+            last = [data[-1]['rank'], data[-1]['id']] if self.ranked else data[-1]['id']
+        return {
+            'page': self.page,
+            'per_page': self.per_page,
+            'cursor': self.cursor,
+            'next': None if last_page else encode_cursor(last),
+            'page_url': request.url,
+        }
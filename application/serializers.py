@@ -0,0 +1,353 @@
+"""Response serializers built from row projections.
+
+Each serializer selects the precomputed column list of its model, reads the
+rows back as tuples and builds the response dicts directly. Related rows
+of a page are fetched once per page instead of through lazy foreign keys.
+The output is the one of the models' `serialize` properties, which stay
+the reference (tests/test_serializers.py), plus aggregates only computed
+here such as the recipe counts of classifications.
+
+List endpoints may narrow it with `?fields=` and widen it with
+`?include=`, parsed by requested(): serializers given `keys` only select
+the columns and run the queries those keys need, and batch load the
+includes of the whole page.
+
+FastJSONProvider encodes responses with orjson when it is installed,
+producing what Flask's stdlib provider would (sorted keys, HTTP dates,
+str() of decimals), and falls back to the stdlib provider otherwise.
+"""
+from application.metrics import TimedJSONProvider
+from peewee import JOIN, fn
+
+from application.models import (Customer, Ingredient, Recipe, RecipeClassification, RecipeRating, RecipeReview,
+                                Users, WeeklyMenu, WeeklyMenuReview, WeeklyMenuScore, WeeklyRecipeMap)
+
+try:
+    import orjson
+except ImportError:  # stdlib json through Flask's provider
+    orjson = None
+
+
+def _fields(model, *exclude):
+    return tuple(field for field in model._meta.sorted_fields if field.name not in exclude)
+
+
+def _names(fields):
+    return tuple(field.name for field in fields)
+
+
+CLASSIFICATION_FIELDS = _fields(RecipeClassification)
+# classification is nested as a dict, like model_to_dict does
+RECIPE_FIELDS = _fields(Recipe, 'classification') + CLASSIFICATION_FIELDS
+MENU_FIELDS = _fields(WeeklyMenu)
+RATING_FIELDS = (RecipeRating.rating, RecipeRating.score_count) + tuple(RecipeRating.histogram_fields())
+INGREDIENT_FIELDS = (Ingredient.id, Ingredient.ingredient_name, Ingredient.unit, Ingredient.count,
+                     Ingredient.recipe, Recipe.recipe_name)
+
+CLASSIFICATION_NAMES = _names(CLASSIFICATION_FIELDS)
+RECIPE_NAMES = _names(_fields(Recipe, 'classification'))
+MENU_NAMES = _names(MENU_FIELDS)
+RATING_NAMES = ('rating', 'review_count', 'rating_histogram')
+
+# keys serialized by default and the ones ?include= may ask for, includes outside the defaults are opt-in
+RECIPE_KEYS = frozenset(RECIPE_NAMES + RATING_NAMES + ('classification', 'ingredients', 'has_links'))
+RECIPE_INCLUDES = ('ingredients', 'classification', 'reviews')
+MENU_KEYS = frozenset(MENU_NAMES + ('recipes', 'score'))
+MENU_INCLUDES = ('recipes', 'score', 'reviews')
+COUNT_NAMES = ('recipe_count', 'published_recipe_count', 'has_links')
+CLASSIFICATION_KEYS = frozenset(CLASSIFICATION_NAMES + COUNT_NAMES)
+CLASSIFICATION_INCLUDES = ('recipes',)
+
+
+def _split(value):
+    return {name.strip() for name in value.split(',') if name.strip()}
+
+
+def requested(fields, include, defaults, includes):
+    """Keys to serialize for the comma separated `fields` and `include`
+    query parameters: `fields` (`defaults` when not given) plus `include`,
+    always with the id. None when neither is given, ValueError on names
+    that are not serialized.
+    """
+    if fields is None and include is None:
+        return None
+    keys = set(defaults) if fields is None else _split(fields)
+    unknown = keys - set(defaults) - set(includes)
+    if unknown:
+        raise ValueError(f"unknown fields {', '.join(sorted(unknown))}")
+    included = _split(include or '')
+    unknown = included - set(includes)
+    if unknown:
+        raise ValueError(f"unknown includes {', '.join(sorted(unknown))}, use {', '.join(includes)}")
+    return frozenset(keys | included | {'id'})
+
+
+def _only(rows, keys):
+    return [{key: value for key, value in row.items() if key in keys} for row in rows]
+
+
+def _recipe(row):
+    """model_to_dict form of a RECIPE_FIELDS row"""
+    data = dict(zip(RECIPE_NAMES, row))
+    data['classification'] = dict(zip(CLASSIFICATION_NAMES, row[len(RECIPE_NAMES):]))
+    return data
+
+
+def _recipe_name(recipe_id, recipe_name):
+    # str() of a Recipe
+    return f"{recipe_id} : {recipe_name} ".strip()
+
+
+def _customer_name(customer_id, name):
+    # str() of a Customer
+    return f"id:{customer_id}, name:{name}".strip()
+
+
+def _review_fields(model):
+    return (Customer.id, Customer.name, model.review, model.score, model.summary, model.pub_date)
+
+
+def _review(row):
+    """Fields shared by recipe and weekly menu reviews of a _review_fields() row"""
+    customer_id, name, review, score, summary, pub_date = row
+    return {'review': str(review).strip(), 'customer': _customer_name(customer_id, name), 'score': str(score),
+            'summary': str(summary).strip(), 'pub_date': str(pub_date).strip()}
+
+
+def _ingredients_of(recipes):
+    """recipe id -> serialized ingredients of `recipes`, a dict of recipe id -> recipe_name"""
+    ingredients = {}
+    query = (Ingredient
+             .select(Ingredient.id, Ingredient.ingredient_name, Ingredient.unit, Ingredient.count, Ingredient.recipe)
+             .where(Ingredient.recipe.in_(list(recipes)))
+             .order_by(Ingredient.id)
+             .tuples())
+    for ingredient_id, name, unit, count, recipe_id in query:
+        ingredients.setdefault(recipe_id, []).append({
+            'id': ingredient_id, 'ingredient_name': str(name).strip(), 'unit': str(unit).strip(),
+            'count': str(count), 'recipe': _recipe_name(recipe_id, recipes[recipe_id])})
+    return ingredients
+
+
+def _rating(row):
+    """RecipeRating.serialize form of a RATING_FIELDS row, zero for recipes without a rollup row"""
+    rating, count, *histogram = (value or 0 for value in row)
+    return {'rating': rating, 'review_count': count,
+            'rating_histogram': {str(score): value for score, value in enumerate(histogram, 1)}}
+
+
+def _reviews_of(model, parent, ids):
+    """parent id -> published reviews of `model` for `ids`, latest first"""
+    reviews = {}
+    query = (model
+             .select(model.id, parent, *_review_fields(model))
+             .join(Customer)
+             .where(parent.in_(list(ids)), model.is_publish)
+             .order_by(model.pub_date.desc(), model.id)
+             .tuples())
+    for review_id, parent_id, *row in query:
+        reviews.setdefault(parent_id, []).append(dict(_review(row), id=review_id))
+    return reviews
+
+
+def recipes(query, keys=None):
+    """Serialize a page of recipes in three queries: the page with its
+    classifications and ratings, the ingredients and the weekly menu links
+    of the page. With `keys` only the joins and queries those need run.
+    """
+    wanted = RECIPE_KEYS if keys is None else keys
+    classified = 'classification' in wanted
+    rated = not wanted.isdisjoint(RATING_NAMES)
+    names = RECIPE_NAMES if keys is None else tuple(
+        name for name in RECIPE_NAMES if name in wanted or name in ('id', 'recipe_name'))
+    query = query.select(*(getattr(Recipe, name) for name in names),
+                         *(CLASSIFICATION_FIELDS if classified else ()), *(RATING_FIELDS if rated else ()))
+    if classified:
+        query = query.join(RecipeClassification).switch(Recipe)
+    if rated:
+        query = query.join(RecipeRating, JOIN.LEFT_OUTER)
+    rows = []
+    for row in query.tuples():
+        data = dict(zip(names, row))
+        row = row[len(names):]
+        if classified:
+            data['classification'] = dict(zip(CLASSIFICATION_NAMES, row[:len(CLASSIFICATION_NAMES)]))
+            row = row[len(CLASSIFICATION_NAMES):]
+        if rated:
+            data.update(_rating(row))
+        rows.append(data)
+    if not rows:
+        return []
+    recipe_names = {row['id']: row['recipe_name'] for row in rows}
+    if 'ingredients' in wanted:
+        ingredients = _ingredients_of(recipe_names)
+        for row in rows:
+            row['ingredients'] = ingredients.get(row['id'], [])
+    if 'has_links' in wanted:
+        linked = {recipe_id for recipe_id, in WeeklyRecipeMap.select(WeeklyRecipeMap.recipe).where(
+            WeeklyRecipeMap.recipe.in_(list(recipe_names))).distinct().tuples()}
+        for row in rows:
+            row['has_links'] = row['id'] in linked
+    if 'reviews' in wanted:
+        reviews = _reviews_of(RecipeReview, RecipeReview.recipe, recipe_names)
+        for row in rows:
+            row['reviews'] = [dict(review, recipe=str(row['recipe_name']).strip()) for review in
+                              reviews.get(row['id'], [])]
+    return rows if keys is None else _only(rows, keys)
+
+
+def ranked_recipes(rows, keys=None):
+    """Serialize the recipes of ranked `rows`, dicts of a recipe `id` and
+    the values to add to its serialized form, keeping their order
+    """
+    data = {recipe['id']: recipe for recipe in recipes(
+        Recipe.select().where(Recipe.id.in_([r['id'] for r in rows])), keys)}
+    return [dict(data[row['id']], **row) for row in rows if row['id'] in data]
+
+
+def classifications(query, keys=None):
+    """Serialize classifications with their recipe counts, grouped in the
+    query of the page
+    """
+    wanted = CLASSIFICATION_KEYS if keys is None else keys
+    if wanted.isdisjoint(COUNT_NAMES):
+        rows = [dict(zip(CLASSIFICATION_NAMES, row)) for row in query.select(*CLASSIFICATION_FIELDS).tuples()]
+    else:
+        rows = []
+        for *row, count, published_count in (query
+                                             .select(*CLASSIFICATION_FIELDS, fn.COUNT(Recipe.id),
+                                                     fn.COUNT(Recipe.id).filter(Recipe.is_publish))
+                                             .join(Recipe, JOIN.LEFT_OUTER)
+                                             .group_by(RecipeClassification.id)
+                                             .tuples()):
+            rows.append(dict(zip(CLASSIFICATION_NAMES, row), recipe_count=count,
+                             published_recipe_count=published_count, has_links=count > 0))
+    if not rows:
+        return []
+    ids = [row['id'] for row in rows]
+    if 'recipes' in wanted:
+        published = {}
+        for recipe_id, recipe_name, classification_id in Recipe.select(
+                Recipe.id, Recipe.recipe_name, Recipe.classification).where(
+                Recipe.classification.in_(ids), Recipe.is_publish).order_by(Recipe.id).tuples():
+            published.setdefault(classification_id, []).append({'id': recipe_id, 'recipe_name': recipe_name})
+        for row in rows:
+            row['recipes'] = published.get(row['id'], [])
+    return rows if keys is None else _only(rows, keys)
+
+
+def ingredients(query):
+    return [{'id': ingredient_id, 'ingredient_name': str(name).strip(), 'unit': str(unit).strip(),
+             'count': str(count), 'recipe': _recipe_name(recipe_id, recipe_name)}
+            for ingredient_id, name, unit, count, recipe_id, recipe_name
+            in query.select(*INGREDIENT_FIELDS).join(Recipe).tuples()]
+
+
+def recipe_reviews(query):
+    rows = (query.select(RecipeReview.id, Recipe.recipe_name, *_review_fields(RecipeReview))
+            .join(Recipe).switch(RecipeReview).join(Customer).tuples())
+    return [dict({'id': review_id, 'recipe': str(recipe_name).strip()}, **_review(row))
+            for review_id, recipe_name, *row in rows]
+
+
+def weekly_menu_reviews(query):
+    rows = (query.select(WeeklyMenuReview.id, WeeklyMenu.week_number, *_review_fields(WeeklyMenuReview))
+            .join(WeeklyMenu).switch(WeeklyMenuReview).join(Customer).tuples())
+    return [dict({'id': review_id, 'menu': str(week_number)}, **_review(row))
+            for review_id, week_number, *row in rows]
+
+
+def weekly_menus(query, keys=None):
+    """Serialize weekly menus with their recipe maps (menu and recipe
+    nested, like model_to_dict does) and average scores, in three queries.
+    With `keys` only the queries those need run.
+    """
+    wanted = MENU_KEYS if keys is None else keys
+    menus = [dict(zip(MENU_NAMES, row)) for row in query.select(*MENU_FIELDS).tuples()]
+    if not menus:
+        return []
+    by_id = {menu['id']: menu for menu in menus}
+    extra = {menu['id']: {} for menu in menus}
+    if 'recipes' in wanted:
+        query = (WeeklyRecipeMap
+                 .select(WeeklyRecipeMap.id, WeeklyRecipeMap.week, *RECIPE_FIELDS)
+                 .join(Recipe).join(RecipeClassification)
+                 .where(WeeklyRecipeMap.week.in_(list(by_id)))
+                 .order_by(WeeklyRecipeMap.id)
+                 .tuples())
+        for menu_id in by_id:
+            extra[menu_id]['recipes'] = []
+        for map_id, menu_id, *recipe in query:
+            extra[menu_id]['recipes'].append({'id': map_id, 'week': dict(by_id[menu_id]), 'recipe': _recipe(recipe)})
+    if 'score' in wanted:
+        scores = {score.menu_id: score.average for score in WeeklyMenuScore.select(
+            WeeklyMenuScore.menu, WeeklyMenuScore.score_sum, WeeklyMenuScore.score_count).where(
+            WeeklyMenuScore.menu.in_(list(by_id)))}
+        for menu_id in by_id:
+            extra[menu_id]['score'] = scores.get(menu_id, 0)
+    if 'reviews' in wanted:
+        reviews = _reviews_of(WeeklyMenuReview, WeeklyMenuReview.menu, by_id)
+        for menu_id, menu in by_id.items():
+            extra[menu_id]['reviews'] = [dict(review, menu=str(menu['week_number'])) for review in
+                                         reviews.get(menu_id, [])]
+    rows = [dict(menu, **extra[menu['id']]) for menu in menus]
+    return rows if keys is None else _only(rows, keys)
+
+
+def users(query):
+    return [{'public_id': public_id, 'name': name, 'password': password, 'admin': admin}
+            for public_id, name, password, admin in query.select(
+                Users.public_id, Users.name, Users.password, Users.admin).tuples()]
+
+
+def customers(query, private=False):
+    """Customer.serialize rows, with public_id and password when `private`"""
+    if private:
+        return [{'id': customer_id, 'public_id': public_id, 'name': name, 'password': password, 'admin': admin,
+                 'is_active': is_active}
+                for customer_id, public_id, name, password, admin, is_active in query.select(
+                    Customer.id, Customer.public_id, Customer.name, Customer.password, Customer.admin,
+                    Customer.is_active).tuples()]
+    return [{'id': customer_id, 'is_active': is_active, 'name': name, 'admin': admin}
+            for customer_id, is_active, name, admin in query.select(
+                Customer.id, Customer.is_active, Customer.name, Customer.admin).tuples()]
+
+
+class FastJSONProvider(TimedJSONProvider):
+    """JSON provider encoding with orjson, responses are built from its bytes.
+
+    Anything orjson refuses (integers over 64 bits, unknown dumps()
+    arguments) goes through the stdlib provider.
+    """
+
+    def _orjson_options(self, indent=None):
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return option
+
+    def _encode(self, obj, indent=None):
+        """orjson bytes of `obj`, None when it has to go through the stdlib provider"""
+        if orjson is None:
+            return None
+        try:
+            return orjson.dumps(obj, default=self.default, option=self._orjson_options(indent))
+        except orjson.JSONEncodeError:
+            return None
+
+    def dumps(self, obj, **kwargs):
+        if set(kwargs) - {'indent', 'separators'}:
+            return super().dumps(obj, **kwargs)
+        encoded = self.timed(self._encode, obj, kwargs.get('indent'))
+        return super().dumps(obj, **kwargs) if encoded is None else encoded.decode()
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        indent = 2 if (self.compact is None and self._app.debug) or self.compact is False else None
+        encoded = self.timed(self._encode, obj, indent)
+        if encoded is None:
+            dump_args = {'indent': indent} if indent else {'separators': (',', ':')}
+            return self._app.response_class(f"{super().dumps(obj, **dump_args)}\n", mimetype=self.mimetype)
+        return self._app.response_class(encoded + b'\n', mimetype=self.mimetype)
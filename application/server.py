@@ -0,0 +1,88 @@
+"""Pre-fork serving under gunicorn.
+
+The app is built once in the master (preload), the garbage collector is
+frozen so the workers share the master's heap pages copy-on-write, and
+the master's pooled connections are closed before forking so no two
+processes share a socket. `manage.py serve` and `gunicorn wsgi:app`
+(through gunicorn.conf.py) both use the settings below.
+"""
+import gc
+import os
+
+from gunicorn.app.base import BaseApplication
+
+from application.config import Config
+
+
+def cpu_count():
+    """CPUs this process may use, honouring affinity masks and a cgroup v2 quota"""
+    try:
+        count = len(os.sched_getaffinity(0))
+    except AttributeError:
+        count = os.cpu_count() or 1
+    try:
+        with open('/sys/fs/cgroup/cpu.max') as f:
+            quota, period = f.read().split()
+        if quota != 'max':
+            count = min(count, max(int(int(quota) / int(period)), 1))
+    except (OSError, ValueError):
+        pass
+    return count
+
+
+def when_ready(server):
+    # the app has been imported and built without opening a connection: close
+    # anything a hook may have connected and freeze everything allocated so far
+    # out of the collector, workers fork right after
+    from application.models import db
+    db.close_all()
+    gc.collect()
+    gc.freeze()
+
+
+def pre_fork(server, worker):
+    from application.models import db
+    db.close_all()
+
+
+def worker_exit(server, worker):
+    from application.models import db
+    db.close_all()
+
+
+def options(**overrides):
+    """gunicorn settings from Config, `overrides` with a None value are ignored"""
+    settings = {
+        'bind': Config.SERVER_BIND,
+        'workers': Config.SERVER_WORKERS or cpu_count(),
+        # every thread of a worker may hold one pooled connection
+        'threads': min(Config.SERVER_THREADS, Config.DB_POOL_MAX_CONNECTIONS),
+        'preload_app': True,
+        'timeout': Config.SERVER_TIMEOUT,
+        'graceful_timeout': Config.SERVER_GRACEFUL_TIMEOUT,
+        'keepalive': Config.SERVER_KEEPALIVE,
+        'max_requests': Config.SERVER_MAX_REQUESTS,
+        'max_requests_jitter': Config.SERVER_MAX_REQUESTS // 10,
+        'when_ready': when_ready,
+        'pre_fork': pre_fork,
+        'worker_exit': worker_exit,
+    }
+    settings.update((key, value) for key, value in overrides.items() if value is not None)
+    settings['worker_class'] = 'gthread' if settings['threads'] > 1 else 'sync'
+    return settings
+
+
+class Server(BaseApplication):
+    """gunicorn application serving `factory()`"""
+
+    def __init__(self, factory, settings):
+        self.factory = factory
+        self.settings = settings
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.settings.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.factory()
@@ -0,0 +1,215 @@
+"""Latency and throughput benchmarks of the API endpoints.
+
+Each route is requested through the Flask test client (no network, no
+server overhead) and/or a threaded WSGI server on a local port, or any
+running server given by URL. Per route the runner records p50/p95/p99
+latency, requests per second and the SQL queries per request reported in
+the X-Query-Count response header. Results are plain JSON so a run can be compared with a stored
+baseline.
+"""
+import http.client
+import json
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.parse import urlsplit
+
+import jwt
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from application import models
+from application.pagination import encode_cursor
+
+BENCH_USER = 'bench user'
+
+
+def bench_token(app):
+    """Token of the benchmark user, created on first use"""
+    user, _ = models.Users.get_or_create(name=BENCH_USER, defaults={'public_id': uuid.uuid4(), 'password': ''})
+    return jwt.encode({'public_id': str(user.public_id), 'exp': datetime.utcnow() + timedelta(hours=2)},
+                      app.config['SECRET_KEY'])
+
+
+def routes(ids):
+    """name -> path of the benchmarked GET routes for the seeded `ids`"""
+    recipe = ids['recipes'][len(ids['recipes']) // 2]
+    menu = ids['menus'][0] if ids['menus'] else 0
+    deep_page = max(len(ids['recipes']) // 20, 1)
+    return {
+        'recipes.page': '/api/v1/recipes/1',
+        'recipes.deep_page': f'/api/v1/recipes/{deep_page}',
+        'recipes.cursor': f'/api/v1/recipes?cursor={encode_cursor(recipe)}',
+        'recipes.get': f'/api/v1/recipes/id/{recipe}',
+        'recipes.search': '/api/v1/recipes/search?q=recipe%207',
+        'recipes.by_ingredients': '/api/v1/recipes/by-ingredients?required=bench%20ingredient%207'
+                                  '&optional=bench%20ingredient%2042&optional=bench%20ingredient%20420',
+        'recipes.nutrition': '/api/v1/recipes?energy_kj_max=2500&protein_g_min=30',
+        'recipes.top_rated': '/api/v1/recipes?sort=rating',
+        'recipes.sparse': '/api/v1/recipes?fields=id,recipe_name',
+        'classification.page': '/api/v1/recipes-classification',
+        'ingredient.page': '/api/v1/ingredient',
+        'recipe_review.page': '/api/v1/recipe-review',
+        'weekly_menu_review.page': '/api/v1/weekly-menu-review',
+        'weekly_menu.page': '/api/v1/weekly-menu',
+        'weekly_menu.get': f'/api/v1/weekly-menu/id/{menu}',
+        'weekly_menu.shopping_list': f'/api/v1/weekly-menu/id/{menu}/shopping-list',
+        'user.list': '/api/v1/user',
+    }
+
+
+class FlaskTarget(object):
+    """Requests through the Flask test client"""
+    name = 'flask'
+
+    def __init__(self, app):
+        self.app = app
+        self.local = threading.local()
+
+    def get(self, path, headers):
+        if not hasattr(self.local, 'client'):
+            self.local.client = self.app.test_client()
+        response = self.local.client.get(path, headers=headers)
+        response.close()
+        return response.status_code, response.headers.get('X-Query-Count', type=int)
+
+    def close(self):
+        pass
+
+
+class HTTPTarget(object):
+    """Requests over HTTP to `url`, one keep-alive connection per thread"""
+    name = 'http'
+
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+        self.local = threading.local()
+
+    def get(self, path, headers):
+        for attempt in range(2):
+            if not hasattr(self.local, 'connection'):
+                self.local.connection = http.client.HTTPConnection(self.host, self.port, timeout=30)
+            try:
+                self.local.connection.request('GET', path, headers=headers)
+                response = self.local.connection.getresponse()
+                response.read()
+                if response.getheader('Connection', '').lower() == 'close':
+                    self.local.connection.close()
+                    del self.local.connection
+                queries = response.getheader('X-Query-Count')
+                return response.status, int(queries) if queries is not None else None
+            except (http.client.HTTPException, OSError):
+                self.local.connection.close()
+                del self.local.connection
+                if attempt:
+                    raise
+
+    def close(self):
+        pass
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class WSGITarget(HTTPTarget):
+    """Requests over HTTP to a threaded WSGI server started on a free local port"""
+    name = 'wsgi'
+
+    def __init__(self, app):
+        self.server = make_server('127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        super().__init__(f'http://127.0.0.1:{self.server.server_port}')
+
+    def close(self):
+        self.server.shutdown()
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of sorted `values`"""
+    if not values:
+        return 0.0
+    rank = math.ceil(pct / 100.0 * len(values)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def measure(target, path, headers, requests=200, concurrency=1, warmup=10):
+    for _ in range(warmup):
+        target.get(path, headers)
+
+    def timed(_):
+        start = time.perf_counter()
+        status, queries = target.get(path, headers)
+        return time.perf_counter() - start, status, queries
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(timed, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(latency for latency, status, queries in results)
+    queries = [queries for latency, status, queries in results if queries is not None]
+    statuses = {}
+    for latency, status, _ in results:
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'rps': round(requests / elapsed, 1) if elapsed else 0.0,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else None,
+        'status': statuses,
+    }
+
+
+def run(target, paths, token, requests=200, concurrency=1, report=None):
+    """Benchmark every route of `paths` against `target`"""
+    headers = {'x-access-tokens': token}
+    results = {}
+    for name, path in paths.items():
+        results[name] = measure(target, path, headers, requests, concurrency)
+        if report:
+            report(target.name, name, results[name])
+    return results
+
+
+def compare(current, baseline, tolerance=0.2):
+    """Regressions of `current` against `baseline` results.
+
+    A route regresses when its p95 latency grew, or its throughput
+    dropped, by more than `tolerance`, or it runs more queries than before.
+    Routes measured at a different concurrency are not compared.
+    """
+    regressions = []
+    for target, routes_ in current['targets'].items():
+        for name, metrics in routes_.items():
+            before = baseline.get('targets', {}).get(target, {}).get(name)
+            if not before or before.get('concurrency') != metrics.get('concurrency'):
+                continue
+            label = f'{target} {name}'
+            if metrics['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+                regressions.append(f"{label}: p95 {before['p95_ms']}ms -> {metrics['p95_ms']}ms")
+            if metrics['rps'] < before['rps'] * (1 - tolerance):
+                regressions.append(f"{label}: {before['rps']} -> {metrics['rps']} requests/s")
+            if None not in (metrics['queries_per_request'], before['queries_per_request']) and \
+                    metrics['queries_per_request'] > before['queries_per_request']:
+                regressions.append(
+                    f"{label}: {before['queries_per_request']} -> {metrics['queries_per_request']} queries/request")
+    return regressions
+
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
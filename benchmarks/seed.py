@@ -0,0 +1,127 @@
+"""Seed the benchmark database with a synthetic catalog for the benchmarks.
+
+Every seeded row is named with the `bench` prefix or numbered from week
+1000 on and is removed before seeding again. Those rules could match real
+rows, so seeding, clearing and reading seeded ids refuse to run unless the
+models are bound to the dedicated BENCH_DATABASE.
+"""
+import random
+import uuid
+
+from peewee import chunked
+
+from application import models
+from application.config import Config
+
+PREFIX = 'bench'
+UNITS = ('g', 'ml', 'unit', 'clove', 'tbsp', 'pinch')
+# distinct ingredient names recipes draw theirs from
+VOCABULARY = 2000
+
+
+class SeedError(RuntimeError):
+    """Raised when the models are not bound to the benchmark database"""
+
+
+def check_database():
+    """Refuse to touch any database but the dedicated benchmark one"""
+    database = Config.BENCH_DATABASE
+    if not database:
+        raise SeedError("BENCH_DATABASE is not set, the benchmarks only seed a dedicated database")
+    if models.db.obj is None or models.db.database != database:
+        raise SeedError(f"the models are not bound to the benchmark database {database!r}")
+
+
+def clear():
+    """Delete every row created by a previous seed"""
+    check_database()
+    recipes = models.Recipe.select(models.Recipe.id).where(models.Recipe.recipe_name.startswith(PREFIX))
+    menus = models.WeeklyMenu.select(models.WeeklyMenu.id).where(models.WeeklyMenu.week_number >= 1000)
+    customers = models.Customer.select(models.Customer.id).where(models.Customer.name.startswith(PREFIX))
+    with models.db.atomic():
+        models.WeeklyMenuReview.delete().where(
+            models.WeeklyMenuReview.menu.in_(menus) | models.WeeklyMenuReview.customer.in_(customers)).execute()
+        models.WeeklyMenuScore.delete().where(models.WeeklyMenuScore.menu.in_(menus)).execute()
+        models.RecipeReview.delete().where(
+            models.RecipeReview.recipe.in_(recipes) | models.RecipeReview.customer.in_(customers)).execute()
+        models.RecipeRating.delete().where(models.RecipeRating.recipe.in_(recipes)).execute()
+        models.WeeklyRecipeMap.delete().where(
+            models.WeeklyRecipeMap.recipe.in_(recipes) | models.WeeklyRecipeMap.week.in_(menus)).execute()
+        models.Ingredient.delete().where(models.Ingredient.recipe.in_(recipes)).execute()
+        models.RecipeSearch.delete().where(models.RecipeSearch.recipe.in_(recipes)).execute()
+        models.RecipeNutrition.delete().where(models.RecipeNutrition.recipe.in_(recipes)).execute()
+        models.Recipe.delete().where(models.Recipe.recipe_name.startswith(PREFIX)).execute()
+        models.RecipeClassification.delete().where(models.RecipeClassification.name.startswith(PREFIX)).execute()
+        models.WeeklyMenu.delete().where(models.WeeklyMenu.week_number >= 1000).execute()
+        models.Customer.delete().where(models.Customer.name.startswith(PREFIX)).execute()
+
+
+def seed(recipes=1000, ingredients=10, menus=10, recipes_per_menu=20, reviews=50, seed=0):
+    """Create `recipes` recipes with `ingredients` ingredients each and `menus`
+    weekly menus (week numbers from 1000 on) holding `recipes_per_menu`
+    recipes and `reviews` reviews each. Returns the ids the runner needs.
+    """
+    rnd = random.Random(seed)
+    clear()
+    with models.db.atomic():
+        classification_ids = [row.id for row in models.RecipeClassification.insert_many(
+            [{'name': f'{PREFIX} {i}', 'is_publish': True} for i in range(5)]
+        ).returning(models.RecipeClassification.id).execute()]
+
+        recipe_ids = []
+        for batch in chunked(range(recipes), 500):
+            recipe_ids.extend(row.id for row in models.Recipe.insert_many([{
+                'recipe_name': f'{PREFIX} recipe {i}',
+                'description': f'{PREFIX} description {i}',
+                'directions': f'{PREFIX} directions {i}',
+                'is_publish': True,
+                'nutrition': {'Energy (kJ)': f'{rnd.randint(1500, 4000)} kJ', 'Protein': f'{rnd.randint(5, 60)} g'},
+                'classification': rnd.choice(classification_ids),
+            } for i in batch]).returning(models.Recipe.id).execute())
+
+        rows = ({'ingredient_name': f'{PREFIX} ingredient {j}', 'unit': rnd.choice(UNITS),
+                 'count': rnd.randint(1, 500), 'recipe': recipe_id}
+                for recipe_id in recipe_ids for j in rnd.sample(range(VOCABULARY), min(ingredients, VOCABULARY)))
+        for batch in chunked(rows, 2000):
+            models.Ingredient.insert_many(batch).as_rowcount().execute()
+
+        customer_ids = [row.id for row in models.Customer.insert_many([{
+            'public_id': uuid.uuid4(), 'name': f'{PREFIX} customer {i}', 'password': '', 'is_active': True,
+        } for i in range(reviews)]).returning(models.Customer.id).execute()]
+
+        menu_ids = [row.id for row in models.WeeklyMenu.insert_many(
+            [{'week_number': 1000 + i, 'is_publish': True} for i in range(menus)]
+        ).returning(models.WeeklyMenu.id).execute()]
+        for menu_id in menu_ids:
+            picked = rnd.sample(recipe_ids, min(recipes_per_menu, len(recipe_ids)))
+            models.WeeklyRecipeMap.insert_many(
+                [{'week': menu_id, 'recipe': recipe_id} for recipe_id in picked]).as_rowcount().execute()
+            models.WeeklyMenuReview.insert_many([{
+                'menu': menu_id, 'customer': customer_id, 'score': rnd.randint(1, 5),
+                'summary': f'{PREFIX} summary', 'review': f'{PREFIX} review',
+            } for customer_id in customer_ids]).as_rowcount().execute()
+            models.RecipeReview.insert_many([{
+                'recipe': recipe_id, 'customer': rnd.choice(customer_ids), 'score': rnd.randint(1, 5),
+                'summary': f'{PREFIX} summary', 'review': f'{PREFIX} review',
+            } for recipe_id in picked]).on_conflict_ignore().as_rowcount().execute()
+    models.WeeklyMenuScore.rebuild()
+    models.RecipeRating.rebuild()
+    models.RecipeSearch.refresh(*recipe_ids)
+    models.RecipeNutrition.refresh(*recipe_ids)
+    models.WriteVersion.bump(models.RecipeClassification, models.Recipe, models.Ingredient, models.Customer,
+                             models.WeeklyMenu, models.WeeklyRecipeMap, models.RecipeReview, models.WeeklyMenuReview,
+                             models.RecipeRating)
+    return {'recipes': recipe_ids, 'menus': menu_ids, 'classifications': classification_ids}
+
+
+def seeded():
+    """The ids of a previous seed, without seeding again"""
+    check_database()
+    def ids(query):
+        return [row.id for row in query.order_by(query.model.id)]
+    return {
+        'recipes': ids(models.Recipe.select(models.Recipe.id).where(models.Recipe.recipe_name.startswith(PREFIX))),
+        'menus': ids(models.WeeklyMenu.select(models.WeeklyMenu.id).where(models.WeeklyMenu.week_number >= 1000)),
+        'classifications': ids(models.RecipeClassification.select(models.RecipeClassification.id).where(
+            models.RecipeClassification.name.startswith(PREFIX))),
+    }
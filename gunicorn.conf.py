@@ -0,0 +1,5 @@
+# Read by `gunicorn wsgi:app` when started from the project root, the same
+# settings `python manage.py serve` uses.
+from application.server import options
+
+globals().update(options())
@@ -43,6 +43,17 @@ def configure_app(config):
         setenv(key, value)
 
 
+def init_db():
+    """Configure the environment and bind the models to its database"""
+    configure_app(os.getenv("APPLICATION_CONFIG"))
+
+    from application import models
+    from application.config import settings
+
+    models.init_db(settings(os.getenv("FLASK_CONFIG")))
+    return models
+
+
 @click.group()
 def cli():
     pass
@@ -137,6 +148,162 @@ def create_initial_db():
         )
 
 
+@cli.command()
+@click.option("--bind", help="Address to listen on, SERVER_BIND by default")
+@click.option("--workers", type=int, help="Worker processes, one per CPU by default")
+@click.option("--threads", type=int, help="Threads per worker, SERVER_THREADS by default")
+def serve(bind, workers, threads):
+    configure_app(os.getenv("APPLICATION_CONFIG"))
+
+    from application.server import Server, options
+
+    def factory():
+        from application.app import create_app
+
+        return create_app(os.getenv("FLASK_CONFIG"))
+
+    Server(factory, options(bind=bind, workers=workers, threads=threads)).run()
+
+
+@cli.command()
+@click.option("--list", "list_only", is_flag=True, help="Show the migrations and whether they are applied")
+def migrate(list_only):
+    init_db()
+
+    from application import migrations
+
+    if list_only:
+        applied = migrations.applied()
+        for version, function in migrations.versions():
+            print(f"{version:4} {function.__name__:30} {'applied' if version in applied else 'pending'}")
+        return
+    names = migrations.migrate()
+    print(f"Applied {len(names)} migrations: {', '.join(names)}" if names else "Database schema is up to date")
+
+
+@cli.command()
+def rebuild_scores():
+    models = init_db()
+
+    menus = models.WeeklyMenuScore.rebuild()
+    print(f"Rebuilt weekly menu scores for {menus} menus")
+
+
+@cli.command()
+def rebuild_ratings():
+    models = init_db()
+
+    recipes = models.RecipeRating.rebuild()
+    print(f"Rebuilt ratings for {recipes} recipes")
+
+
+@cli.command()
+def rebuild_search():
+    models = init_db()
+
+    recipes = models.RecipeSearch.rebuild()
+    print(f"Rebuilt search documents for {recipes} recipes")
+
+
+@cli.command()
+def rebuild_nutrition():
+    models = init_db()
+
+    recipes = models.RecipeNutrition.rebuild()
+    print(f"Rebuilt nutrition values for {recipes} recipes")
+
+
+@cli.command("import")
+@click.argument("paths", nargs=-1, required=True, type=click.Path(exists=True))
+@click.option("--batch-size", default=1000, show_default=True, help="Documents per transaction")
+def import_catalog(paths, batch_size):
+    init_db()
+
+    from application import catalog
+
+    def report(path, error):
+        print(f"Skipping {path}: {error}")
+
+    stats = catalog.load(paths, batch_size=batch_size, on_error=report)
+    print(
+        f"Imported {stats['documents']} documents: {stats['classifications']} classifications, "
+        f"{stats['recipes']} recipes, {stats['ingredients']} ingredients, {stats['errors']} errors "
+        f"in {stats['seconds']:.2f}s ({stats['rows_per_second']:.0f} rows/s)"
+    )
+
+
+@cli.command()
+@click.option("--recipes", default=1000, show_default=True, help="Seeded recipes")
+@click.option("--ingredients", default=10, show_default=True, help="Ingredients per recipe")
+@click.option("--menus", default=10, show_default=True, help="Seeded weekly menus")
+@click.option("--reviews", default=50, show_default=True, help="Reviews per weekly menu")
+@click.option("--requests", "requests_per_route", default=200, show_default=True, help="Requests per route")
+@click.option("--concurrency", default=1, show_default=True, help="Concurrent clients")
+@click.option("--target", "targets", multiple=True, type=click.Choice(["flask", "wsgi"]),
+              help="In-process targets, both by default")
+@click.option("--url", help="Benchmark a running server instead of the in-process targets")
+@click.option("--no-seed", is_flag=True, help="Reuse the previously seeded rows")
+@click.option("--output", default="bench_output.json", show_default=True, type=click.Path())
+@click.option("--baseline", type=click.Path(exists=True), help="Results to compare against")
+@click.option("--tolerance", default=0.2, show_default=True, help="Allowed p95/throughput change")
+def bench(recipes, ingredients, menus, reviews, requests_per_route, concurrency, targets, url, no_seed,
+          output, baseline, tolerance):
+    configure_app(os.getenv("APPLICATION_CONFIG"))
+
+    from application import migrations, models
+    from application.app import create_app
+    from benchmarks import runner, seed
+
+    app = create_app(os.getenv("FLASK_CONFIG"))
+    if not app.config["BENCH_DATABASE"]:
+        raise click.ClickException("Set BENCH_DATABASE to a dedicated database, the seed deletes rows that may be real")
+    app.config["POSTGRES_DB"] = app.config["BENCH_DATABASE"]
+    models.init_db(app.config)
+    applied = migrations.migrate()
+    if applied:
+        print(f"Applied {len(applied)} migrations to {app.config['BENCH_DATABASE']}: {', '.join(applied)}")
+    volumes = {"recipes": recipes, "ingredients": ingredients, "menus": menus, "reviews": reviews}
+    if no_seed:
+        ids = seed.seeded()
+    else:
+        ids = seed.seed(recipes=recipes, ingredients=ingredients, menus=menus, reviews=reviews)
+    if not ids["recipes"]:
+        raise click.ClickException("No seeded rows, run without --no-seed first")
+    paths = runner.routes(ids)
+    token = runner.bench_token(app)
+
+    if url:
+        targets = [runner.HTTPTarget(url)]
+    else:
+        targets = [runner.FlaskTarget(app) if name == "flask" else runner.WSGITarget(app)
+                   for name in targets or ("flask", "wsgi")]
+
+    def report(target, route, metrics):
+        print(
+            f"{target:6} {route:26} p50 {metrics['p50_ms']:8.2f}ms  p95 {metrics['p95_ms']:8.2f}ms  "
+            f"p99 {metrics['p99_ms']:8.2f}ms  {metrics['rps']:8.1f} req/s  "
+            f"{metrics['queries_per_request'] if metrics['queries_per_request'] is not None else '-'} queries"
+            + "".join(f"  {count}x{status}" for status, count in sorted(metrics["status"].items()) if status != "200")
+        )
+
+    results = {"volumes": volumes, "targets": {}}
+    for target in targets:
+        try:
+            results["targets"][target.name] = runner.run(
+                target, paths, token, requests=requests_per_route, concurrency=concurrency, report=report)
+        finally:
+            target.close()
+    runner.save(results, output)
+    print(f"Results written to {output}")
+
+    if baseline:
+        regressions = runner.compare(results, runner.load(baseline), tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            raise SystemExit(1)
+
+
 @cli.command()
 @click.argument("filenames", nargs=-1)
 def test(filenames):
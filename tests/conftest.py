@@ -0,0 +1,47 @@
+import os
+from datetime import datetime, timedelta
+
+import jwt
+import pytest
+
+from application import migrations, models
+from application.app import create_app
+from application.config import settings
+
+
+@pytest.fixture(scope='session')
+def database():
+    """The development database, its schema brought up to date once per session"""
+    models.init_db(settings("development"))
+    migrations.migrate()
+    return models.db
+
+
+def getLoginToken():
+    """Login helper function"""
+    user = models.Users.get(models.Users.name == 'user')
+    token = jwt.encode(
+        {'public_id': str(user.public_id), 'exp': datetime.utcnow() + timedelta(minutes=30)},
+        os.getenv('SECRET_KEY'))
+    return token
+
+
+@pytest.fixture(scope='session')
+def auth(database):
+    """Token of the login user"""
+    return getLoginToken()
+
+
+@pytest.fixture
+def mock_request_headers(auth):
+    """Request headers carrying the token of the login user, a fresh dict per test"""
+    return {"Content-Type": "application/json", "x-access-tokens": auth}
+
+
+@pytest.fixture
+def client(database):
+    app = create_app("Development")
+    app.config['QUERY_BUDGET_STRICT'] = True
+
+    with app.test_client() as client:
+        yield client
@@ -0,0 +1,93 @@
+import threading
+import time
+
+import pytest
+
+from application.admission import ConcurrencyLimiter, RateLimiter
+from application.app import create_app
+from application.config import DevelopmentConfig
+
+
+def test_concurrency_limiter_queues_then_sheds():
+    limiter = ConcurrencyLimiter(1, queue=1, timeout=5)
+    assert limiter.acquire()
+    admitted = []
+    waiter = threading.Thread(target=lambda: admitted.append(limiter.acquire()))
+    waiter.start()
+    while not limiter.waiting:
+        time.sleep(0.001)
+    assert not limiter.acquire()  # the queue is full
+    limiter.release()
+    waiter.join()
+    assert admitted == [True]
+    limiter.release()
+    assert limiter.stats == {'limit': 1, 'queue': 1, 'in_flight': 0, 'waiting': 0, 'admitted': 2, 'queued': 1,
+                             'shed': 1, 'timed_out': 0}
+
+
+def test_concurrency_limiter_deadline():
+    limiter = ConcurrencyLimiter(1, queue=4, timeout=0.01)
+    assert limiter.acquire()
+    assert not limiter.acquire()
+    assert limiter.stats['timed_out'] == limiter.stats['shed'] == 1
+    assert ConcurrencyLimiter(0).acquire()
+
+
+def test_rate_limiter_refills():
+    limiter = RateLimiter(rate=100, burst=2)
+    assert limiter.take('a') == limiter.take('a') == 0
+    wait = limiter.take('a')
+    assert 0 < wait <= 0.01
+    assert limiter.take('b') == 0  # buckets are per key
+    time.sleep(wait)
+    assert limiter.take('a') == 0
+    assert RateLimiter(rate=0, burst=0).take('a') == 0
+
+
+@pytest.fixture
+def limited_app(monkeypatch, database):
+    monkeypatch.setattr(DevelopmentConfig, 'MAX_IN_FLIGHT', 1)
+    monkeypatch.setattr(DevelopmentConfig, 'ADMISSION_QUEUE', 0)
+    monkeypatch.setattr(DevelopmentConfig, 'RATE_LIMIT_PER_SECOND', 0.01)
+    monkeypatch.setattr(DevelopmentConfig, 'RATE_LIMIT_BURST', 2)
+    app = create_app("Development")
+    release = threading.Event()
+
+    @app.route('/test/slow')
+    def slow():
+        release.wait(5)
+        return 'done'
+
+    yield app, release
+    release.set()
+
+
+def test_load_shedding(limited_app, mock_request_headers):
+    app, release = limited_app
+    responses = []
+    worker = threading.Thread(target=lambda: responses.append(app.test_client().get('/test/slow')))
+    worker.start()
+    client = app.test_client()
+    while not client.get('/metrics').get_data(as_text=True).count('admission_in_flight 1'):
+        time.sleep(0.001)
+    shed = client.get('/api/v1/recipes-classification', headers=mock_request_headers)
+    assert shed.status_code == 503
+    assert shed.headers['Retry-After'] == '1'
+    assert shed.headers['X-Query-Count'] == '0'
+    release.set()
+    worker.join()
+    assert responses[0].status_code == 200
+    stats = client.get('/api/v1/stats', headers=mock_request_headers).json
+    assert stats['admission']['shed'] == 1
+    assert stats['admission']['in_flight'] == 1  # the stats request itself
+
+
+def test_rate_limit(limited_app, mock_request_headers):
+    app, _ = limited_app
+    client = app.test_client()
+    statuses = [client.get('/api/v1/recipes-classification', headers=mock_request_headers).status_code
+                for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    limited = client.get('/api/v1/stats', headers=mock_request_headers)
+    assert limited.status_code == 429
+    assert int(limited.headers['Retry-After']) > 1
@@ -0,0 +1,59 @@
+import pytest
+
+from application.app import create_app
+from application.config import Config
+from benchmarks import runner, seed
+
+
+def test_percentile():
+    '''nearest rank percentiles of sorted latencies'''
+    values = [i / 1000 for i in range(1, 101)]
+    assert runner.percentile(values, 50) == 0.05
+    assert runner.percentile(values, 95) == 0.095
+    assert runner.percentile(values, 99) == 0.099
+    assert runner.percentile([], 95) == 0.0
+
+
+def test_compare():
+    """
+    GIVEN benchmark results and a baseline
+    WHEN they are compared
+    THEN slower, lower throughput or chattier routes are reported
+    """
+    baseline = {'targets': {'flask': {
+        'recipes.page': {'p95_ms': 10.0, 'rps': 100.0, 'queries_per_request': 3, 'concurrency': 1},
+        'recipes.get': {'p95_ms': 10.0, 'rps': 100.0, 'queries_per_request': 2, 'concurrency': 1},
+    }}}
+    current = {'targets': {'flask': {
+        'recipes.page': {'p95_ms': 11.0, 'rps': 95.0, 'queries_per_request': 3, 'concurrency': 1},
+        'recipes.get': {'p95_ms': 15.0, 'rps': 70.0, 'queries_per_request': 4, 'concurrency': 1},
+        'weekly_menu.get': {'p95_ms': 50.0, 'rps': 10.0, 'queries_per_request': 9, 'concurrency': 1},
+    }}}
+    '''within tolerance and routes missing from the baseline are not regressions'''
+    regressions = runner.compare(current, baseline, tolerance=0.2)
+    assert len(regressions) == 3
+    assert all(regression.startswith('flask recipes.get') for regression in regressions)
+    assert runner.compare(current, baseline, tolerance=1.0) == ['flask recipes.get: 2 -> 4 queries/request']
+
+
+def test_measure(database):
+    '''the test client target records latency, throughput and queries per request'''
+    app = create_app("Development")
+    headers = {'x-access-tokens': runner.bench_token(app)}
+    metrics = runner.measure(runner.FlaskTarget(app), '/api/v1/recipes/1', headers, requests=5, warmup=1)
+    assert metrics['status'] == {'200': 5}
+    assert metrics['p50_ms'] <= metrics['p95_ms'] <= metrics['p99_ms']
+    assert metrics['rps'] > 0
+    assert metrics['queries_per_request'] >= 1
+
+
+def test_seed_refuses_other_databases(monkeypatch, database):
+    """the seed only clears rows of the dedicated benchmark database"""
+    monkeypatch.setattr(Config, 'BENCH_DATABASE', None)
+    with pytest.raises(seed.SeedError):
+        seed.clear()
+    monkeypatch.setattr(Config, 'BENCH_DATABASE', 'bench_elsewhere')
+    with pytest.raises(seed.SeedError):
+        seed.seed(recipes=1)
+    with pytest.raises(seed.SeedError):
+        seed.seeded()
@@ -0,0 +1,72 @@
+import os
+
+import pytest
+
+from application import catalog
+from application.models import Ingredient, Recipe, RecipeClassification, db
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'data')
+
+DOCUMENT = '''#type -->
+{ "is_publish": true, "name": "Catalog test type" }
+
+#recipe -->
+{ "recipe_name": "Catalog test recipe", "classification": 1, "nutrition": {"Protein": "30 g"} }
+
+#ingredient -->
+[{ "ingredient_name": " garlic ", "unit": "clove", "count": 2 }, { "ingredient_name": "salt" }]
+'''
+
+
+def test_parse_document():
+    sections = catalog.parse_document(DOCUMENT)
+    assert [kind for kind, payloads in sections] == ['classification', 'recipe', 'ingredient']
+    assert len(sections[2][1]) == 2
+
+    with pytest.raises(catalog.CatalogError):
+        catalog.parse_document('#unknown -->\n{}')
+    with pytest.raises(catalog.CatalogError):
+        catalog.parse_document('#recipe -->\n{ "recipe_name": ')
+
+
+def test_parse_sample_data():
+    for path in catalog.iter_files([DATA]):
+        with open(path, encoding='utf-8') as f:
+            kinds = [kind for kind, payloads in catalog.parse_document(f.read())]
+        assert kinds == ['classification', 'recipe']
+
+
+def test_load(tmp_path, database):
+    (tmp_path / 'test.json').write_text(DOCUMENT)
+    with db.atomic() as transaction:
+        stats = catalog.load([DATA, str(tmp_path)], batch_size=3)
+        assert stats['recipes'] == 8
+        assert stats['errors'] == 0
+
+        recipe = Recipe.get(Recipe.recipe_name == 'Catalog test recipe')
+        assert recipe.classification.name == 'Catalog test type'
+        assert sorted(i.ingredient_name for i in Ingredient.select().where(Ingredient.recipe == recipe)) == \
+            ['garlic', 'salt']
+
+        '''reloading updates in place'''
+        count = Recipe.select().count()
+        stats = catalog.load([DATA, str(tmp_path)])
+        assert Recipe.select().count() == count
+        assert RecipeClassification.select().where(RecipeClassification.name == 'Veggis').count() == 1
+        transaction.rollback()
+
+
+def test_load_skips_invalid_rows(tmp_path, database):
+    """A row its column would reject is counted as an error, the rest of its batch is written"""
+    (tmp_path / 'test.json').write_text(DOCUMENT.replace('"salt"', '"salt", "count": "a pinch"'))
+    (tmp_path / 'bad.json').write_text(DOCUMENT.replace('Catalog test recipe', 'Catalog bad recipe').replace(
+        '"classification": 1', '"classification": 1, "cook_time": "forever"').split('#ingredient')[0])
+    with db.atomic() as transaction:
+        stats = catalog.load([str(tmp_path)])
+        assert stats['errors'] == 2
+        assert stats['recipes'] == 1
+
+        recipe = Recipe.get(Recipe.recipe_name == 'Catalog test recipe')
+        assert [i.ingredient_name for i in Ingredient.select().where(Ingredient.recipe == recipe)] == ['garlic']
+        assert not Recipe.select().where(Recipe.recipe_name == 'Catalog bad recipe').exists()
+        transaction.rollback()
@@ -1,37 +1,13 @@
 import datetime
 import json
+import threading
 from application.app import *
-from application.models import Users,db
+from application.models import Users,Ingredient,RecipeSearch,Recipe,RecipeClassification,RecipeRating,RecipeReview,Customer,WeeklyMenu,WeeklyMenuReview,WeeklyMenuScore,WeeklyRecipeMap,db
 import pytest
 import jwt
 import os
  
 
-@pytest.fixture
-def client():
-    app = create_app("Development")
-
-    with app.test_client() as client:
-        # with app.app_context():
-            # init_db()
-        yield client
-
-
-
-
-def getLoginToken():
-    """Login helper function"""
-    user = Users.get(Users.name == 'user')
-    token = jwt.encode(
-        {'public_id': str(user.public_id), 'exp': datetime.utcnow() + timedelta(minutes=30)},
-        os.getenv('SECRET_KEY'))
-    return token
-
-
-auth_token = getLoginToken()
-mock_request_headers = {"Content-Type": "application/json", "x-access-tokens": auth_token}
-
-
 def test_root_404(client):
     url = '/'
     response = client.get(url)
@@ -39,7 +15,7 @@ def test_root_404(client):
     assert response.status_code == 404
 
 
-def test_recipe(client):
+def test_recipe(client, mock_request_headers):
     url = '/api/v1/recipes'
     response = client.get(url, headers=mock_request_headers)
     assert response.status_code == 200
@@ -70,7 +46,18 @@ def test_recipe(client):
     assert response.status_code == 204
 
 
-def test_ingredient(client):
+def test_recipe_list_serialization(client, mock_request_headers):
+    """Batched list serialization matches per row serialization"""
+    url = '/api/v1/recipes/1'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    res = json.loads(response.data.decode())
+    for recipe in res["recipes"]:
+        expected = json.loads(json.dumps(Recipe.get_by_id(recipe["id"]).serialize))
+        assert recipe == expected
+
+
+def test_ingredient(client, mock_request_headers):
     """Get all"""
     url = 'api/v1/ingredient'
     response = client.get(url, headers=mock_request_headers)
@@ -102,7 +89,7 @@ def test_ingredient(client):
     assert response.status_code == 204
 
 
-def test_classification(client):
+def test_classification(client, mock_request_headers):
     """Get all"""
     url = 'api/v1/recipes-classification'
     response = client.get(url, headers=mock_request_headers)
@@ -131,7 +118,7 @@ def test_classification(client):
     assert response.status_code == 204
 
 
-def test_user(client):
+def test_user(client, mock_request_headers):
     """Get all"""
     url = '/api/v1/user'
     response = client.get(url, headers=mock_request_headers)
@@ -153,3 +140,720 @@ def test_user(client):
         url = '/api/v1/user'
         response = client.get(url, headers={"x-access-tokens": token, "Content-Type": "application/json"})
         assert response.status_code == 200
+
+
+def test_weekly_menu_score(client, mock_request_headers):
+    """Menu score follows review writes"""
+    menu = WeeklyMenu.create(week_number=52)
+    customers = [Customer.create(public_id=uuid.uuid4(), name=f"score customer {i}", password="x", is_active=True)
+                 for i in range(2)]
+
+    url = '/api/v1/weekly-menu-review'
+    ids = []
+    for customer, score in zip(customers, (4, 5)):
+        mock_request_data = {"menu": menu.id, "customer": customer.id, "score": score, "summary": "ok", "review": "ok"}
+        response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+        assert response.status_code == 201
+        ids.append(json.loads(response.data.decode())["weekly-menu-review"][0]["id"])
+
+    url = f'/api/v1/weekly-menu/id/{menu.id}'
+    response = client.get(url, headers=mock_request_headers)
+    assert json.loads(response.data.decode())["weekly-menu"][0]["score"] == 4.5
+
+    '''update and unpublish'''
+    response = client.put(f'/api/v1/weekly-menu-review/id/{ids[0]}', data=json.dumps({"score": 2}),
+                          headers=mock_request_headers)
+    assert response.status_code == 200
+    response = client.delete(f'/api/v1/weekly-menu-review/id/{ids[1]}', headers=mock_request_headers)
+    assert response.status_code == 204
+
+    response = client.get(url, headers=mock_request_headers)
+    assert json.loads(response.data.decode())["weekly-menu"][0]["score"] == 2
+
+    WeeklyMenuScore.rebuild()
+    assert WeeklyMenuScore.get_by_id(menu.id).histogram == {"1": 0, "2": 1, "3": 0, "4": 0, "5": 0}
+
+
+@pytest.mark.parametrize('kind', ['weekly-menu', 'recipe'])
+def test_review_concurrent_unpublish(client, mock_request_headers, kind):
+    """A review unpublished by two writers at once leaves its score in the rollup once"""
+    customer = Customer.create(public_id=uuid.uuid4(), name=f"{kind} race customer", password="x", is_active=True)
+    if kind == 'weekly-menu':
+        model, rollup, parent = WeeklyMenuReview, WeeklyMenuScore, WeeklyMenu.create(week_number=49)
+        payload = {"menu": parent.id}
+    else:
+        model, rollup, parent = RecipeReview, RecipeRating, Recipe.create(
+            recipe_name="race recipe", classification=RecipeClassification.get_by_id(1), nutrition={})
+        payload = {"recipe": parent.id}
+    response = client.post(f'/api/v1/{kind}-review', headers=mock_request_headers, data=json.dumps(
+        dict(payload, customer=customer.id, score=4, summary="ok", review="ok")))
+    review = json.loads(response.data.decode())[f"{kind}-review"][0]["id"]
+
+    locked, release = threading.Event(), threading.Event()
+
+    def other_writer():
+        with db.atomic():
+            row = model.select().where(model.id == review).for_update().get()
+            locked.set()
+            release.wait(5)
+            before = row.score_state
+            row.is_publish = False
+            row.save()
+            rollup.review_changed(before, row.score_state)
+        db.close()
+
+    writer = threading.Thread(target=other_writer)
+    writer.start()
+    locked.wait(5)
+    responses = []
+    deleter = threading.Thread(target=lambda: responses.append(client.application.test_client().delete(
+        f'/api/v1/{kind}-review/id/{review}', headers=mock_request_headers)))
+    deleter.start()
+    deleter.join(0.2)
+    assert deleter.is_alive()  # waits for the row lock
+    release.set()
+    writer.join()
+    deleter.join()
+    assert responses[0].status_code == 404
+    assert rollup.get_by_id(parent.id).score_count == 0
+
+
+def test_principal_cache(client, mock_request_headers):
+    """Repeated requests with the same token are served from the principal cache"""
+    url = '/api/v1/stats'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    response = client.get(url, headers=mock_request_headers)
+    stats = json.loads(response.data.decode())["principal_cache"]
+    assert stats["misses"] == 1
+    assert stats["hits"] >= 1
+
+
+def test_principal_cache_eviction(client, mock_request_headers):
+    """A deleted principal is rejected by the next request, not after the cache TTL"""
+    user = Users.create(public_id=uuid.uuid4(), name="evicted user", password="x")
+    headers = dict(mock_request_headers, **{"x-access-tokens": jwt.encode(
+        {'public_id': str(user.public_id), 'exp': datetime.utcnow() + timedelta(minutes=30)}, os.getenv('SECRET_KEY'))})
+    assert client.get('/api/v1/stats', headers=headers).status_code == 200
+    assert client.get('/api/v1/stats', headers=headers).status_code == 200
+
+    user.delete_instance()
+    assert client.get('/api/v1/stats', headers=headers).status_code == 403
+
+
+def test_cursor_pagination(client, mock_request_headers):
+    """Walking the next cursors returns every row of the offset pages, a
+    last page that is exactly full offers no next cursor
+    """
+    url = '/api/v1/recipes/1?per_page=100'
+    response = client.get(url, headers=mock_request_headers)
+    expected = [i["id"] for i in json.loads(response.data.decode())["recipes"]]
+
+    for per_page in (3, len(expected) // 2, len(expected)):
+        ids = []
+        url = f'/api/v1/recipes?per_page={per_page}'
+        while url:
+            response = client.get(url, headers=mock_request_headers)
+            assert response.status_code == 200
+            res = json.loads(response.data.decode())
+            assert len(res["recipes"]) <= per_page
+            ids.extend(i["id"] for i in res["recipes"])
+            cursor = res["meta"]["next"]
+            url = f'/api/v1/recipes?per_page={per_page}&cursor={cursor}' if cursor else None
+        assert ids == expected
+
+    response = client.get(f'/api/v1/recipes?per_page={len(expected)}', headers=mock_request_headers)
+    assert response.status_code == 200
+    assert json.loads(response.data.decode())["meta"]["next"] is None
+
+    response = client.get('/api/v1/recipes?cursor=bogus', headers=mock_request_headers)
+    assert response.status_code == 400
+
+
+def test_pool_stats(client, mock_request_headers):
+    """Requests check a pooled connection out and return it on teardown"""
+    url = '/api/v1/stats'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    pool = json.loads(response.data.decode())["db_pool"]
+    assert pool["in_use"] >= 1
+    assert db.is_closed()
+    assert db.stats["idle"] >= 1
+
+
+def test_bulk_ingredient(client, mock_request_headers):
+    """Bulk create through both routes, rejected payloads insert nothing"""
+    url = '/api/v1/ingredient'
+    mock_request_data = [
+        {"ingredient_name": "bulk garlic", "unit": "clove", "count": "2", "recipe": "3"},
+        {"ingredient_name": "bulk onion", "unit": "unit", "count": 1, "recipe": 3},
+    ]
+    response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+    assert response.status_code == 201
+    res = json.loads(response.data.decode())
+    assert [i["ingredient_name"] for i in res["Ingredient"]] == ["bulk garlic", "bulk onion"]
+    assert res["Ingredient"][0]["recipe"] == str(Recipe.get_by_id(3)).strip()
+
+    '''conflicts with the rows above'''
+    response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+    assert response.status_code == 409
+
+    '''recipe route, one invalid row rejects the batch'''
+    url = '/api/v1/recipes/id/4/ingredients'
+    mock_request_data = [{"ingredient_name": "bulk leek", "count": 1}, {"unit": "g"}]
+    response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+    assert response.status_code == 422
+    assert json.loads(response.data.decode())["errors"][0]["index"] == 1
+
+    response = client.post(url, data=json.dumps(mock_request_data[:1]), headers=mock_request_headers)
+    assert response.status_code == 201
+
+    '''an empty payload is invalid, an oversized one too large'''
+    response = client.post(url, data=json.dumps([]), headers=mock_request_headers)
+    assert response.status_code == 400
+    response = client.post(url, data=json.dumps(mock_request_data[:1] * (client.application.config['MAX_BULK_ROWS'] + 1)),
+                           headers=mock_request_headers)
+    assert response.status_code == 413
+
+
+def test_conditional_get(client, mock_request_headers):
+    """Unchanged resources are answered with 304 until a write bumps their version"""
+    url = '/api/v1/recipes'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    etag = response.headers["ETag"]
+    assert "no-cache" in response.headers["Cache-Control"]
+
+    headers = dict(mock_request_headers, **{"If-None-Match": etag})
+    response = client.get(url, headers=headers)
+    assert response.status_code == 304
+    assert response.data == b""
+
+    mock_request_data = {"classification": 1, "recipe_name": "ETag recipe", "nutrition": {}, "is_publish": True}
+    response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+    assert response.status_code == 201
+
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+
+
+def test_weekly_menu_conditional_get(client, mock_request_headers):
+    """Weekly menu ETags follow writes to the recipes they embed"""
+    recipe = Recipe.create(recipe_name="ETag menu recipe", classification=RecipeClassification.get_by_id(1),
+                           nutrition={}, is_publish=True)
+    menu = WeeklyMenu.create(week_number=1, is_publish=True)
+    WeeklyRecipeMap.create(week=menu, recipe=recipe)
+    url = f'/api/v1/weekly-menu/id/{menu.id}'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    assert "max-age" not in response.headers["Cache-Control"]
+
+    headers = dict(mock_request_headers, **{"If-None-Match": response.headers["ETag"]})
+    assert client.get(url, headers=headers).status_code == 304
+    response = client.put(f'/api/v1/recipes/id/{recipe.id}', data=json.dumps({"recipe_name": "ETag menu recipe 2"}),
+                          headers=mock_request_headers)
+    assert response.status_code == 200
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert json.loads(response.data.decode())["weekly-menu"][0]["recipes"][0]["recipe"]["recipe_name"] == \
+        "ETag menu recipe 2"
+
+
+def test_export(client, mock_request_headers):
+    """Exports stream one JSON document per row"""
+    url = '/api/v1/export/recipes'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    assert response.mimetype == 'application/x-ndjson'
+    rows = [json.loads(line) for line in response.data.decode().splitlines()]
+    assert len(rows) == Recipe.select().count()
+    assert [row["id"] for row in rows] == sorted(row["id"] for row in rows)
+
+    response = client.get(f'{url}?since_id={rows[0]["id"]}', headers=mock_request_headers)
+    assert len(response.data.decode().splitlines()) == len(rows) - 1
+
+    response = client.get('/api/v1/export/weekly-menu-reviews?since=2000-01-01', headers=mock_request_headers)
+    assert response.status_code == 200
+    assert response.data.decode().count("\n") == WeeklyMenuReview.select().count()
+    response = client.get(f'{url}?since=2000-01-01', headers=mock_request_headers)
+    assert response.status_code == 400
+    response = client.get('/api/v1/export/users', headers=mock_request_headers)
+    assert response.status_code == 404
+
+
+def test_export_query_budget(client, mock_request_headers, monkeypatch):
+    """The statements streaming an export count against its query_budget"""
+    view = client.application.view_functions['export_endpoint']
+    for _ in range(2):
+        response = client.get('/api/v1/export/recipes', headers=mock_request_headers)
+        assert len(response.data.decode().splitlines()) == Recipe.select().count()
+
+    '''the response headers only count the statements run before streaming'''
+    monkeypatch.setattr(view, 'query_budget', int(response.headers["X-Query-Count"]))
+    with pytest.raises(QueryBudgetExceeded):
+        client.get('/api/v1/export/recipes', headers=mock_request_headers).get_data()
+
+
+def test_query_count(client, mock_request_headers):
+    """Responses report the statements their request ran"""
+    response = client.get('/api/v1/recipes', headers=mock_request_headers)
+    assert response.status_code == 200
+    assert int(response.headers["X-Query-Count"]) >= 1
+    timings = response.headers.getlist("Server-Timing")
+    assert [timing.split(";")[0] for timing in timings] == ["db", "serialize", "total"]
+
+    '''in strict mode a view over its query budget fails the request'''
+    app = create_app("Development")
+    app.config.update(TESTING=True, QUERY_BUDGET_STRICT=True)
+
+    @app.route('/over-budget')
+    @query_budget(1)
+    def over_budget():
+        Users.select().count()
+        Recipe.select().count()
+        return jsonify({})
+
+    with pytest.raises(QueryBudgetExceeded):
+        app.test_client().get('/over-budget')
+    app.config['QUERY_BUDGET_STRICT'] = False
+    assert app.test_client().get('/over-budget').headers["X-Query-Count"] == "2"
+
+
+def test_metrics(client, mock_request_headers):
+    """/metrics exposes Prometheus counters and histograms per route"""
+    client.get('/api/v1/recipes', headers=mock_request_headers)
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+    text = response.data.decode()
+    assert 'http_requests_total{method="GET",route="/api/v1/recipes",status="200"} 1' in text
+    assert 'http_request_duration_seconds_count{method="GET",route="/api/v1/recipes"} 1' in text
+    assert 'http_request_duration_seconds_bucket{method="GET",route="/api/v1/recipes",le="+Inf"} 1' in text
+    assert 'http_request_db_queries_count{method="GET",route="/api/v1/recipes"} 1' in text
+    assert 'http_response_serialization_seconds_sum{method="GET",route="/api/v1/recipes"}' in text
+    '''the scrape itself is in flight'''
+    assert 'http_requests_in_flight 1' in text
+    assert 'db_pool_in_use ' in text
+
+
+def test_recipe_search(client, mock_request_headers):
+    """Search ranks recipe name matches above ingredient and description matches"""
+    url = '/api/v1/recipes'
+    for name, description in (("Smoky paprika stew", "Slow cooked"), ("Green salad", "With a paprika dressing")):
+        mock_request_data = {"classification": 1, "recipe_name": name, "description": description,
+                             "nutrition": {}, "is_publish": True}
+        response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+        assert response.status_code == 201
+    salad = json.loads(response.data.decode())["Recipe"][0]["id"]
+
+    response = client.get('/api/v1/recipes/search?q=paprika', headers=mock_request_headers)
+    assert response.status_code == 200
+    res = json.loads(response.data.decode())
+    assert [r["recipe_name"] for r in res["recipes"]] == ["Smoky paprika stew", "Green salad"]
+    assert res["recipes"][0]["rank"] > res["recipes"][1]["rank"]
+
+    '''ingredient writes update the search document'''
+    mock_request_data = {"ingredient_name": "croutons", "unit": "g", "count": 20, "recipe": salad}
+    response = client.post('/api/v1/ingredient', data=json.dumps(mock_request_data), headers=mock_request_headers)
+    assert response.status_code == 201
+    response = client.get('/api/v1/recipes/search?q=crouton', headers=mock_request_headers)
+    assert [r["id"] for r in json.loads(response.data.decode())["recipes"]] == [salad]
+
+    '''ranked cursor pagination'''
+    response = client.get('/api/v1/recipes/search?q=paprika&per_page=1', headers=mock_request_headers)
+    res = json.loads(response.data.decode())
+    assert res["recipes"][0]["recipe_name"] == "Smoky paprika stew"
+    response = client.get(f'/api/v1/recipes/search?q=paprika&per_page=1&cursor={res["meta"]["next"]}',
+                          headers=mock_request_headers)
+    assert [r["id"] for r in json.loads(response.data.decode())["recipes"]] == [salad]
+
+    response = client.get('/api/v1/recipes/search?q=', headers=mock_request_headers)
+    assert response.status_code == 400
+
+
+def test_ingredient_save_refreshes(client, monkeypatch):
+    """Moving an ingredient refreshes the search documents of both recipes, other edits only its own"""
+    classification = RecipeClassification.get_by_id(1)
+    recipes = [Recipe.create(recipe_name=f"Refresh recipe {i}", classification=classification, nutrition={},
+                             is_publish=True) for i in range(2)]
+    ingredient = Ingredient.create(ingredient_name="refresh salt", unit="g", count=1, recipe=recipes[0])
+    refreshed = []
+    monkeypatch.setattr(RecipeSearch, 'refresh', classmethod(lambda cls, *recipe_ids: refreshed.append(recipe_ids)))
+
+    ingredient.unit = "pinch"
+    db.reset_query_stats()
+    ingredient.save()
+    assert db.query_stats["queries"] == 1
+    assert refreshed == [(recipes[0].id, None)]
+
+    ingredient.recipe = recipes[1]
+    ingredient.save()
+    assert refreshed[-1] == (recipes[1].id, recipes[0].id)
+
+
+def test_recipe_coverage(client, mock_request_headers):
+    """Recipes are ranked by how many of the given ingredients they use"""
+    recipes = {}
+    for name, ingredients in (("Coverage pasta", ["Garlic", "  olive   OIL", "pasta", "basil"]),
+                              ("Coverage bread", ["garlic", "bread"]),
+                              ("Coverage soup", ["garlic ", "olive oil", "leek"])):
+        mock_request_data = {"classification": 1, "recipe_name": name, "nutrition": {}, "is_publish": True}
+        response = client.post('/api/v1/recipes', data=json.dumps(mock_request_data), headers=mock_request_headers)
+        recipes[name] = json.loads(response.data.decode())["Recipe"][0]["id"]
+        response = client.post(f'/api/v1/recipes/id/{recipes[name]}/ingredients',
+                               data=json.dumps([{"ingredient_name": i, "count": 1} for i in ingredients]),
+                               headers=mock_request_headers)
+        assert response.status_code == 201
+
+    url = '/api/v1/recipes/by-ingredients?required=GARLIC&optional=olive%20oil&optional=leek'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    res = json.loads(response.data.decode())
+    assert [r["recipe_name"] for r in res["recipes"]] == ["Coverage soup", "Coverage pasta", "Coverage bread"]
+    assert res["recipes"][0]["coverage"] == {"matched": 3, "missing": 0}
+    assert res["recipes"][1]["coverage"] == {"matched": 2, "missing": 2}
+
+    '''every required name has to match'''
+    response = client.get('/api/v1/recipes/by-ingredients?required=garlic&required=bread', headers=mock_request_headers)
+    assert [r["id"] for r in json.loads(response.data.decode())["recipes"]] == [recipes["Coverage bread"]]
+
+    '''ranked cursor pagination'''
+    response = client.get(url + '&per_page=2', headers=mock_request_headers)
+    next_page = json.loads(response.data.decode())["meta"]["next"]
+    response = client.get(f'{url}&per_page=2&cursor={next_page}', headers=mock_request_headers)
+    assert [r["id"] for r in json.loads(response.data.decode())["recipes"]] == [recipes["Coverage bread"]]
+
+    '''recipes sharing ingredients with a weekly menu'''
+    response = client.post('/api/v1/weekly-menu', data=json.dumps({"week_number": 40, "is_publish": True}),
+                           headers=mock_request_headers)
+    menu = json.loads(response.data.decode())["WeeklyMenu"][0]["id"]
+    response = client.post(f'/api/v1/weekly-menu/id/{menu}/recipe/id/{recipes["Coverage bread"]}',
+                           headers=mock_request_headers)
+    assert response.status_code in (200, 201)
+    response = client.get(f'/api/v1/recipes/by-ingredients?menu_id={menu}&required=olive%20oil',
+                          headers=mock_request_headers)
+    assert [r["id"] for r in json.loads(response.data.decode())["recipes"]] == \
+        [recipes["Coverage soup"], recipes["Coverage pasta"]]
+
+    response = client.get('/api/v1/recipes/by-ingredients', headers=mock_request_headers)
+    assert response.status_code == 400
+
+
+def test_recipe_nutrition_filter(client, mock_request_headers):
+    """Nutrient ranges filter the recipe list on the parsed nutrition values"""
+    url = '/api/v1/recipes'
+    recipes = {}
+    for name, nutrition in (("Nutrition lean", {"Energy (kJ)": "1264kJ", "Protein": "42.5 g", "Sodium": "0,8 g"}),
+                            ("Nutrition rich", {"Energy (kJ)": "3819 kJ", "Protein": "31g"}),
+                            ("Nutrition light", {"Calories": "300", "Protein": "12 g"})):
+        mock_request_data = {"classification": 1, "recipe_name": name, "nutrition": nutrition, "is_publish": True}
+        response = client.post(url, data=json.dumps(mock_request_data), headers=mock_request_headers)
+        assert response.status_code == 201
+        recipes[name] = json.loads(response.data.decode())["Recipe"][0]["id"]
+
+    def names(query):
+        response = client.get(f'{url}?per_page=100&{query}', headers=mock_request_headers)
+        assert response.status_code == 200
+        return {r["recipe_name"] for r in json.loads(response.data.decode())["recipes"]
+                if r["recipe_name"].startswith("Nutrition")}
+
+    assert names('energy_kj_max=2500&protein_g_min=30') == {"Nutrition lean"}
+    assert names('protein_g_min=30') == {"Nutrition lean", "Nutrition rich"}
+    # kcal and mg are converted to the unit of the column
+    assert names('energy_kj_min=1200&energy_kj_max=1300') == {"Nutrition lean", "Nutrition light"}
+    assert names('sodium_mg_min=800&sodium_mg_max=800') == {"Nutrition lean"}
+
+    '''updates are reflected'''
+    response = client.put(f'{url}/id/{recipes["Nutrition rich"]}',
+                          data=json.dumps({"nutrition": {"Energy (kJ)": "2000kJ", "Protein": "35 g"}}),
+                          headers=mock_request_headers)
+    assert response.status_code == 200
+    assert names('energy_kj_max=2500&protein_g_min=30') == {"Nutrition lean", "Nutrition rich"}
+
+    response = client.get(f'{url}?protein_g_min=lots', headers=mock_request_headers)
+    assert response.status_code == 400
+
+
+def test_weekly_menu_shopping_list(client, mock_request_headers):
+    """Ingredient totals of a weekly menu, by normalized name and unit"""
+    response = client.post('/api/v1/weekly-menu', data=json.dumps({"week_number": 41, "is_publish": True}),
+                           headers=mock_request_headers)
+    menu = json.loads(response.data.decode())["WeeklyMenu"][0]["id"]
+    for name, servings, ingredients in (
+            ("Shopping curry", 2, [("Onion", "unit", 2), ("Rice", "g", 300), ("coconut milk", "ml", 400)]),
+            ("Shopping risotto", 4, [(" onion", "Unit", 1), ("rice", "g", 320), ("Parmesan", "g", 80)])):
+        mock_request_data = {"classification": 1, "recipe_name": name, "num_of_servings": servings,
+                             "nutrition": {}, "is_publish": True}
+        response = client.post('/api/v1/recipes', data=json.dumps(mock_request_data), headers=mock_request_headers)
+        recipe = json.loads(response.data.decode())["Recipe"][0]["id"]
+        client.post(f'/api/v1/recipes/id/{recipe}/ingredients', headers=mock_request_headers, data=json.dumps(
+            [{"ingredient_name": i, "unit": unit, "count": count} for i, unit, count in ingredients]))
+        response = client.post(f'/api/v1/weekly-menu/id/{menu}/recipe/id/{recipe}', headers=mock_request_headers)
+        assert response.status_code == 201
+
+    url = f'/api/v1/weekly-menu/id/{menu}/shopping-list'
+    response = client.get(url, headers=mock_request_headers)
+    assert response.status_code == 200
+    res = json.loads(response.data.decode())
+    assert res["shopping-list"] == [
+        {"name": "coconut milk", "unit": "ml", "quantity": 400, "recipes": 1},
+        {"name": "onion", "unit": "unit", "quantity": 3, "recipes": 2},
+        {"name": "parmesan", "unit": "g", "quantity": 80, "recipes": 1},
+        {"name": "rice", "unit": "g", "quantity": 620, "recipes": 2},
+    ]
+
+    '''scaled to 4 servings per recipe'''
+    response = client.get(f'{url}?servings=4', headers=mock_request_headers)
+    totals = {row["name"]: row["quantity"] for row in json.loads(response.data.decode())["shopping-list"]}
+    assert totals == {"coconut milk": 800, "onion": 5, "parmesan": 80, "rice": 920}
+
+    '''served from the cache until an ingredient changes'''
+    response = client.get(url, headers=mock_request_headers)
+    assert response.headers['X-Query-Count'] == '1'
+    client.post(f'/api/v1/recipes/id/{recipe}/ingredients', headers=mock_request_headers,
+                data=json.dumps([{"ingredient_name": "Leek", "unit": "unit", "count": 1}]))
+    response = client.get(url, headers=mock_request_headers)
+    assert "leek" in [row["name"] for row in json.loads(response.data.decode())["shopping-list"]]
+
+    '''scaling that does not divide evenly keeps the fractions'''
+    response = client.get(f'{url}?servings=3', headers=mock_request_headers)
+    totals = {row["name"]: row["quantity"] for row in json.loads(response.data.decode())["shopping-list"]}
+    assert totals == {"coconut milk": 600, "leek": 0.75, "onion": 3.75, "parmesan": 60, "rice": 690}
+
+    response = client.get(f'{url}?servings=0', headers=mock_request_headers)
+    assert response.status_code == 400
+    response = client.get('/api/v1/weekly-menu/id/999999/shopping-list', headers=mock_request_headers)
+    assert response.status_code == 404
+
+
+def test_review_filters(client, mock_request_headers):
+    """Review lists filter by reviewed row, customer, score and publication date"""
+    classification = RecipeClassification.get_by_id(1)
+    recipes = [Recipe.create(recipe_name=f"review filter recipe {i}", classification=classification, nutrition={},
+                             is_publish=True) for i in range(2)]
+    customers = [Customer.create(public_id=uuid.uuid4(), name=f"review filter customer {i}", password="x",
+                                 is_active=True) for i in range(2)]
+    for recipe, customer, score in ((recipes[0], customers[0], 2), (recipes[0], customers[1], 5),
+                                    (recipes[1], customers[0], 4)):
+        mock_request_data = {"recipe": recipe.id, "customer": customer.id, "score": score, "summary": "s",
+                             "review": "r"}
+        response = client.post('/api/v1/recipe-review', data=json.dumps(mock_request_data),
+                               headers=mock_request_headers)
+        assert response.status_code == 201
+
+    def scores(query):
+        response = client.get(f'/api/v1/recipe-review?{query}', headers=mock_request_headers)
+        assert response.status_code == 200
+        return sorted(int(r["score"]) for r in json.loads(response.data.decode())["recipe-review"])
+
+    assert scores(f'recipe_id={recipes[0].id}') == [2, 5]
+    assert scores(f'customer_id={customers[0].id}') == [2, 4]
+    assert scores(f'recipe_id={recipes[0].id}&min_score=3') == [5]
+    assert scores(f'customer_id={customers[1].id}&since=2000-01-01&until=2999-01-01') == [5]
+    response = client.get(f'/api/v1/recipe-review?customer_id={customers[1].id}&until=2000-01-01',
+                          headers=mock_request_headers)
+    assert response.status_code == 404
+
+    response = client.get('/api/v1/recipe-review?since=yesterday', headers=mock_request_headers)
+    assert response.status_code == 400
+
+    menu = WeeklyMenu.create(week_number=45)
+    mock_request_data = {"menu": menu.id, "customer": customers[0].id, "score": 3, "summary": "s", "review": "r"}
+    response = client.post('/api/v1/weekly-menu-review', data=json.dumps(mock_request_data),
+                           headers=mock_request_headers)
+    assert response.status_code == 201
+    response = client.get(f'/api/v1/weekly-menu-review?menu_id={menu.id}&customer_id={customers[0].id}',
+                          headers=mock_request_headers)
+    res = json.loads(response.data.decode())["weekly-menu-review"]
+    assert [(r["menu"], r["score"]) for r in res] == [("45", "3")]
+
+
+def test_recipe_rating(client, mock_request_headers):
+    """Review writes keep the rating rollup on recipe payloads, lists sort by it"""
+    classification = RecipeClassification.get_by_id(1)
+    recipes = [Recipe.create(recipe_name=f"rating recipe {i}", classification=classification, nutrition={},
+                             is_publish=True).id for i in range(3)]
+    customers = [Customer.create(public_id=uuid.uuid4(), name=f"rating customer {i}", password="x",
+                                 is_active=True).id for i in range(2)]
+    reviews = []
+    for recipe, customer, score in ((recipes[0], customers[0], 3), (recipes[0], customers[1], 4),
+                                    (recipes[1], customers[0], 5), (recipes[2], customers[0], 4),
+                                    (recipes[2], customers[1], 5)):
+        mock_request_data = {"recipe": recipe, "customer": customer, "score": score, "summary": "s", "review": "r"}
+        response = client.post('/api/v1/recipe-review', data=json.dumps(mock_request_data),
+                               headers=mock_request_headers)
+        assert response.status_code == 201
+        reviews.append(json.loads(response.data.decode())["recipe-review"][0]["id"])
+
+    response = client.get(f'/api/v1/recipes/id/{recipes[2]}', headers=mock_request_headers)
+    recipe = json.loads(response.data.decode())["recipes"][0]
+    assert (recipe["rating"], recipe["review_count"]) == (4.5, 2)
+    assert recipe["rating_histogram"] == {"1": 0, "2": 0, "3": 0, "4": 1, "5": 1}
+
+    def order(sort, per_page=100):
+        response = client.get(f'/api/v1/recipes?sort={sort}&per_page={per_page}', headers=mock_request_headers)
+        assert response.status_code == 200
+        return [r["id"] for r in json.loads(response.data.decode())["recipes"] if r["id"] in recipes]
+
+    assert order('rating') == [recipes[1], recipes[2], recipes[0]]
+    assert order('review_count') == [recipes[0], recipes[2], recipes[1]]
+
+    '''unpublishing and rescoring reviews update the rollup'''
+    response = client.delete(f'/api/v1/recipe-review/id/{reviews[2]}', headers=mock_request_headers)
+    assert response.status_code == 204
+    response = client.put(f'/api/v1/recipe-review/id/{reviews[0]}', data=json.dumps({"score": 5}),
+                          headers=mock_request_headers)
+    assert response.status_code == 200
+    assert order('rating') == [recipes[0], recipes[2], recipes[1]]
+
+    '''ranked cursor pages'''
+    response = client.get('/api/v1/recipes?sort=rating&per_page=1', headers=mock_request_headers)
+    res = json.loads(response.data.decode())
+    response = client.get(f'/api/v1/recipes?sort=rating&per_page=1&cursor={res["meta"]["next"]}',
+                          headers=mock_request_headers)
+    assert json.loads(response.data.decode())["recipes"][0]["rank"] <= res["recipes"][0]["rank"]
+
+    response = client.get('/api/v1/recipes?sort=name', headers=mock_request_headers)
+    assert response.status_code == 400
+
+
+def test_reviewer_rename_conditional_get(client, mock_request_headers):
+    """Recipe reads including reviews follow writes to the reviewers' names"""
+    recipe = Recipe.create(recipe_name="ETag reviewed recipe", classification=RecipeClassification.get_by_id(1),
+                           nutrition={}, is_publish=True)
+    customer = Customer.create(public_id=uuid.uuid4(), name="etag reviewer", password="x", is_active=True)
+    RecipeReview.create(recipe=recipe, customer=customer, score=4, summary="ok", review="ok")
+    url = f'/api/v1/recipes/id/{recipe.id}?include=reviews'
+    response = client.get(url, headers=mock_request_headers)
+    headers = dict(mock_request_headers, **{"If-None-Match": response.headers["ETag"]})
+    assert client.get(url, headers=headers).status_code == 304
+
+    response = client.put(f'/api/v1/customer/id/{customer.id}', data=json.dumps({"name": "etag reviewer 2"}),
+                          headers=mock_request_headers)
+    assert response.status_code == 200
+    response = client.get(url, headers=headers)
+    assert response.status_code == 200
+    assert "etag reviewer 2" in json.dumps(json.loads(response.data.decode())["recipes"][0]["reviews"])
+
+
+def test_sparse_fields(client, mock_request_headers):
+    """?fields= narrows list payloads and ?include= adds batch loaded relations"""
+    full = client.get('/api/v1/recipes?per_page=5', headers=mock_request_headers)
+    sparse = client.get('/api/v1/recipes?per_page=5&fields=id,recipe_name', headers=mock_request_headers)
+    assert sparse.status_code == 200
+    assert int(sparse.headers["X-Query-Count"]) < int(full.headers["X-Query-Count"])
+    res = json.loads(sparse.data.decode())
+    assert [set(r) for r in res["recipes"]] == [{"id", "recipe_name"}] * len(res["recipes"])
+    assert [r["id"] for r in res["recipes"]] == [r["id"] for r in json.loads(full.data.decode())["recipes"]]
+
+    response = client.get('/api/v1/recipes/search?q=recipe&fields=recipe_name&include=reviews',
+                          headers=mock_request_headers)
+    assert response.status_code == 200
+    assert set(json.loads(response.data.decode())["recipes"][0]) == {"id", "rank", "recipe_name", "reviews"}
+
+    WeeklyMenu.get_or_create(week_number=51, defaults={'is_publish': True})
+    response = client.get('/api/v1/weekly-menu?fields=week_number', headers=mock_request_headers)
+    assert set(json.loads(response.data.decode())["weekly-menu"][0]) == {"id", "week_number"}
+    response = client.get('/api/v1/recipes-classification?include=recipes', headers=mock_request_headers)
+    assert "recipes" in json.loads(response.data.decode())["recipes-classification"][0]
+
+    for path in ('/api/v1/recipes?fields=id,secret', '/api/v1/weekly-menu?include=ingredients',
+                 '/api/v1/recipes-classification?include=reviews'):
+        response = client.get(path, headers=mock_request_headers)
+        assert response.status_code == 400
+
+
+def test_weekly_menu_bulk_recipes(client, mock_request_headers):
+    """A menu's recipe set is replaced, diffed and cloned in one request each"""
+    classification = RecipeClassification.get_by_id(1)
+    recipes = [Recipe.create(recipe_name=f"bulk menu recipe {i}", classification=classification, nutrition={},
+                             is_publish=True).id for i in range(5)]
+    menus = []
+    for week in (46, 47):
+        response = client.post('/api/v1/weekly-menu', data=json.dumps({"week_number": week, "is_publish": True}),
+                               headers=mock_request_headers)
+        menus.append(json.loads(response.data.decode())["WeeklyMenu"][0]["id"])
+    url = f'/api/v1/weekly-menu/id/{menus[0]}/recipes'
+
+    def mapped(menu):
+        return sorted(r for r, in WeeklyRecipeMap.select(WeeklyRecipeMap.recipe).where(
+            WeeklyRecipeMap.week == menu).tuples())
+
+    response = client.put(url, data=json.dumps({"recipes": recipes[:3] + [recipes[0]]}), headers=mock_request_headers)
+    assert response.status_code == 200
+    res = json.loads(response.data.decode())
+    assert (sorted(res["meta"]["added"]), res["meta"]["removed"]) == (recipes[:3], 0)
+    assert len(res["WeeklyMenu"][0]["recipes"]) == 3
+
+    response = client.put(url, data=json.dumps({"recipes": recipes[2:]}), headers=mock_request_headers)
+    res = json.loads(response.data.decode())
+    assert (sorted(res["meta"]["added"]), res["meta"]["removed"]) == (recipes[3:], 2)
+    assert mapped(menus[0]) == recipes[2:]
+
+    response = client.patch(url, data=json.dumps({"add": recipes[:2], "remove": [recipes[4]]}),
+                            headers=mock_request_headers)
+    res = json.loads(response.data.decode())
+    assert (sorted(res["meta"]["added"]), res["meta"]["removed"]) == (recipes[:2], 1)
+    assert mapped(menus[0]) == recipes[:4]
+
+    '''the single recipe endpoint relies on the unique index too'''
+    response = client.post(f'/api/v1/weekly-menu/id/{menus[0]}/recipe/id/{recipes[0]}', headers=mock_request_headers)
+    assert response.status_code == 409
+
+    '''cloning copies the recipes of another week with one INSERT ... SELECT'''
+    client.put(f'/api/v1/weekly-menu/id/{menus[1]}/recipes', data=json.dumps({"recipes": [recipes[4]]}),
+               headers=mock_request_headers)
+    response = client.post(f'/api/v1/weekly-menu/id/{menus[1]}/recipes/clone', data=json.dumps({"week_number": 46}),
+                           headers=mock_request_headers)
+    assert response.status_code == 201
+    assert sorted(json.loads(response.data.decode())["meta"]["added"]) == recipes[:4]
+    assert mapped(menus[1]) == recipes
+    response = client.post(f'/api/v1/weekly-menu/id/{menus[1]}/recipes/clone',
+                           data=json.dumps({"week_number": 46, "replace": True}), headers=mock_request_headers)
+    assert json.loads(response.data.decode())["meta"]["removed"] == 5
+    assert mapped(menus[1]) == recipes[:4]
+
+    for method, path, payload, status in (
+            ('put', url, {"recipes": [recipes[0], 999999]}, 400),
+            ('put', url, {"recipes": "all"}, 400),
+            ('patch', url, {"add": [recipes[0]], "remove": [recipes[0]]}, 400),
+            ('put', '/api/v1/weekly-menu/id/999999/recipes', {"recipes": []}, 404),
+            ('post', f'{url}/clone', {"week_number": 46}, 400),
+            ('post', f'{url}/clone', {"week_number": 9}, 404)):
+        response = getattr(client, method)(path, data=json.dumps(payload), headers=mock_request_headers)
+        assert response.status_code == status, path
+    assert mapped(menus[0]) == recipes[:4]
+
+
+def test_classification_counts(client, mock_request_headers):
+    """Classifications carry their recipe counts, cached until a recipe or classification write"""
+    classification = RecipeClassification.create(name="counted classification", is_publish=True)
+    for i, published in enumerate((True, True, False)):
+        Recipe.create(recipe_name=f"counted recipe {i}", classification=classification, nutrition={},
+                      is_publish=published)
+    url = f'/api/v1/recipes-classification/id/{classification.id}'
+    response = client.get(url, headers=mock_request_headers)
+    row = json.loads(response.data.decode())["recipes-classification"][0]
+    assert (row["recipe_count"], row["published_recipe_count"], row["has_links"]) == (3, 2, True)
+
+    response = client.get(url, headers=mock_request_headers)
+    assert response.headers["X-Query-Count"] == "1"
+
+    mock_request_data = {"classification": classification.id, "recipe_name": "counted recipe 3", "nutrition": {},
+                         "is_publish": True}
+    response = client.post('/api/v1/recipes', data=json.dumps(mock_request_data), headers=mock_request_headers)
+    assert response.status_code == 201
+    response = client.get(url, headers=mock_request_headers)
+    row = json.loads(response.data.decode())["recipes-classification"][0]
+    assert (row["recipe_count"], row["published_recipe_count"]) == (4, 3)
+
+    response = client.get('/api/v1/recipes-classification?per_page=100', headers=mock_request_headers)
+    assert int(response.headers["X-Query-Count"]) == 2
+    rows = json.loads(response.data.decode())["recipes-classification"]
+    assert all(r["has_links"] == (r["recipe_count"] > 0) for r in rows)
+
+    '''deleting answers an empty 204 without counting recipes'''
+    unused = RecipeClassification.create(name="uncounted classification", is_publish=True)
+    response = client.delete(f'/api/v1/recipes-classification/id/{unused.id}', headers=mock_request_headers)
+    assert (response.status_code, response.data) == (204, b'')
@@ -0,0 +1,28 @@
+import threading
+
+from application.metrics import Counter, Histogram
+
+
+def test_finished_thread_shards_are_folded():
+    '''a thread per sample keeps the totals but not the shards'''
+    counter = Counter('test_total', 'Test counter.', ('route',))
+    histogram = Histogram('test_seconds', 'Test histogram.', buckets=(0.1, 1.0))
+
+    def record():
+        counter.inc('/')
+        histogram.observe(0.5)
+
+    for _ in range(50):
+        thread = threading.Thread(target=record)
+        thread.start()
+        thread.join()
+    assert len(counter._shards) <= 1
+    assert 'test_total{route="/"} 50' in list(counter.collect())
+    assert not counter._shards
+
+    record()
+    assert 'test_total{route="/"} 51' in list(counter.collect())
+    lines = list(histogram.collect())
+    assert 'test_seconds_bucket{le="1.0"} 51' in lines
+    assert 'test_seconds_sum 25.5' in lines
+    assert len(histogram._shards) == 1
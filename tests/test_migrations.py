@@ -0,0 +1,73 @@
+import pytest
+from peewee import IntegrityError
+
+from application import migrations, models
+from application.app import create_app
+from application.models import Recipe, RecipeClassification, WeeklyMenu, WeeklyRecipeMap, db
+
+pytestmark = pytest.mark.usefixtures('database')
+
+SCHEMA = 'migration_test'
+
+
+@pytest.fixture
+def schema():
+    """A connection creating its tables in an empty schema, dropped afterwards.
+    public stays on the search_path for the hstore type.
+    """
+    if not db.is_closed():
+        db.close()
+    with db.connection_context():
+        db.execute_sql(f'CREATE SCHEMA {SCHEMA}')
+        db.execute_sql(f'SET search_path TO {SCHEMA}, public')
+        try:
+            yield SCHEMA
+        finally:
+            db.execute_sql('RESET search_path')
+            db.execute_sql(f'DROP SCHEMA {SCHEMA} CASCADE')
+
+
+def test_migrations_apply_once():
+    """Every migration is recorded and running migrate again applies nothing"""
+    assert migrations.migrate() == []
+    assert migrations.applied() == {version for version, _ in migrations.versions()}
+    names = [name for name, in migrations.SchemaVersion.select(migrations.SchemaVersion.name)
+             .order_by(migrations.SchemaVersion.version).tuples()]
+    assert names == [function.__name__ for function in migrations.MIGRATIONS]
+
+
+def test_create_app_does_not_touch_the_database():
+    db.close_all()
+    db.reset_query_stats()
+    create_app("Development")
+    assert db.query_stats['queries'] == 0
+    assert db.stats['in_use'] == db.stats['idle'] == 0
+
+
+def test_fresh_database_matches_the_models(schema):
+    """An empty database migrates to the tables and indexes the models declare"""
+    assert migrations.migrate() == [function.__name__ for function in migrations.MIGRATIONS]
+    for model in models.BaseModel.__subclasses__() + [models.Customer]:
+        if model is migrations.SchemaVersion:
+            continue
+        table = model._meta.table_name
+        assert sorted(column.name for column in db.get_columns(table, schema)) == \
+            sorted(field.column_name for field in model._meta.sorted_fields), table
+        indexes = {index.name for index in db.get_indexes(table, schema)}
+        assert {index._name for index in model._meta.fields_to_index()} <= indexes, table
+
+
+def test_unique_weekly_recipe_map_drops_duplicates(schema):
+    """A database created before versioned migrations, with duplicate menu
+    recipes, migrates from version 1 on
+    """
+    migrations.initial_schema(db)
+    classification = RecipeClassification.create(name="migrated type")
+    menu = WeeklyMenu.create(week_number=48)
+    recipe = Recipe.create(recipe_name="migrated recipe", classification=classification, nutrition={})
+    WeeklyRecipeMap.insert_many([{'week': menu, 'recipe': recipe}] * 3).execute()
+
+    assert migrations.migrate() == [function.__name__ for function in migrations.MIGRATIONS]
+    assert WeeklyRecipeMap.select().where(WeeklyRecipeMap.week == menu).count() == 1
+    with pytest.raises(IntegrityError), db.atomic():
+        WeeklyRecipeMap.create(week=menu, recipe=recipe)
@@ -0,0 +1,160 @@
+import decimal
+import json
+import uuid
+from datetime import date, datetime
+
+import pytest
+from flask.json.provider import DefaultJSONProvider
+
+from application import serializers
+from application.app import create_app
+from application.models import (Customer, Ingredient, Recipe, RecipeClassification, RecipeReview, WeeklyMenu,
+                                WeeklyMenuReview, WeeklyMenuScore, WeeklyRecipeMap, db)
+
+
+@pytest.fixture(scope='module')
+def app():
+    return create_app("Development")
+
+
+@pytest.fixture(scope='module')
+def rows(app, database):
+    """A small graph of rows, text with the surrounding whitespace the legacy serializers strip"""
+    with db.atomic():
+        classification = RecipeClassification.create(name='serializer class', is_publish=True)
+        recipes = [Recipe.create(recipe_name=f'serializer recipe {i}', description=' spaced ', is_publish=True,
+                                 nutrition={'Energy (kJ)': '1264kJ', 'Protein': f'{i} g'},
+                                 classification=classification) for i in range(3)]
+        for recipe in recipes[:2]:
+            Ingredient.create(ingredient_name='  Garlic ', unit=' clove', count=2, recipe=recipe)
+            Ingredient.create(ingredient_name='rice', unit='g', count=300, recipe=recipe)
+        customer = Customer.create(public_id=uuid.uuid4(), name='serializer customer', password='x', is_active=True)
+        menu = WeeklyMenu.create(week_number=44)
+        for recipe in recipes[1:]:
+            WeeklyRecipeMap.create(week=menu, recipe=recipe)
+        RecipeReview.create(recipe=recipes[0], customer=customer, score=4, summary='good ', review=' tasty')
+        WeeklyMenuReview.create(menu=menu, customer=customer, score=3, summary='fine', review='ok ')
+        WeeklyMenuScore.apply(menu.id, 3, 1)
+    return {'recipes': [r.id for r in recipes], 'menu': menu.id, 'customer': customer.id,
+            'classification': classification.id}
+
+
+@pytest.mark.parametrize('model, serializer, key', [
+    (Recipe, serializers.recipes, 'recipes'),
+    (RecipeClassification, serializers.classifications, 'classification'),
+    (Ingredient, serializers.ingredients, 'recipes'),
+    (RecipeReview, serializers.recipe_reviews, 'recipes'),
+    (WeeklyMenuReview, serializers.weekly_menu_reviews, 'menu'),
+    (WeeklyMenu, serializers.weekly_menus, 'menu'),
+    (Customer, serializers.customers, 'customer'),
+])
+def test_projection_matches_model_serialize(rows, model, serializer, key):
+    """Projected rows are exactly what the models' serialize properties produce"""
+    column = {
+        'recipes': {Recipe: Recipe.id, Ingredient: Ingredient.recipe, RecipeReview: RecipeReview.recipe},
+        'classification': {RecipeClassification: RecipeClassification.id},
+        'menu': {WeeklyMenu: WeeklyMenu.id, WeeklyMenuReview: WeeklyMenuReview.menu},
+        'customer': {Customer: Customer.id},
+    }[key][model]
+    ids = rows[key] if isinstance(rows[key], list) else [rows[key]]
+    query = model.select().where(column.in_(ids)).order_by(model.id)
+    expected = [row.serialize for row in query]
+    assert expected
+    data = serializer(query.clone())
+    if model is RecipeClassification:
+        # counted in the page query only, the model has no per row equivalent
+        assert [(row.pop('recipe_count'), row.pop('published_recipe_count')) for row in data] == [(3, 3)]
+    assert data == expected
+
+
+def test_ranked_recipes_keep_order(rows):
+    ranked = [{'id': rows['recipes'][2], 'rank': 2.0}, {'id': rows['recipes'][0], 'rank': 1.0}]
+    data = serializers.ranked_recipes(ranked)
+    assert [(r['id'], r['rank']) for r in data] == [(rows['recipes'][2], 2.0), (rows['recipes'][0], 1.0)]
+    assert data[1]['ingredients'][0]['ingredient_name'] == 'Garlic'
+
+
+GOLDEN = {
+    'b': [1, 2.5, None, True],
+    'a': {'when': datetime(2021, 3, 4, 5, 6, 7), 'day': date(2021, 3, 4)},
+    'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+    'price': decimal.Decimal('1.10'),
+    'text': 'crème fraîche',
+}
+GOLDEN_JSON = ('{"a":{"day":"Thu, 04 Mar 2021 00:00:00 GMT","when":"Thu, 04 Mar 2021 05:06:07 GMT"},'
+               '"b":[1,2.5,null,true],"id":"12345678-1234-5678-1234-567812345678","price":"1.10",'
+               '"text":"crème fraîche"}')
+
+
+@pytest.mark.parametrize('fast', [True, False])
+def test_json_provider_golden(app, monkeypatch, fast):
+    """orjson and the stdlib fallback produce Flask's JSON"""
+    if not fast:
+        monkeypatch.setattr(serializers, 'orjson', None)
+    elif serializers.orjson is None:
+        pytest.skip('orjson is not installed')
+    provider = serializers.FastJSONProvider(app)
+    assert json.loads(provider.dumps(GOLDEN, separators=(',', ':'))) == json.loads(GOLDEN_JSON)
+    assert json.loads(provider.dumps(GOLDEN)) == json.loads(DefaultJSONProvider(app).dumps(GOLDEN))
+    with app.test_request_context():
+        response = provider.response(GOLDEN)
+    assert response.mimetype == 'application/json'
+    assert json.loads(response.get_data()) == json.loads(GOLDEN_JSON)
+    if fast:
+        assert response.get_data() == GOLDEN_JSON.encode() + b'\n'
+
+
+def test_json_provider_falls_back(app):
+    """Values orjson cannot encode go through the stdlib encoder"""
+    provider = serializers.FastJSONProvider(app)
+    assert provider.dumps({'big': 2 ** 70}) == '{"big": 1180591620717411303424}'
+    assert json.loads(provider.dumps({'a': 1}, ensure_ascii=False)) == {'a': 1}
+
+
+@pytest.mark.parametrize('serializer, defaults, includes, key, fields, queries', [
+    (serializers.recipes, serializers.RECIPE_KEYS, serializers.RECIPE_INCLUDES, 'recipes', 'id,recipe_name', 1),
+    (serializers.weekly_menus, serializers.MENU_KEYS, serializers.MENU_INCLUDES, 'menu', 'id,week_number', 1),
+    (serializers.classifications, serializers.CLASSIFICATION_KEYS, serializers.CLASSIFICATION_INCLUDES,
+     'classification', 'name', 1),
+])
+def test_sparse_fieldsets(rows, serializer, defaults, includes, key, fields, queries):
+    """Sparse rows are the default rows narrowed to the keys, without the queries of the others"""
+    model = {'recipes': Recipe, 'menu': WeeklyMenu, 'classification': RecipeClassification}[key]
+    ids = rows[key] if isinstance(rows[key], list) else [rows[key]]
+    query = model.select().where(model.id.in_(ids)).order_by(model.id)
+    full = serializer(query.clone())
+    keys = serializers.requested(fields, None, defaults, includes)
+    db.reset_query_stats()
+    sparse = serializer(query.clone(), keys)
+    assert db.query_stats['queries'] == queries
+    assert sparse == [{name: row[name] for name in keys} for row in full]
+    assert serializers.requested(None, None, defaults, includes) is None
+    with pytest.raises(ValueError):
+        serializers.requested('id,nope', None, defaults, includes)
+    with pytest.raises(ValueError):
+        serializers.requested(None, 'id', defaults, includes)
+
+
+def test_includes_are_batch_loaded(rows):
+    """Includes add their keys for a page in one query each"""
+    keys = serializers.requested('recipe_name', 'reviews,ingredients', serializers.RECIPE_KEYS,
+                                 serializers.RECIPE_INCLUDES)
+    db.reset_query_stats()
+    data = serializers.recipes(Recipe.select().where(Recipe.id.in_(rows['recipes'])).order_by(Recipe.id), keys)
+    assert db.query_stats['queries'] == 3
+    assert set(data[0]) == {'id', 'recipe_name', 'reviews', 'ingredients'}
+    expected = serializers.recipe_reviews(RecipeReview.select().where(RecipeReview.recipe == rows['recipes'][0]))
+    assert data[0]['reviews'] == expected
+    assert data[1]['reviews'] == [] and data[2]['ingredients'] == []
+
+    menus = serializers.weekly_menus(WeeklyMenu.select().where(WeeklyMenu.id == rows['menu']),
+                                     serializers.requested(None, 'reviews', serializers.MENU_KEYS,
+                                                           serializers.MENU_INCLUDES))
+    assert menus[0]['reviews'] == serializers.weekly_menu_reviews(
+        WeeklyMenuReview.select().where(WeeklyMenuReview.menu == rows['menu']))
+    assert len(menus[0]['recipes']) == 2
+    classifications = serializers.classifications(
+        RecipeClassification.select().where(RecipeClassification.id == rows['classification']),
+        serializers.requested('id', 'recipes', serializers.CLASSIFICATION_KEYS, serializers.CLASSIFICATION_INCLUDES))
+    assert classifications == [{'id': rows['classification'], 'recipes': [
+        {'id': recipe_id, 'recipe_name': f'serializer recipe {i}'} for i, recipe_id in enumerate(rows['recipes'])]}]
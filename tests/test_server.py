@@ -0,0 +1,13 @@
+from application import server
+
+
+def test_options():
+    '''one worker per CPU by default, gthread workers when threaded'''
+    settings = server.options()
+    assert settings['workers'] == server.cpu_count() >= 1
+    assert settings['preload_app'] is True
+    assert settings['worker_class'] == ('gthread' if settings['threads'] > 1 else 'sync')
+
+    settings = server.options(bind='127.0.0.1:9000', workers=3, threads=1)
+    assert (settings['bind'], settings['workers'], settings['worker_class']) == ('127.0.0.1:9000', 3, 'sync')
+    assert server.options(workers=None)['workers'] == server.cpu_count()
@@ -2,4 +2,5 @@ import os
 
 from application.app import create_app
 
-app = create_app(os.environ["FLASK_CONFIG"])
\ No newline at end of file
+# served by `python manage.py serve`, or `gunicorn wsgi:app` with gunicorn.conf.py
+app = create_app(os.environ["FLASK_CONFIG"])